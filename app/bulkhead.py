@@ -0,0 +1,105 @@
+import asyncio
+import time
+from math import ceil
+from typing import Awaitable, Callable
+
+from fastapi import HTTPException, Request, Response
+from prometheus_client import Counter, Gauge, Histogram
+
+queue_wait = Histogram(
+    "module_queue_wait_seconds",
+    "Time requests waited for a free slot in their module's bulkhead.",
+    ["module"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+queued_requests = Gauge(
+    "module_queued_requests",
+    "Requests currently waiting for a free slot in their module's bulkhead.",
+    ["module"],
+    multiprocess_mode="livesum",
+)
+rejected_requests = Counter(
+    "module_rejected_requests",
+    "Requests shed by their module's bulkhead, by reason.",
+    ["module", "reason"],
+)
+
+
+class Bulkhead:
+    """
+    Limits the number of concurrent requests of a module, so that a slow module can not starve the others.
+    A slot is held until the endpoint returned, streamed bodies are not covered.
+    Requests queue for a free slot and are rejected with a 503 once the queue is full or they waited for too long.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, max_queue_time: float):
+        """
+        :param max_concurrency: Number of requests handled at once.
+        :param max_queue: Number of requests waiting for a slot before new ones are rejected.
+        :param max_queue_time: Seconds a request may wait for a slot before being rejected.
+        """
+        self.max_queue = max_queue
+        self.max_queue_time = max_queue_time
+
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+
+    def _reject(self, module: str, reason: str) -> HTTPException:
+        rejected_requests.labels(module, reason).inc()
+        return HTTPException(
+            status_code=503,
+            detail="Service overloaded, try again later.",
+            headers={"Retry-After": str(ceil(self.max_queue_time))},
+        )
+
+    async def _acquire(self) -> bool:
+        """
+        Wait for a slot, returns whether one was free within max_queue_time.
+        Unlike wait_for before Python 3.12, a slot acquired just as the wait ends is never lost.
+        """
+        if not self.semaphore.locked():
+            # Does not wait
+            return await self.semaphore.acquire()
+
+        acquire = asyncio.ensure_future(self.semaphore.acquire())
+        try:
+            await asyncio.wait([acquire], timeout=self.max_queue_time)
+        except BaseException:
+            # Cancelled, e.g., the client went away
+            if acquire.done() and not acquire.cancelled():
+                self.semaphore.release()
+            acquire.cancel()
+            raise
+
+        if acquire.done():
+            return True
+
+        # The semaphore hands the slot on if it was woken up in the meantime
+        acquire.cancel()
+        return False
+
+    def wrap(
+        self, module: str, handler: Callable[[Request], Awaitable[Response]]
+    ) -> Callable[[Request], Awaitable[Response]]:
+        async def limited_handler(request: Request) -> Response:
+            if self.semaphore.locked() and self.waiting >= self.max_queue:
+                raise self._reject(module, "queue_full")
+
+            self.waiting += 1
+            queued_requests.labels(module).inc()
+            start = time.perf_counter()
+            try:
+                acquired = await self._acquire()
+            finally:
+                self.waiting -= 1
+                queued_requests.labels(module).dec()
+                queue_wait.labels(module).observe(time.perf_counter() - start)
+            if not acquired:
+                raise self._reject(module, "queue_timeout")
+
+            try:
+                return await handler(request)
+            finally:
+                self.semaphore.release()
+
+        return limited_handler
@@ -0,0 +1,193 @@
+import zlib
+from typing import Optional
+
+from prometheus_client import Counter
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Optional codec, only offered when installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compression_bytes = Counter(
+    "response_compression_bytes",
+    "Bytes passed through the compression middleware, by encoding and direction.",
+    ["encoding", "direction"],
+)
+
+# Already compressed or streamed media, compressing those only costs CPU and latency
+EXCLUDED_CONTENT_TYPES = (
+    "image/png",
+    "image/jpeg",
+    "image/gif",
+    "image/webp",
+    "image/avif",
+    "audio/",
+    "video/",
+    "font/woff",
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/zstd",
+    "application/octet-stream",
+    "text/event-stream",
+)
+
+
+def is_excluded(content_type: str) -> bool:
+    # The converter responds with a plain "image"
+    return content_type.startswith(EXCLUDED_CONTENT_TYPES) or content_type == "image"
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """
+    Pick the best supported encoding the client accepts.
+    """
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+
+    if zstandard is not None and "zstd" in accepted:
+        return "zstd"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class Compressor:
+    """
+    A streaming compressor for one response.
+    """
+
+    def __init__(self, encoding: str, gzip_level: int, zstd_level: int):
+        self.encoding = encoding
+        if encoding == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=zstd_level).compressobj()
+        else:
+            self.compressor = zlib.compressobj(
+                gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        compression_bytes.labels(self.encoding, "in").inc(len(data))
+
+        if self.encoding == "zstd":
+            out = self.compressor.compress(data) + self.compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_FINISH
+                if final
+                else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+        else:
+            out = self.compressor.compress(data) + self.compressor.flush(
+                zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH
+            )
+
+        compression_bytes.labels(self.encoding, "out").inc(len(out))
+        return out
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses with zstd or gzip, depending on what the client accepts.
+    Already compressed media and streamed audio are passed through.
+    Routes may override this with a `compress` attribute, True to always and False to never compress.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        gzip_level: int = 6,
+        zstd_level: int = 3,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+        compressor: Optional[Compressor] = None
+        passthrough = False
+
+        async def send_with_compression(message: Message):
+            nonlocal start_message, compressor, passthrough
+
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+
+                # The route is known once the response starts
+                override = getattr(scope.get("route"), "compress", None)
+                passthrough = override is False or (
+                    override is None
+                    and (
+                        "content-encoding" in headers
+                        or is_excluded(headers.get("content-type", ""))
+                    )
+                )
+
+                if passthrough:
+                    await send(message)
+                else:
+                    start_message = message
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if compressor is None:
+                # Small, complete responses are not worth it
+                if not more_body and len(body) < self.minimum_size:
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+
+                compressor = Compressor(encoding, self.gzip_level, self.zstd_level)
+                headers = MutableHeaders(raw=start_message["headers"])
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                del headers["Content-Length"]
+
+                if not more_body:
+                    body = compressor.compress(body, True)
+                    headers["Content-Length"] = str(len(body))
+                    await send(start_message)
+                    await send({"type": "http.response.body", "body": body})
+                    return
+
+                await send(start_message)
+
+            # Streamed responses are flushed chunk by chunk to not delay them
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": compressor.compress(body, not more_body),
+                    "more_body": more_body,
+                }
+            )
+
+        await self.app(scope, receive, send_with_compression)
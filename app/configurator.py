@@ -1,32 +1,297 @@
+import asyncio
+import inspect
+import time
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Optional
+
 from dynaconf import Dynaconf
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from prometheus_client import Counter, Gauge, Histogram
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+from starlette.types import Receive, Scope, Send
+
+from . import loop_monitor, request_profiler
+from .bulkhead import Bulkhead
+from .jobs import Job, get_job_manager
+from .response_cache import ResponseCache
+from .threadpool import ThreadPool, default_pool
 
 # Metadata for OpenAPI
 tags_metadata = []
 
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+request_duration = Histogram(
+    "module_request_duration_seconds",
+    "Time until a module's endpoint returned its response.",
+    ["module"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+request_size = Histogram(
+    "module_request_size_bytes",
+    "Size of requests to a module's endpoints.",
+    ["module"],
+    buckets=SIZE_BUCKETS,
+)
+response_size = Histogram(
+    "module_response_size_bytes",
+    "Size of responses from a module's endpoints.",
+    ["module"],
+    buckets=SIZE_BUCKETS,
+)
+requests_in_progress = Gauge(
+    "module_requests_in_progress",
+    "Requests currently handled by a module's endpoints.",
+    ["module"],
+    multiprocess_mode="livesum",
+)
+request_errors = Counter(
+    "module_request_errors",
+    "Requests to a module's endpoints which failed, by status class.",
+    ["module", "status"],
+)
+
+
+async def _count_bytes(
+    module: str, iterator: AsyncIterator[bytes | str]
+) -> AsyncIterator[bytes | str]:
+    size = 0
+    try:
+        async for chunk in iterator:
+            size += len(chunk)
+            yield chunk
+    finally:
+        response_size.labels(module).observe(size)
+
+
+class ModuleRoute(APIRoute):
+    """
+    A route recording latency, sizes, in-flight requests and errors, labeled by the module's tag.
+    Optionally limits concurrency, caches its responses, and overrides their compression.
+    """
+
+    def __init__(
+        self,
+        *args,
+        bulkhead: Optional[Bulkhead] = None,
+        cache: Optional[ResponseCache] = None,
+        compress: Optional[bool] = None,
+        **kwargs,
+    ):
+        self.bulkhead = bulkhead
+        self.cache = cache
+        self.compress = compress
+        super().__init__(*args, **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+        module = str(self.tags[0]) if self.tags else "default"
+
+        handler = request_profiler.wrap(self.path, handler)
+        handler = loop_monitor.wrap(self.path, handler)
+
+        if self.bulkhead is not None:
+            handler = self.bulkhead.wrap(module, handler)
+
+        # Cache hits do not occupy the bulkhead
+        if self.cache is not None:
+            handler = self.cache.wrap(module, handler)
+
+        async def instrumented_handler(request: Request) -> Response:
+            request_size.labels(module).observe(
+                int(request.headers.get("content-length", 0))
+            )
+
+            status = 500
+            start = time.perf_counter()
+            requests_in_progress.labels(module).inc()
+            try:
+                response = await handler(request)
+                status = response.status_code
+            except HTTPException as e:
+                status = e.status_code
+                raise
+            except RequestValidationError:
+                # Raised by the wrapped handler, and turned into a 422 by the app
+                status = 422
+                raise
+            finally:
+                requests_in_progress.labels(module).dec()
+                request_duration.labels(module).observe(time.perf_counter() - start)
+                if status >= 400:
+                    request_errors.labels(module, f"{status // 100}xx").inc()
+
+            # Streamed responses are counted once they are fully sent
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = _count_bytes(module, response.body_iterator)
+            elif hasattr(response, "body"):
+                response_size.labels(module).observe(len(response.body))
+
+            return response
+
+        return instrumented_handler
+
 
 class Configurator:
-    def __init__(self, app_: FastAPI, config_: Dynaconf):
+    """
+    What a module registers its endpoints with.
+    Modules started on startup, rather than lazily, are initialized on a staging app of which only routes and tags are
+    kept, use `app` for nothing else.
+    """
+
+    def __init__(
+        self, app_: FastAPI, config_: Dynaconf, tags: Optional[list[dict]] = None
+    ):
+        """
+        :param tags: Collects the OpenAPI metadata of registered tags, by default the global `tags_metadata`.
+        """
         self.tag = "default"
         self.app = app_
         self.config = config_
+        self.tags = tags_metadata if tags is None else tags
+
+        # Shared by all endpoints of this module
+        self.bulkhead = (
+            Bulkhead(
+                config_.get("max_concurrency"),
+                # Queue as many as are handled at once by default
+                config_.get("max_queue", config_.get("max_concurrency")),
+                config_.get("max_queue_time", 10),
+            )
+            if config_.get("max_concurrency", 0) > 0
+            else None
+        )
+
+        # Sync endpoints run on a dedicated pool if configured
+        self.threadpool = (
+            ThreadPool(config_.get("threads"))
+            if config_.get("threads", 0) > 0
+            else None
+        )
 
     def register(self, name: str, description: str):
         self.tag = name
-        tags_metadata.append({"name": name, "description": description})
+        self.tags.append({"name": name, "description": description})
 
-    def get(self, *args, **kwargs):
-        kwargs["tags"] = [self.tag]
-        return self.app.get(*args, **kwargs)
+    def threaded(self, func: Callable) -> Callable:
+        """
+        Turn a blocking function into an async one running on this module's threads, for sync endpoints or blocking
+        stages of async ones.
+        """
+        if self.threadpool is None:
+            return default_pool.wrap("default", request_profiler.track_thread(func))
+        return self.threadpool.wrap(self.tag, request_profiler.track_thread(func))
 
-    def post(self, *args, **kwargs):
+    def route(
+        self,
+        path: str,
+        methods: list[str],
+        cache: Optional[ResponseCache] = None,
+        compress: Optional[bool] = None,
+        limited: bool = True,
+        **kwargs,
+    ):
+        """
+        Register an endpoint, tagged and instrumented for this module.
+        :param cache: Caches successful responses, see `ResponseCache`.
+        :param compress: Always (True) or never (False) compress responses, by default depending on the content type.
+        :param limited: Whether requests occupy the module's bulkhead, cheap endpoints can skip it.
+        """
         kwargs["tags"] = [self.tag]
-        return self.app.post(*args, **kwargs)
 
-    def delete(self, *args, **kwargs):
-        kwargs["tags"] = [self.tag]
-        return self.app.delete(*args, **kwargs)
+        def decorator(func: Callable) -> Callable:
+            endpoint = (
+                func if inspect.iscoroutinefunction(func) else self.threaded(func)
+            )
 
-    def put(self, *args, **kwargs):
-        kwargs["tags"] = [self.tag]
-        return self.app.put(*args, **kwargs)
+            self.app.router.add_api_route(
+                path,
+                endpoint,
+                methods=methods,
+                route_class_override=partial(
+                    ModuleRoute,
+                    bulkhead=self.bulkhead if limited else None,
+                    cache=cache,
+                    compress=compress,
+                ),
+                **kwargs,
+            )
+            return func
+
+        return decorator
+
+    def job(self, path: str, **kwargs):
+        """
+        Register a function as background job, submitted via POST to path.
+        The submission returns a job, to be polled at `/v1/jobs/{id}` and fetched at `/v1/jobs/{id}/result`.
+        """
+
+        def decorator(func: Callable) -> Callable:
+            manager = get_job_manager()
+            manager.register(path, func)
+
+            def submit(**params) -> Job:
+                return manager.submit(path, params)
+
+            # Accept the same parameters as the function itself
+            submit.__signature__ = inspect.signature(func).replace(
+                return_annotation=Job
+            )
+            submit.__name__ = f"submit_{func.__name__}"
+
+            self.route(path, ["POST"], status_code=202, **kwargs)(submit)
+            return func
+
+        return decorator
+
+    def get(self, path: str, **kwargs):
+        return self.route(path, ["GET"], **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.route(path, ["POST"], **kwargs)
+
+    def delete(self, path: str, **kwargs):
+        return self.route(path, ["DELETE"], **kwargs)
+
+    def put(self, path: str, **kwargs):
+        return self.route(path, ["PUT"], **kwargs)
+
+
+class LazyModule:
+    """
+    Placeholder for a module, which imports and initializes it on the first request to one of its prefixes.
+    """
+
+    def __init__(
+        self, app_: FastAPI, prefixes: list[str], initializer: Callable[[], Any]
+    ):
+        self.app = app_
+        self.initializer = initializer
+        self.lock = asyncio.Lock()
+        self.initialized = False
+
+        # The prefix itself and paths below it, but not paths merely starting alike
+        self.routes = [
+            Route(path, self, include_in_schema=False)
+            for prefix in prefixes
+            for path in [prefix.rstrip("/"), f"{prefix.rstrip('/')}/{{path:path}}"]
+        ]
+        self.app.router.routes.extend(self.routes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        # Concurrent first requests wait for the same initialization
+        async with self.lock:
+            if not self.initialized:
+                await run_in_threadpool(self.initializer)
+
+                for route in self.routes:
+                    self.app.router.routes.remove(route)
+                self.app.openapi_schema = None
+                self.initialized = True
+
+        # Dispatch again, now hitting the actual routes
+        await self.app.router(scope, receive, send)
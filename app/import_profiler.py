@@ -0,0 +1,59 @@
+import importlib._bootstrap
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterator
+
+# Every import not yet in sys.modules goes through this function, the same spot `-X importtime` measures
+_original_find_and_load = importlib._bootstrap._find_and_load
+
+_local = threading.local()
+_lock = threading.Lock()
+_active = 0
+
+
+def _find_and_load(name, import_):
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        return _original_find_and_load(name, import_)
+
+    # The last element accumulates the time spent in nested imports
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        return _original_find_and_load(name, import_)
+    finally:
+        elapsed = time.perf_counter() - start
+        children = stack.pop()
+        _local.breakdown[name.partition(".")[0]] += elapsed - children
+        if stack:
+            stack[-1] += elapsed
+
+
+@contextmanager
+def profile_imports() -> Iterator[dict[str, float]]:
+    """
+    Record the self-time of all imports done by the current thread, aggregated by top-level package.
+    """
+    global _active
+
+    breakdown = defaultdict(float)
+
+    with _lock:
+        if _active == 0:
+            importlib._bootstrap._find_and_load = _find_and_load
+        _active += 1
+
+    _local.stack = []
+    _local.breakdown = breakdown
+    try:
+        yield breakdown
+    finally:
+        del _local.stack
+        del _local.breakdown
+
+        with _lock:
+            _active -= 1
+            if _active == 0:
+                importlib._bootstrap._find_and_load = _original_find_and_load
@@ -0,0 +1,459 @@
+import asyncio
+import inspect
+import json
+import logging
+import os
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from enum import Enum
+from functools import cache
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from prometheus_client import Counter, Histogram
+from pydantic import BaseModel
+from redis import Redis
+
+from .config import settings
+from .utils import get_cache_path
+
+if TYPE_CHECKING:
+    from .configurator import Configurator
+
+jobs_finished = Counter(
+    "jobs_finished",
+    "Background jobs finished, by name and status.",
+    ["name", "status"],
+)
+job_queue_time = Histogram(
+    "job_queue_seconds",
+    "Time background jobs waited for a worker.",
+    ["name"],
+    buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+)
+job_duration = Histogram(
+    "job_duration_seconds",
+    "Time background jobs took to run.",
+    ["name"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+)
+
+
+class JobStatus(Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class Job(BaseModel):
+    id: str
+    name: str
+    status: JobStatus = JobStatus.queued
+    created: float
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    error: Optional[str] = None
+    media_type: Optional[str] = None
+
+
+class JobStore(ABC):
+    """
+    Queues jobs and keeps their state and results.
+    """
+
+    @abstractmethod
+    def enqueue(self, job: Job, payload: bytes):
+        """
+        Store a new job and queue its payload for execution.
+        """
+
+    @abstractmethod
+    def dequeue(self, timeout: float) -> Optional[tuple[Job, bytes]]:
+        """
+        Take the next queued job, waiting up to timeout seconds.
+        """
+
+    @abstractmethod
+    def update(self, job: Job):
+        """
+        Store the new state of a job.
+        """
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Job]:
+        pass
+
+    @abstractmethod
+    def finish(self, job: Job, result: Optional[bytes], ttl: int):
+        """
+        Store the final state and result of a job, both are forgotten after ttl seconds.
+        """
+
+    @abstractmethod
+    def get_result(self, job_id: str) -> Optional[bytes]:
+        pass
+
+
+class MemoryJobStore(JobStore):
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.jobs: dict[str, Job] = {}
+        self.results: dict[str, bytes] = {}
+        self.expires: dict[str, float] = {}
+
+    def _expire(self):
+        now = time.time()
+        for job_id in [j for j, expires in self.expires.items() if expires < now]:
+            del self.jobs[job_id]
+            del self.expires[job_id]
+            self.results.pop(job_id, None)
+
+    def enqueue(self, job: Job, payload: bytes):
+        with self.lock:
+            self._expire()
+            self.jobs[job.id] = job
+        self.queue.put((job.id, payload))
+
+    def dequeue(self, timeout: float) -> Optional[tuple[Job, bytes]]:
+        try:
+            job_id, payload = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self.lock:
+            return self.jobs[job_id].model_copy(), payload
+
+    def update(self, job: Job):
+        with self.lock:
+            self.jobs[job.id] = job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            self._expire()
+            job = self.jobs.get(job_id)
+            return None if job is None else job.model_copy()
+
+    def finish(self, job: Job, result: Optional[bytes], ttl: int):
+        with self.lock:
+            # Results nobody polls for are forgotten as well
+            self._expire()
+            self.jobs[job.id] = job
+            if result is not None:
+                self.results[job.id] = result
+            self.expires[job.id] = time.time() + ttl
+
+    def get_result(self, job_id: str) -> Optional[bytes]:
+        with self.lock:
+            self._expire()
+            return self.results.get(job_id)
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Jobs in a SQLite file, possibly shared by several processes.
+    Each process renews the lease of the jobs it runs, those of processes which died are queued again once it ran out.
+    """
+
+    def __init__(self, db_file: str, poll_interval: float = 0.25, lease: float = 60):
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.running: set[str] = set()
+
+        with self.lock:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    data TEXT NOT NULL,
+                    payload BLOB,
+                    result BLOB,
+                    expires REAL,
+                    heartbeat REAL
+                )
+                """
+            )
+            # Files from before leases
+            columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+            if "heartbeat" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, created)"
+            )
+            self.conn.commit()
+
+        threading.Thread(target=self._beat, name="job-heartbeat", daemon=True).start()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.lease / 3)
+            with self.lock:
+                if self.running:
+                    placeholders = ", ".join("?" * len(self.running))
+                    self.conn.execute(
+                        f"UPDATE jobs SET heartbeat = ? WHERE id IN ({placeholders})",
+                        (time.time(), *self.running),
+                    )
+                    self.conn.commit()
+
+    def _requeue(self):
+        """
+        Queue jobs again whose process died while running them. Call within the lock.
+        """
+        rows = self.conn.execute(
+            "SELECT data FROM jobs WHERE status = ? AND (heartbeat IS NULL OR heartbeat < ?)",
+            (JobStatus.running.value, time.time() - self.lease),
+        ).fetchall()
+        for (data,) in rows:
+            job = Job.model_validate_json(data)
+            job.status = JobStatus.queued
+            job.started = None
+            self._update(job)
+        if rows:
+            logging.warning(f"Queued {len(rows)} interrupted jobs again.")
+
+    def enqueue(self, job: Job, payload: bytes):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO jobs (id, status, created, data, payload) VALUES (?, ?, ?, ?, ?)",
+                (job.id, job.status.value, job.created, job.model_dump_json(), payload),
+            )
+            self.conn.commit()
+
+    def dequeue(self, timeout: float) -> Optional[tuple[Job, bytes]]:
+        deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                self._requeue()
+                row = self.conn.execute(
+                    "SELECT data, payload FROM jobs WHERE status = ? ORDER BY created LIMIT 1",
+                    (JobStatus.queued.value,),
+                ).fetchone()
+                if row is not None:
+                    job = Job.model_validate_json(row[0])
+                    job.status = JobStatus.running
+                    self._update(job)
+                    self.conn.execute(
+                        "UPDATE jobs SET heartbeat = ? WHERE id = ?",
+                        (time.time(), job.id),
+                    )
+                    self.conn.commit()
+                    self.running.add(job.id)
+                    return job, row[1]
+                self.conn.commit()
+
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def _update(self, job: Job):
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, data = ? WHERE id = ?",
+            (job.status.value, job.model_dump_json(), job.id),
+        )
+
+    def update(self, job: Job):
+        with self.lock:
+            self._update(job)
+            self.conn.commit()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM jobs WHERE id = ? AND (expires IS NULL OR expires > ?)",
+                (job_id, time.time()),
+            ).fetchone()
+        return None if row is None else Job.model_validate_json(row[0])
+
+    def finish(self, job: Job, result: Optional[bytes], ttl: int):
+        with self.lock:
+            self.running.discard(job.id)
+            self.conn.execute(
+                "DELETE FROM jobs WHERE expires IS NOT NULL AND expires < ?",
+                (time.time(),),
+            )
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, data = ?, payload = NULL, result = ?, expires = ? WHERE id = ?",
+                (
+                    job.status.value,
+                    job.model_dump_json(),
+                    result,
+                    time.time() + ttl,
+                    job.id,
+                ),
+            )
+            self.conn.commit()
+
+    def get_result(self, job_id: str) -> Optional[bytes]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result FROM jobs WHERE id = ? AND (expires IS NULL OR expires > ?)",
+                (job_id, time.time()),
+            ).fetchone()
+        return None if row is None else row[0]
+
+
+class RedisJobStore(JobStore):
+    def __init__(self, redis: Redis, prefix: str = "api:jobs"):
+        self.redis = redis
+        self.prefix = prefix
+
+    def enqueue(self, job: Job, payload: bytes):
+        self.redis.set(f"{self.prefix}:{job.id}", job.model_dump_json())
+        self.redis.set(f"{self.prefix}:{job.id}:payload", payload)
+        self.redis.rpush(f"{self.prefix}:queue", job.id)
+
+    def dequeue(self, timeout: float) -> Optional[tuple[Job, bytes]]:
+        item = self.redis.blpop([f"{self.prefix}:queue"], timeout=timeout)
+        if item is None:
+            return None
+        job_id = item[1].decode() if isinstance(item[1], bytes) else item[1]
+        job = self.get(job_id)
+        payload = self.redis.get(f"{self.prefix}:{job_id}:payload")
+        if job is None or payload is None:
+            return None
+        return job, payload
+
+    def update(self, job: Job):
+        self.redis.set(f"{self.prefix}:{job.id}", job.model_dump_json())
+
+    def get(self, job_id: str) -> Optional[Job]:
+        data = self.redis.get(f"{self.prefix}:{job_id}")
+        return None if data is None else Job.model_validate_json(data)
+
+    def finish(self, job: Job, result: Optional[bytes], ttl: int):
+        self.redis.set(f"{self.prefix}:{job.id}", job.model_dump_json(), ex=ttl)
+        self.redis.delete(f"{self.prefix}:{job.id}:payload")
+        if result is not None:
+            self.redis.set(f"{self.prefix}:{job.id}:result", result, ex=ttl)
+
+    def get_result(self, job_id: str) -> Optional[bytes]:
+        return self.redis.get(f"{self.prefix}:{job_id}:result")
+
+
+def encode_result(result: Any) -> tuple[bytes, str]:
+    """
+    Convert the return value of a job into its content and media type.
+    """
+    if isinstance(result, Response):
+        return bytes(result.body), result.media_type or "application/octet-stream"
+    if isinstance(result, bytes):
+        return result, "application/octet-stream"
+    return json.dumps(jsonable_encoder(result)).encode(), "application/json"
+
+
+class JobManager:
+    """
+    Runs registered functions on a pool of worker threads, taking jobs from a store.
+    """
+
+    def __init__(self, store: JobStore, workers: int = 2, result_ttl: int = 3600):
+        self.store = store
+        self.result_ttl = result_ttl
+        self.functions: dict[str, Callable] = {}
+
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"job-{i}", daemon=True).start()
+
+    def register(self, name: str, func: Callable):
+        self.functions[name] = func
+
+    def submit(self, name: str, kwargs: dict) -> Job:
+        job = Job(id=uuid.uuid4().hex, name=name, created=time.time())
+        self.store.enqueue(job, pickle.dumps(kwargs))
+        return job
+
+    def _run(self, job: Job, payload: bytes):
+        job.status = JobStatus.running
+        job.started = time.time()
+        self.store.update(job)
+        job_queue_time.labels(job.name).observe(job.started - job.created)
+
+        result = None
+        try:
+            value = self.functions[job.name](**pickle.loads(payload))
+            if inspect.iscoroutine(value):
+                value = asyncio.run(value)
+            result, job.media_type = encode_result(value)
+            job.status = JobStatus.done
+        except Exception as e:
+            logging.exception(f"Job {job.name} failed")
+            job.status = JobStatus.failed
+            job.error = str(e) if not isinstance(e, HTTPException) else str(e.detail)
+
+        job.finished = time.time()
+        job_duration.labels(job.name).observe(job.finished - job.started)
+        jobs_finished.labels(job.name, job.status.value).inc()
+        self.store.finish(job, result, self.result_ttl)
+
+    def _work(self):
+        while True:
+            try:
+                item = self.store.dequeue(1.0)
+                if item is not None:
+                    self._run(*item)
+            except Exception:
+                logging.exception("Job worker failed")
+                time.sleep(1.0)
+
+
+def _create_store(store: str) -> JobStore:
+    if store == "memory":
+        return MemoryJobStore()
+    elif store == "sqlite":
+        return SQLiteJobStore(str(get_cache_path("jobs.db")))
+    elif store == "redis":
+        return RedisJobStore(
+            Redis(
+                host=os.getenv("REDIS_HOST", "localhost"),
+                port=int(os.getenv("REDIS_PORT", "6379")),
+            )
+        )
+    raise ValueError(f"Unknown job store: {store}")
+
+
+@cache
+def get_job_manager() -> JobManager:
+    config = settings["global"].get("jobs", {})
+    return JobManager(
+        _create_store(config.get("store", "memory")),
+        workers=config.get("workers", 2),
+        result_ttl=config.get("result_ttl", 3600),
+    )
+
+
+def init(configurator: "Configurator"):
+    configurator.register("Jobs", "Status and results of background jobs.")
+
+    def get_job_or_404(job_id: str) -> Job:
+        job = get_job_manager().store.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Unknown job.")
+        return job
+
+    @configurator.get("/v1/jobs/{job_id}")
+    def get_job(job_id: str) -> Job:
+        return get_job_or_404(job_id)
+
+    @configurator.get("/v1/jobs/{job_id}/result")
+    def get_job_result(job_id: str):
+        job = get_job_or_404(job_id)
+        if job.status == JobStatus.failed:
+            # The job failed, not this request
+            raise HTTPException(status_code=409, detail=f"Job failed: {job.error}")
+        if job.status != JobStatus.done:
+            raise HTTPException(status_code=409, detail=f"Job is {job.status.value}.")
+        return Response(
+            content=get_job_manager().store.get_result(job_id) or b"",
+            media_type=job.media_type,
+        )
@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+import weakref
+from functools import cache, lru_cache
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+from langchain_openai import ChatOpenAI
+from prometheus_client import Counter, Histogram
+
+from ..config import settings
+from ..utils import on_loop_shutdown
+
+client_requests = Counter(
+    "llm_client_requests",
+    "Requests to LLM upstreams, by whether they opened a new connection or reused a pooled one.",
+    ["host", "connection"],
+)
+client_handshakes = Counter(
+    "llm_client_tls_handshakes",
+    "TLS handshakes with LLM upstreams.",
+    ["host"],
+)
+client_connect_time = Histogram(
+    "llm_client_connect_seconds",
+    "Time to open a new connection to an LLM upstream, including TLS.",
+    ["host"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+def _trace(host: str, state: dict, name: str):
+    if name == "connection.connect_tcp.started":
+        state["connecting"] = time.perf_counter()
+    elif name == "connection.start_tls.complete":
+        client_handshakes.labels(host).inc()
+    elif name.endswith(".send_request_headers.started"):
+        if "connecting" in state:
+            client_requests.labels(host, "new").inc()
+            client_connect_time.labels(host).observe(
+                time.perf_counter() - state["connecting"]
+            )
+        else:
+            client_requests.labels(host, "reused").inc()
+
+
+def _limits() -> httpx.Limits:
+    config = settings["global"].get("llm_clients", {})
+    return httpx.Limits(
+        max_connections=config.get("max_connections", 100),
+        max_keepalive_connections=config.get("max_keepalive_connections", 20),
+        keepalive_expiry=config.get("keepalive_expiry", 60),
+    )
+
+
+def _host(base_url: str) -> str:
+    url = urlsplit(base_url)
+    return f"{url.scheme}://{url.netloc}"
+
+
+@cache
+def get_http_client(host: str) -> httpx.Client:
+    """
+    The keep-alive connection pool of an upstream host, shared by all its models.
+    """
+
+    def on_request(request: httpx.Request):
+        state = {}
+        request.extensions["trace"] = lambda name, info: _trace(host, state, name)
+
+    return httpx.Client(limits=_limits(), event_hooks={"request": [on_request]})
+
+
+def _new_async_http_client(host: str) -> httpx.AsyncClient:
+    async def on_request(request: httpx.Request):
+        state = {}
+
+        async def trace(name: str, info: dict):
+            _trace(host, state, name)
+
+        request.extensions["trace"] = trace
+
+    return httpx.AsyncClient(limits=_limits(), event_hooks={"request": [on_request]})
+
+
+class LoopAsyncClient(httpx.AsyncClient):
+    """
+    Pooled connections belong to the event loop which opened them, this sends each request with the pool of the running
+    loop instead. Loops started by `asyncio.run`, e.g., in jobs, get their own pool, closed once the loop shuts down.
+    """
+
+    def __init__(self, host: str):
+        super().__init__(limits=_limits())
+        self.host = host
+        self.lock = threading.Lock()
+        self.clients: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, httpx.AsyncClient
+        ] = weakref.WeakKeyDictionary()
+
+    def get_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self.clients.get(loop)
+            if client is None:
+                client = self.clients[loop] = _new_async_http_client(self.host)
+                on_loop_shutdown(self.aclose)
+        return client
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return await self.get_client().send(request, **kwargs)
+
+    async def aclose(self):
+        with self.lock:
+            client = self.clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+@cache
+def get_async_http_client(host: str) -> httpx.AsyncClient:
+    """
+    Same as get_http_client, for async calls, with one pool per event loop.
+    """
+    return LoopAsyncClient(host)
+
+
+@lru_cache(maxsize=256)
+def _get_chat_model(
+    base_url: str,
+    model: str,
+    api_key: Optional[str],
+    stop: tuple[str, ...],
+    params: tuple[tuple[str, object], ...],
+) -> ChatOpenAI:
+    host = _host(base_url)
+    return ChatOpenAI(
+        base_url=base_url,
+        model=model,
+        api_key=api_key,
+        stop_sequences=list(stop) or None,
+        http_client=get_http_client(host),
+        http_async_client=get_async_http_client(host),
+        include_response_headers=True,
+        **dict(params),
+    )
+
+
+def get_chat_model(
+    base_url: str,
+    model: str,
+    api_key: Optional[str],
+    stop: Optional[list[str]] = None,
+    **params,
+) -> ChatOpenAI:
+    """
+    A shared chat model for the given upstream, model, and sampling parameters, using the host's connection pool.
+    """
+    return _get_chat_model(
+        base_url, model, api_key, tuple(stop or ()), tuple(sorted(params.items()))
+    )
@@ -1,24 +1,69 @@
+import logging
 import os
+import queue
 import re
 import sqlite3
+import sys
 import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from functools import cache
 from pathlib import Path
 from typing import Optional
 
+import aiosqlite
+from langchain_core.embeddings import Embeddings
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import Runnable, RunnableConfig
-from langchain_openai import ChatOpenAI
+from prometheus_client import Counter, Gauge, Histogram
 
-from ..llm.ratelimit import rate_limited_call
+from ..llm import memory_recall as recall
+from ..llm.clients import get_chat_model
+from ..llm.memory_cache import CachedSession
+from ..llm.memory_store import get_memory_store, release_memory_store
+from ..llm.ratelimit import arate_limited_call, rate_limited_call
 from ..llm.types import Message, Role
 from ..utils import get_cache_path
 
-
-@dataclass
+# Levels are summarized once above this multiple of characters_per_level
+COMPRESSION_THRESHOLD = 1.5
+
+compaction_queue_depth = Gauge(
+    "memory_compaction_queue_depth",
+    "Sessions waiting for their memory to be compacted.",
+    multiprocess_mode="livesum",
+)
+compaction_lag = Histogram(
+    "memory_compaction_lag_seconds",
+    "Time from a session needing compaction until it was compacted.",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+compactions = Counter(
+    "memory_compactions",
+    "Background memory compactions, by result.",
+    ["result"],
+)
+idle_compactions = Counter(
+    "memory_idle_compactions",
+    "Idle sessions visited by the idle compactor, by result.",
+    ["result"],
+)
+idle_compaction_calls = Counter(
+    "memory_idle_compaction_calls",
+    "Summarization calls spent by the idle compactor.",
+)
+compactions_deduplicated = Counter(
+    "memory_compactions_deduplicated",
+    "Compactions skipped because another was in flight for the same session and level, or already replaced the memories.",
+    ["reason"],
+)
+
+
+@dataclass(slots=True)
 class Memory:
     id: int
     session_id: str
@@ -58,11 +103,11 @@ def _get_compression_chain(model: str):
                 ("human", "{messages}"),
             ]
         )
-        | ChatOpenAI(
+        | get_chat_model(
             base_url=os.environ.get("LITELLM_URL", "https://llm.conczin.net"),
             model=model,
             api_key=os.environ.get("LITELLM_API_KEY"),
-            max_retries=3,
+            max_retries=0,
             temperature=0,
             max_tokens=200,
         )
@@ -117,6 +162,148 @@ def _verify_conversation(conversation: list[Message]):
             raise ValueError("All messages must have a name.")
 
 
+INSERT_QUERY = """
+INSERT INTO memory (session_id, name, time, content, level)
+VALUES (?, ?, ?, ?, ?)
+"""
+
+# Summaries cover older memories, on equal time they come first
+FETCH_QUERY = """
+SELECT * FROM memory
+WHERE session_id = ?
+ORDER BY time, level DESC, ROWID
+"""
+
+
+def _to_rows(memories: list[Memory]) -> list[tuple]:
+    return [
+        (memory.session_id, memory.name, memory.time, memory.content, memory.level)
+        for memory in memories
+    ]
+
+
+def _set_ids(memories: list[Memory], last_id: int):
+    # Writes are serialized, thus the ids of one statement are consecutive
+    for i, memory in enumerate(memories):
+        memory.id = last_id - len(memories) + 1 + i
+
+
+def _from_rows(rows: list[tuple]) -> list[Memory]:
+    # Names repeat a lot, share them
+    return [
+        Memory(id, sys.intern(session), sys.intern(name), time, content, level)
+        for id, session, name, time, content, level in rows
+    ]
+
+
+def _unpack(input_dict: dict) -> tuple[str, list[Message]]:
+    assert isinstance(input_dict, dict), "Input must be a dictionary."
+    assert "session_id" in input_dict, "Session ID not found in input dict."
+    assert "conversation" in input_dict, "Conversation not found in input dict."
+    return input_dict["session_id"], input_dict["conversation"]
+
+
+def _insert_memories(conn: sqlite3.Connection, memories: list[Memory]):
+    conn.executemany(INSERT_QUERY, _to_rows(memories))
+    _set_ids(memories, conn.execute("SELECT last_insert_rowid()").fetchone()[0])
+
+
+async def _ainsert_memories(conn: aiosqlite.Connection, memories: list[Memory]):
+    await conn.executemany(INSERT_QUERY, _to_rows(memories))
+    async with conn.execute("SELECT last_insert_rowid()") as cursor:
+        _set_ids(memories, (await cursor.fetchone())[0])
+
+
+def _by_session(memories: list[Memory]) -> dict[str, list[Memory]]:
+    sessions = defaultdict(list)
+    for memory in memories:
+        sessions[memory.session_id].append(memory)
+    return sessions
+
+
+def _delete_query(memories: list[Memory]) -> str:
+    ids = [memory.id for memory in memories if memory.id >= 0]
+    return f"DELETE FROM memory WHERE id IN ({', '.join(map(str, ids))})"
+
+
+def _delete_memories(conn: sqlite3.Connection, memories: list[Memory]):
+    conn.execute(_delete_query(memories))
+
+
+class MemoryCompactor:
+    """
+    Compacts the memory of sessions on a background thread, so that summarization does not delay the request.
+    """
+
+    def __init__(self, manager: "MemoryManager"):
+        self.manager = manager
+        self.queue: queue.Queue[Optional[tuple[str, float]]] = queue.Queue()
+
+        # Sessions waiting in the queue, submitted again on every turn until compacted
+        self.lock = threading.Lock()
+        self.pending: set[str] = set()
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._work, name="memory-compactor", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, session_id: str):
+        with self.lock:
+            if session_id in self.pending or self.stopped.is_set():
+                return
+            self.pending.add(session_id)
+        compaction_queue_depth.inc()
+        self.queue.put((session_id, time.time()))
+
+    def join(self):
+        """
+        Wait until all submitted sessions are compacted.
+        """
+        self.queue.join()
+
+    def stop(self):
+        """
+        Stop once the session being compacted is done, the others are left for their next turn.
+        """
+        self.stopped.set()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _work(self):
+        while not self.stopped.is_set():
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                continue
+            session_id, submitted = item
+            compaction_queue_depth.dec()
+
+            # Turns from now on see the memory as compacted, or submit it again
+            with self.lock:
+                self.pending.discard(session_id)
+            try:
+                # The memory may have changed since, fetch it again
+                self.manager.compress_memory(self.manager.fetch_memories(session_id))
+                compactions.labels("done").inc()
+            except Exception:
+                logging.exception(f"Compacting memory of {session_id} failed")
+                compactions.labels("failed").inc()
+            finally:
+                compaction_lag.observe(time.time() - submitted)
+                self.queue.task_done()
+
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                compaction_queue_depth.dec()
+            self.queue.task_done()
+
+
 class MemoryManager(Runnable):
     """
     A manager class that stores conversations in an SQLite database.
@@ -128,66 +315,75 @@ class MemoryManager(Runnable):
         characters_per_level: int = 700,
         sentences_per_summary: int = 3,
         model: str = "mistral/mistral-medium",
+        background_compaction: bool = True,
+        shards: int = 1,
+        embedding: Optional[Embeddings] = None,
+        recall_k: int = 8,
+        recall_characters: int = 2000,
+        query_prefix: str = "",
     ):
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
-        self.lock = threading.Lock()
+        """
+        :param embedding: Enables recall mode, the prompt only contains the recent memories, and up to recall_k older ones
+        relevant to the conversation, within recall_characters.
+        """
+        self.store = get_memory_store(db_file, shards)
 
-        self.create_table()
+        self.embedding = embedding
+        self.recall_k = recall_k
+        self.recall_characters = recall_characters
+        self.query_prefix = query_prefix
 
         self.characters_per_level = characters_per_level
         self.sentences_per_summary = sentences_per_summary
 
         self.chain = _get_compression_chain(model)
 
+        # Summarize on a background thread instead of within the request
+        self.compactor = MemoryCompactor(self) if background_compaction else None
+
     def invoke(
         self, input_dict: dict, config: Optional[RunnableConfig] = None, **kwargs
     ) -> list[BaseMessage]:
-        assert isinstance(input_dict, dict), "Input must be a dictionary."
-        assert "session_id" in input_dict, "Session ID not found in input dict."
-        assert "conversation" in input_dict, "Conversation not found in input dict."
+        return self.add_fetch_compress(*_unpack(input_dict))
 
-        return self.add_fetch_compress(
-            input_dict["session_id"], input_dict["conversation"]
-        )
+    async def ainvoke(
+        self, input_dict: dict, config: Optional[RunnableConfig] = None, **kwargs
+    ) -> list[BaseMessage]:
+        return await self.aadd_fetch_compress(*_unpack(input_dict))
 
-    def create_table(self):
+    def add_memory(self, memory: Memory):
         """
-        Create the memory table if it doesn't exist.
+        Add a memory to the database, and set its id.
         """
-        with self.lock:
-            query = """
-            CREATE TABLE IF NOT EXISTS memory (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT NOT NULL,
-                name TEXT NOT NULL,
-                time INTEGER NOT NULL,
-                content TEXT NOT NULL,
-                level INTEGER DEFAULT 0
-            )
-            """
-            self.conn.execute(query)
-            self.conn.commit()
+        self.add_memories([memory])
 
-    def add_memory(self, memory: Memory):
+    def add_memories(self, memories: list[Memory]):
         """
-        Add a memory to the database.
+        Add memories to the database in a single transaction, and set their ids.
         """
-        with self.lock:
-            query = """
-            INSERT INTO memory (session_id, name, time, content, level)
-            VALUES (?, ?, ?, ?, ?)
-            """
-            self.conn.execute(
-                query,
-                (
-                    memory.session_id,
-                    memory.name,
-                    memory.time,
-                    memory.content,
-                    memory.level,
-                ),
-            )
-            self.conn.commit()
+        for store, partition in self.store.partition(memories).items():
+            vectors = self._embed(partition)
+            with store.write() as conn:
+                _insert_memories(conn, partition)
+                if vectors is not None:
+                    recall.insert_embeddings(conn, partition, vectors)
+
+            for session_id, added in _by_session(partition).items():
+                store.sessions.update(session_id, [], added)
+
+    async def aadd_memories(self, memories: list[Memory]):
+        """
+        Add memories to the database in a single transaction, and set their ids.
+        """
+        for store, partition in self.store.partition(memories).items():
+            vectors = await self._aembed(partition)
+            async with store.awrite() as conn:
+                await _ainsert_memories(conn, partition)
+                if vectors is not None:
+                    await recall.ainsert_embeddings(conn, partition, vectors)
+
+            for session_id, added in _by_session(partition).items():
+                store.sessions.update(session_id, [], added)
 
     def _split_buffer(self, buffer: list[Memory]) -> tuple[list[Memory], list[Memory]]:
         """
@@ -201,71 +397,188 @@ class MemoryManager(Runnable):
             count += len(memory.content)
         return buffer[:split_index], buffer[split_index:]
 
-    def _compress_buffer(self, count: int, buffer: list[Memory]) -> list[Memory]:
+    def _needs_compression(
+        self, count: int, buffer: list[Memory], threshold: float = COMPRESSION_THRESHOLD
+    ) -> bool:
+        return count > self.characters_per_level * threshold and len(buffer) >= 3
+
+    @staticmethod
+    def _is_stale(memories: list[Memory], session: CachedSession) -> bool:
+        ids = {memory.id for memory in session.memories}
+        if all(memory.id in ids for memory in memories):
+            return False
+        compactions_deduplicated.labels("stale").inc()
+        return True
+
+    def _compress_buffer(
+        self, count: int, buffer: list[Memory], threshold: float = COMPRESSION_THRESHOLD
+    ) -> list[Memory]:
         # Threshold reached, summarize
-        if count > self.characters_per_level * 1.5 and len(buffer) >= 3:
+        if self._needs_compression(count, buffer, threshold):
             to_be_summarized, too_recent = self._split_buffer(buffer)
-            summarized_memory = self._summarize(to_be_summarized)
-            self.remove_memories(to_be_summarized)
-            self.add_memory(summarized_memory)
+            session_id = buffer[0].session_id
+
+            # Concurrent requests keep their view of the memory instead of summarizing the same rows again
+            with self.store.shard(session_id).compaction(
+                session_id, buffer[0].level
+            ) as owner:
+                if not owner:
+                    compactions_deduplicated.labels("in_flight").inc()
+                    return buffer
+                if self._is_stale(to_be_summarized, self._fetch_session(session_id)):
+                    return buffer
+
+                summarized_memory = self._summarize(to_be_summarized)
+                self.replace_memories(to_be_summarized, summarized_memory)
             return [summarized_memory] + too_recent
         else:
             return buffer
 
-    def compress_memory(self, memories: list[Memory]) -> list[Memory]:
+    async def _acompress_buffer(self, count: int, buffer: list[Memory]) -> list[Memory]:
+        if self._needs_compression(count, buffer):
+            to_be_summarized, too_recent = self._split_buffer(buffer)
+            session_id = buffer[0].session_id
+
+            with self.store.shard(session_id).compaction(
+                session_id, buffer[0].level
+            ) as owner:
+                if not owner:
+                    compactions_deduplicated.labels("in_flight").inc()
+                    return buffer
+                if self._is_stale(
+                    to_be_summarized, await self._afetch_session(session_id)
+                ):
+                    return buffer
+
+                summarized_memory = await self._asummarize(to_be_summarized)
+                await self.areplace_memories(to_be_summarized, summarized_memory)
+            return [summarized_memory] + too_recent
+        else:
+            return buffer
+
+    def replace_memories(self, memories: list[Memory], summary: Memory):
         """
-        Compress memories by summarizing the first n tokens on each level.
+        Replace memories with their summary in a single transaction, and set the summary's id.
         """
+        store = self.store.shard(summary.session_id)
+        vectors = self._embed([summary])
+        with store.write() as conn:
+            _delete_memories(conn, memories)
+            _insert_memories(conn, [summary])
+            if vectors is not None:
+                recall.insert_embeddings(conn, [summary], vectors)
+
+        store.sessions.update(
+            summary.session_id, [memory.id for memory in memories], [summary]
+        )
 
-        compressed_memories = []
+    async def areplace_memories(self, memories: list[Memory], summary: Memory):
+        """
+        Replace memories with their summary in a single transaction, and set the summary's id.
+        """
+        store = self.store.shard(summary.session_id)
+        vectors = await self._aembed([summary])
+        async with store.awrite() as conn:
+            await conn.execute(_delete_query(memories))
+            await _ainsert_memories(conn, [summary])
+            if vectors is not None:
+                await recall.ainsert_embeddings(conn, [summary], vectors)
+
+        store.sessions.update(
+            summary.session_id, [memory.id for memory in memories], [summary]
+        )
+
+    @staticmethod
+    def _split_levels(memories: list[Memory]) -> list[tuple[int, list[Memory]]]:
+        """
+        Split memories into runs of non-decreasing level, with their character count.
+        """
+        buffers = []
 
         count = 0
         last_level = 0
-        to_be_summarized = []
+        buffer = []
         for memory in memories:
             if memory.level < last_level:
-                compressed_memories.extend(
-                    self._compress_buffer(count, to_be_summarized)
-                )
+                buffers.append((count, buffer))
 
                 # Reset and start the next compression level
                 count = 0
-                to_be_summarized = []
+                buffer = []
 
             count += len(memory.content)
-            to_be_summarized.append(memory)
+            buffer.append(memory)
             last_level = memory.level
 
-        compressed_memories.extend(self._compress_buffer(count, to_be_summarized))
+        buffers.append((count, buffer))
 
+        return buffers
+
+    def compress_memory(
+        self, memories: list[Memory], threshold: float = COMPRESSION_THRESHOLD
+    ) -> list[Memory]:
+        """
+        Compress memories by summarizing the first n tokens on each level.
+        :param threshold: Multiple of characters_per_level a level has to exceed to be summarized.
+        """
+        compressed_memories = []
+        for count, buffer in self._split_levels(memories):
+            compressed_memories.extend(self._compress_buffer(count, buffer, threshold))
         return compressed_memories
 
+    async def acompress_memory(self, memories: list[Memory]) -> list[Memory]:
+        compressed_memories = []
+        for count, buffer in self._split_levels(memories):
+            compressed_memories.extend(await self._acompress_buffer(count, buffer))
+        return compressed_memories
+
+    def needs_compression(
+        self, memories: list[Memory], threshold: float = COMPRESSION_THRESHOLD
+    ) -> bool:
+        return any(
+            self._needs_compression(count, buffer, threshold)
+            for count, buffer in self._split_levels(memories)
+        )
+
     def fetch_memories(self, session_id: str) -> list[Memory]:
         """
         Fetch memories from a given session (usually the NPCs unique id).
         """
-        query = """
-        SELECT * FROM memory
-        WHERE session_id = ?
-        ORDER BY time, ROWID
-        """
-        cursor = self.conn.execute(query, (session_id,))
-        rows = cursor.fetchall()
-        memories = [Memory(*row) for row in rows]
-        return memories
+        return list(self._fetch_session(session_id).memories)
 
-    def _summarize(self, memories: list[Memory]) -> Memory:
-        """
-        Summarize memories into fewer memories.
-        """
+    async def afetch_memories(self, session_id: str) -> list[Memory]:
+        return list((await self._afetch_session(session_id)).memories)
+
+    def _fetch_session(self, session_id: str) -> CachedSession:
+        store = self.store.shard(session_id)
+        session = store.sessions.get(session_id)
+        if session is not None:
+            return session
+
+        generation = store.sessions.generation
+        rows = store.read().execute(FETCH_QUERY, (session_id,)).fetchall()
+        return store.sessions.fill(session_id, _from_rows(rows), generation)
+
+    async def _afetch_session(self, session_id: str) -> CachedSession:
+        store = self.store.shard(session_id)
+        session = store.sessions.get(session_id)
+        if session is not None:
+            return session
+
+        generation = store.sessions.generation
+        conn = await store.aread()
+        rows = await conn.execute_fetchall(FETCH_QUERY, (session_id,))
+        return store.sessions.fill(session_id, _from_rows(rows), generation)
+
+    def _summary_prompt(self, memories: list[Memory]) -> dict:
         messages = [f"{memory.name}: {memory.content}" for memory in memories]
-        summary = rate_limited_call(
-            self.chain,
-            {
-                "messages": "\n".join(messages),
-                "sentences": self.sentences_per_summary,
-            },
-        )
+        return {
+            "messages": "\n".join(messages),
+            "sentences": self.sentences_per_summary,
+        }
+
+    @staticmethod
+    def _to_summary(memories: list[Memory], summary: str) -> Memory:
         return Memory(
             -1,
             memories[0].session_id,
@@ -275,33 +588,35 @@ class MemoryManager(Runnable):
             memories[0].level + 1,
         )
 
-    def add_fetch_compress(
-        self, session_id: str, conversation: list[Message]
-    ) -> list[BaseMessage]:
-        _verify_conversation(conversation)
+    def _summarize(self, memories: list[Memory]) -> Memory:
+        """
+        Summarize memories into fewer memories.
+        """
+        summary = rate_limited_call(self.chain, self._summary_prompt(memories))
+        return self._to_summary(memories, summary)
 
-        # fetch memories
-        memories = self.fetch_memories(session_id)
+    async def _asummarize(self, memories: list[Memory]) -> Memory:
+        summary = await arate_limited_call(self.chain, self._summary_prompt(memories))
+        return self._to_summary(memories, summary)
+
+    @staticmethod
+    def _untracked(
+        session: CachedSession, session_id: str, conversation: list[Message]
+    ) -> list[Memory]:
+        """
+        The messages after the last one already in memory, as new memories.
+        """
+        _verify_conversation(conversation)
 
         # find the first tracked message
-        index = -1
-        any_matched = False
+        tracked = session.tracked
         for index, message in enumerate(conversation[::-1]):
-            if any(
-                memory.level == 0
-                and memory.name == message.name
-                and memory.content == message.content
-                for memory in memories
-            ):
-                any_matched = True
+            if (message.name, message.content) in tracked:
+                conversation = [] if index == 0 else conversation[-index:]
                 break
 
-        if any_matched:
-            conversation = [] if index == 0 else conversation[-index:]
-
-        # add memories
-        for message in conversation:
-            memory = Memory(
+        return [
+            Memory(
                 id=-1,
                 session_id=session_id,
                 name=str(message.name),
@@ -309,35 +624,297 @@ class MemoryManager(Runnable):
                 content=message.content,
                 level=0,
             )
-            self.add_memory(memory)
-            memories.append(memory)
+            for message in conversation
+        ]
 
-        # compress memories
-        compressed_memories = self.compress_memory(memories)
+    def add_fetch_compress(
+        self, session_id: str, conversation: list[Message]
+    ) -> list[BaseMessage]:
+        # fetch memories
+        session = self._fetch_session(session_id)
+        memories = list(session.memories)
+
+        # add memories, all in one transaction
+        new_memories = self._untracked(session, session_id, conversation)
+        self.add_memories(new_memories)
+        memories.extend(new_memories)
+
+        # compress memories, or let the compactor do it after the request
+        if self.compactor is None:
+            memories = self.compress_memory(memories)
+        elif self.needs_compression(memories):
+            self.compactor.submit(session_id)
+
+        if self.embedding is not None:
+            memories = self._recall(session_id, memories, conversation)
 
-        return _to_conversation(compressed_memories)
+        return _to_conversation(memories)
 
-    def prune(self):
+    async def aadd_fetch_compress(
+        self, session_id: str, conversation: list[Message]
+    ) -> list[BaseMessage]:
         """
-        Prune conversations older than a year.
+        Same as add_fetch_compress, without blocking the event loop or a worker thread.
         """
-        with self.lock:
-            query = "DELETE FROM memory WHERE 1"
-            self.conn.execute(query)
-            self.conn.commit()
+        session = await self._afetch_session(session_id)
+        memories = list(session.memories)
+
+        new_memories = self._untracked(session, session_id, conversation)
+        await self.aadd_memories(new_memories)
+        memories.extend(new_memories)
+
+        if self.compactor is None:
+            memories = await self.acompress_memory(memories)
+        elif self.needs_compression(memories):
+            self.compactor.submit(session_id)
+
+        if self.embedding is not None:
+            memories = await self._arecall(session_id, memories, conversation)
+
+        return _to_conversation(memories)
+
+    def _embed(self, memories: list[Memory]) -> Optional[list[list[float]]]:
+        if self.embedding is None or not memories:
+            return None
+        return self.embedding.embed_documents([m.content for m in memories])
+
+    async def _aembed(self, memories: list[Memory]) -> Optional[list[list[float]]]:
+        if self.embedding is None or not memories:
+            return None
+        return await self.embedding.aembed_documents([m.content for m in memories])
+
+    def _recall(
+        self, session_id: str, memories: list[Memory], conversation: list[Message]
+    ) -> list[Memory]:
+        """
+        The recent memories, and the older ones most relevant to the conversation, within the recall budget.
+        """
+        older, recent = recall.split_recent(memories, self.recall_characters // 2)
+        if older:
+            store = self.store.shard(session_id)
+            rows = store.read().execute(recall.FETCH_QUERY, (session_id,)).fetchall()
+            vectors = recall.from_rows(rows)
+
+            # Memories written before recall was enabled
+            missing = [m for m in older if m.id not in vectors]
+            if missing:
+                embedded = self._embed(missing)
+                with store.write() as conn:
+                    recall.insert_embeddings(conn, missing, embedded)
+                vectors.update(zip([m.id for m in missing], embedded))
+
+            query = self.embedding.embed_query(
+                self.query_prefix + recall.query_text(conversation)
+            )
+            older = self._select(older, recent, vectors, query)
+        return self._observe(older + recent)
+
+    async def _arecall(
+        self, session_id: str, memories: list[Memory], conversation: list[Message]
+    ) -> list[Memory]:
+        older, recent = recall.split_recent(memories, self.recall_characters // 2)
+        if older:
+            store = self.store.shard(session_id)
+            conn = await store.aread()
+            rows = await conn.execute_fetchall(recall.FETCH_QUERY, (session_id,))
+            vectors = recall.from_rows(rows)
+
+            missing = [m for m in older if m.id not in vectors]
+            if missing:
+                embedded = await self._aembed(missing)
+                async with store.awrite() as conn:
+                    await recall.ainsert_embeddings(conn, missing, embedded)
+                vectors.update(zip([m.id for m in missing], embedded))
+
+            query = await self.embedding.aembed_query(
+                self.query_prefix + recall.query_text(conversation)
+            )
+            older = self._select(older, recent, vectors, query)
+        return self._observe(older + recent)
+
+    def _select(
+        self,
+        older: list[Memory],
+        recent: list[Memory],
+        vectors: dict,
+        query: list[float],
+    ) -> list[Memory]:
+        budget = self.recall_characters - sum(len(m.content) for m in recent)
+        return recall.select(older, vectors, query, self.recall_k, budget)
+
+    @staticmethod
+    def _observe(memories: list[Memory]) -> list[Memory]:
+        recall.recalled_characters.observe(sum(len(m.content) for m in memories))
+        return memories
+
+    def prune(self, retention_days: float = 365):
+        """
+        Prune conversations idle for longer than the retention, a year by default.
+        """
+        cutoff = int((time.time() - retention_days * 86400) * 1000)
+        self.store.prune(cutoff)
 
     def close(self):
         """
-        Close the database connection.
+        Stop the compactor and release the store, its connections are closed once no other manager uses it.
+        """
+        if self.compactor is not None:
+            self.compactor.stop()
+        release_memory_store(self.store)
+
+    async def aclose(self):
+        """
+        Close the async database connections, e.g., before their event loop ends. They reopen on their next use.
         """
-        self.conn.close()
+        await self.store.aclose()
 
     def remove_memories(self, memories: list[Memory]):
         """
         Remove memories from the database.
         """
+        for store, partition in self.store.partition(memories).items():
+            with store.write() as conn:
+                _delete_memories(conn, partition)
+
+            for session_id, removed in _by_session(partition).items():
+                store.sessions.update(session_id, [m.id for m in removed], [])
+
+
+class IdleCompactor:
+    """
+    Compacts sessions idle for a while whose uncompressed tail is above the threshold, during off-peak hours, so that
+    their next request finds them compacted already.
+    """
+
+    def __init__(
+        self,
+        manager: MemoryManager,
+        idle_minutes: float = 30,
+        hours: Optional[list[int]] = None,
+        interval: float = 900,
+        batch_size: int = 100,
+        concurrency: int = 4,
+        calls_per_minute: float = 60,
+        dry_run: bool = False,
+        threshold: float = 1.0,
+        session_glob: str = "*",
+    ):
+        """
+        :param hours: Local hours to run in, all by default.
+        :param calls_per_minute: Upper bound on summarization calls, leaves room for live traffic upstream.
+        :param dry_run: Only count and log the sessions which would be compacted.
+        :param threshold: Multiple of characters_per_level above which tails are compacted, below the one requests use.
+        :param session_glob: Restricts to the sessions of the manager's character, as their settings are used.
+        """
+        self.manager = manager
+        self.idle_minutes = idle_minutes
+        self.hours = hours
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.calls_per_minute = calls_per_minute
+        self.dry_run = dry_run
+        self.threshold = threshold
+        self.session_glob = session_glob
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.started = 0.0
+
+    def start(self):
+        threading.Thread(
+            target=self._work, name="memory-idle-compactor", daemon=True
+        ).start()
+
+    def _work(self):
+        while True:
+            time.sleep(self.interval)
+            if self.hours and datetime.now().hour not in self.hours:
+                continue
+            try:
+                sessions, calls = self.run()
+                if sessions:
+                    logging.info(
+                        f"{'Would compact' if self.dry_run else 'Compacted'} {sessions} idle sessions with {calls} calls."
+                    )
+            except Exception:
+                logging.exception("Compacting idle memories failed")
+
+    def find(self, store, after: str, cutoff: int) -> list[str]:
+        """
+        A batch of idle sessions above the threshold, ordered by id and starting after the given one.
+        """
+        return [
+            row[0]
+            for row in store.read().execute(
+                """
+                SELECT session_id FROM memory
+                WHERE session_id > ? AND session_id GLOB ?
+                GROUP BY session_id
+                HAVING MAX(time) < ?
+                    AND SUM(CASE WHEN level = 0 THEN LENGTH(content) ELSE 0 END) > ?
+                    AND SUM(level = 0) >= 3
+                ORDER BY session_id
+                LIMIT ?
+                """,
+                (
+                    after,
+                    self.session_glob,
+                    cutoff,
+                    self.manager.characters_per_level * self.threshold,
+                    self.batch_size,
+                ),
+            )
+        ]
+
+    def run(self) -> tuple[int, int]:
+        """
+        One pass over all idle sessions, returns the number of sessions compacted and calls spent.
+        """
+        cutoff = int((time.time() - self.idle_minutes * 60) * 1000)
+        self.calls = 0
+        self.started = time.monotonic()
+
+        compacted = 0
+        with ThreadPoolExecutor(self.concurrency, "memory-idle-compactor") as executor:
+            for store in self.manager.store.shards:
+                after = ""
+                while session_ids := self.find(store, after, cutoff):
+                    compacted += sum(executor.map(self._compact, session_ids))
+                    after = session_ids[-1]
+        return compacted, self.calls
+
+    def _compact(self, session_id: str) -> bool:
+        memories = self.manager.fetch_memories(session_id)
+        if not self.manager.needs_compression(memories, self.threshold):
+            idle_compactions.labels("skipped").inc()
+            return False
+        if self.dry_run:
+            idle_compactions.labels("dry_run").inc()
+            return True
+
+        self._pace()
+        try:
+            compressed = self.manager.compress_memory(memories, self.threshold)
+        except Exception:
+            logging.exception(f"Compacting idle memory of {session_id} failed")
+            idle_compactions.labels("failed").inc()
+            return False
+
+        # Each new summary took one call
+        ids = {memory.id for memory in memories}
+        calls = sum(memory.id not in ids for memory in compressed)
         with self.lock:
-            ids = [memory.id for memory in memories if memory.id >= 0]
-            query = f"DELETE FROM memory WHERE id IN ({', '.join(map(str, ids))})"
-            self.conn.execute(query)
-            self.conn.commit()
+            self.calls += calls
+        idle_compaction_calls.inc(calls)
+        idle_compactions.labels("compacted" if calls else "skipped").inc()
+        return calls > 0
+
+    def _pace(self):
+        # Spread the calls of a pass to stay below the budget
+        with self.lock:
+            ahead = self.calls / self.calls_per_minute * 60 - (
+                time.monotonic() - self.started
+            )
+        if ahead > 0:
+            time.sleep(ahead)
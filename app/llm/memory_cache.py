@@ -0,0 +1,157 @@
+import sys
+import threading
+from collections import Counter as Multiset
+from typing import TYPE_CHECKING, Iterable, Optional
+
+from cachetools import LRUCache
+from prometheus_client import Counter, Gauge
+
+if TYPE_CHECKING:
+    from .memory import Memory
+
+cache_requests = Counter(
+    "memory_cache_requests",
+    "Session memory lookups, by result.",
+    ["result"],
+)
+cache_bytes = Gauge(
+    "memory_cache_bytes",
+    "Approximate size of the cached session memories.",
+    multiprocess_mode="livesum",
+)
+
+# Approximate size of a slotted memory and its list entry, excluding the content
+MEMORY_OVERHEAD = 120
+
+# Sessions whose latest write is remembered, beyond that all fills in progress are rejected once
+MAX_WRITTEN_SESSIONS = 100000
+
+
+def _sizeof(memories: tuple["Memory", ...]) -> int:
+    return sum(MEMORY_OVERHEAD + sys.getsizeof(m.content) for m in memories)
+
+
+def _keys(memories: Iterable["Memory"]) -> Iterable[tuple[str, str]]:
+    return ((m.name, m.content) for m in memories if m.level == 0)
+
+
+class CachedSession:
+    """
+    The memories of a session, and an index of its level 0 messages built on first use, then carried over by writes.
+    """
+
+    __slots__ = ("memories", "size", "_tracked")
+
+    def __init__(
+        self,
+        memories: tuple["Memory", ...],
+        tracked: Optional[Multiset[tuple[str, str]]] = None,
+    ):
+        self.memories = memories
+        self.size = _sizeof(memories)
+        self._tracked = tracked
+
+    @property
+    def tracked(self) -> Multiset[tuple[str, str]]:
+        """
+        The (name, content) of all level 0 memories, with their number of occurrences.
+        """
+        if self._tracked is None:
+            self._tracked = Multiset(_keys(self.memories))
+        return self._tracked
+
+    def updated(self, removed: set[int], added: list["Memory"]) -> "CachedSession":
+        """
+        The session after a write, updating the index with only the written memories.
+        The index moves to the new session, readers still holding this one see the write too.
+        """
+        memories = [m for m in self.memories if m.id not in removed]
+        tracked = self._tracked
+        if tracked is not None:
+            tracked.update(_keys(added))
+            for key in _keys(m for m in self.memories if m.id in removed):
+                tracked[key] -= 1
+                if tracked[key] <= 0:
+                    del tracked[key]
+        return CachedSession(tuple(sorted(memories + added, key=_order)), tracked)
+
+
+def _order(memory: "Memory") -> tuple[int, int, int]:
+    # Same order as the database query
+    return memory.time, -memory.level, memory.id
+
+
+class SessionCache:
+    """
+    An LRU cache of the memories of recently active sessions, limited by their approximate size in bytes.
+    Writers update it after committing, readers only fill it when no write to that session happened in between.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.lock = threading.Lock()
+
+        # Bumped by every write, the generation of each session's latest write, and before which all are rejected
+        self.generation = 0
+        self.written: dict[str, int] = {}
+        self.floor = 0
+
+        self.sessions: LRUCache[str, CachedSession] = LRUCache(
+            maxsize=max_bytes, getsizeof=lambda session: session.size
+        )
+
+    def get(self, session_id: str) -> Optional[CachedSession]:
+        with self.lock:
+            session = self.sessions.get(session_id)
+        cache_requests.labels("miss" if session is None else "hit").inc()
+        return session
+
+    def fill(
+        self, session_id: str, memories: list["Memory"], generation: int
+    ) -> CachedSession:
+        """
+        Cache the memories of a session, read from the database after the given generation.
+        """
+        session = CachedSession(tuple(memories))
+        with self.lock:
+            if generation >= max(self.floor, self.written.get(session_id, 0)):
+                self._set(session_id, session)
+        return session
+
+    def update(
+        self, session_id: str, removed: Iterable[int], added: Iterable["Memory"]
+    ):
+        """
+        Apply a committed write to a cached session.
+        """
+        with self.lock:
+            self._written(session_id)
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self._set(session_id, session.updated(set(removed), list(added)))
+
+    def discard(self, session_id: str):
+        with self.lock:
+            self._written(session_id)
+            self.sessions.pop(session_id, None)
+            cache_bytes.set(self.sessions.currsize)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.floor = self.generation
+            self.written.clear()
+            self.sessions.clear()
+            cache_bytes.set(0)
+
+    def _written(self, session_id: str):
+        self.generation += 1
+        self.written[session_id] = self.generation
+        if len(self.written) > MAX_WRITTEN_SESSIONS:
+            self.floor = self.generation
+            self.written.clear()
+
+    def _set(self, session_id: str, session: CachedSession):
+        self.sessions.pop(session_id, None)
+        if session.size <= self.sessions.maxsize:
+            self.sessions[session_id] = session
+        cache_bytes.set(self.sessions.currsize)
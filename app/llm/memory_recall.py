@@ -0,0 +1,101 @@
+import sqlite3
+from typing import TYPE_CHECKING
+
+import aiosqlite
+import numpy as np
+from prometheus_client import Histogram
+
+if TYPE_CHECKING:
+    from .memory import Memory
+
+recalled_characters = Histogram(
+    "memory_recalled_characters",
+    "Characters of memory put into the prompt in recall mode.",
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+
+# Memories may be gone by the time they are embedded, skip those
+INSERT_QUERY = """
+INSERT OR REPLACE INTO memory_embedding (memory_id, session_id, embedding)
+SELECT id, session_id, ? FROM memory WHERE id = ?
+"""
+
+FETCH_QUERY = "SELECT memory_id, embedding FROM memory_embedding WHERE session_id = ?"
+
+
+def _to_rows(memories: list["Memory"], vectors: list[list[float]]) -> list[tuple]:
+    return [
+        (np.asarray(vector, dtype=np.float32).tobytes(), memory.id)
+        for memory, vector in zip(memories, vectors)
+    ]
+
+
+def from_rows(rows: list[tuple]) -> dict[int, np.ndarray]:
+    return {id: np.frombuffer(blob, dtype=np.float32) for id, blob in rows}
+
+
+def insert_embeddings(
+    conn: sqlite3.Connection, memories: list["Memory"], vectors: list[list[float]]
+):
+    conn.executemany(INSERT_QUERY, _to_rows(memories, vectors))
+
+
+async def ainsert_embeddings(
+    conn: aiosqlite.Connection, memories: list["Memory"], vectors: list[list[float]]
+):
+    await conn.executemany(INSERT_QUERY, _to_rows(memories, vectors))
+
+
+def split_recent(
+    memories: list["Memory"], characters: int
+) -> tuple[list["Memory"], list["Memory"]]:
+    """
+    Split off the most recent memories fitting into the budget, at least the last one.
+    """
+    used = 0
+    index = len(memories)
+    while index > 0:
+        size = len(memories[index - 1].content)
+        if index < len(memories) and used + size > characters:
+            break
+        used += size
+        index -= 1
+    return memories[:index], memories[index:]
+
+
+def select(
+    memories: list["Memory"],
+    vectors: dict[int, np.ndarray],
+    query: list[float],
+    k: int,
+    characters: int,
+) -> list["Memory"]:
+    """
+    The k memories most similar to the query which fit into the budget, in their original order.
+    """
+    candidates = [memory for memory in memories if memory.id in vectors]
+    if not candidates:
+        return []
+
+    matrix = np.stack([vectors[memory.id] for memory in candidates])
+    query_vector = np.asarray(query, dtype=np.float32)
+    scores = matrix @ query_vector
+    scores /= np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vector) + 1e-9
+
+    chosen = set()
+    used = 0
+    for index in np.argsort(-scores):
+        memory = candidates[index]
+        if len(chosen) >= k:
+            break
+        if used + len(memory.content) <= characters:
+            chosen.add(memory.id)
+            used += len(memory.content)
+    return [memory for memory in memories if memory.id in chosen]
+
+
+def query_text(messages: list, messages_count: int = 2) -> str:
+    """
+    The latest messages of the conversation, what the next answer will be about.
+    """
+    return "\n".join(str(message.content) for message in messages[-messages_count:])
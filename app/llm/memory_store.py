@@ -0,0 +1,538 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, Iterator, Optional, Union
+
+import aiosqlite
+from prometheus_client import Counter, Gauge
+
+from ..utils import on_loop_shutdown
+from .memory_cache import SessionCache
+
+if TYPE_CHECKING:
+    from .memory import Memory
+
+pruned_sessions = Counter(
+    "memory_pruned_sessions",
+    "Idle sessions removed from the memory database.",
+)
+pruned_rows = Counter(
+    "memory_pruned_rows",
+    "Memories removed from the memory database by retention.",
+)
+reclaimed_bytes = Counter(
+    "memory_reclaimed_bytes",
+    "Bytes returned to the file system by incremental vacuum.",
+)
+database_bytes = Gauge(
+    "memory_database_bytes",
+    "Size of the memory database.",
+    multiprocess_mode="max",
+)
+
+# Each migration moves the schema one version up, never edit or reorder applied ones
+MIGRATIONS = [
+    # 1: Initial schema
+    """
+    CREATE TABLE IF NOT EXISTS memory (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        time INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        level INTEGER DEFAULT 0
+    )
+    """,
+    # 2: Sessions were full table scans
+    "CREATE INDEX IF NOT EXISTS memory_session ON memory (session_id, level, time)",
+    # 3: Let pruning shrink the file, existing databases only once rewritten offline by `vacuum_database`
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    # 4: Embeddings for recall mode, removed along with their memory
+    """
+    CREATE TABLE IF NOT EXISTS memory_embedding (
+        memory_id INTEGER PRIMARY KEY,
+        session_id TEXT NOT NULL,
+        embedding BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS memory_embedding_session ON memory_embedding (session_id);
+    CREATE TRIGGER IF NOT EXISTS memory_embedding_delete AFTER DELETE ON memory
+    BEGIN
+        DELETE FROM memory_embedding WHERE memory_id = old.id;
+    END;
+    """,
+]
+
+
+class _AsyncConnections:
+    """
+    The aiosqlite connections of one event loop, opened on first use.
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.reader: Optional[aiosqlite.Connection] = None
+        self.writer: Optional[aiosqlite.Connection] = None
+
+
+class MemoryStore:
+    """
+    The SQLite database behind the memory manager.
+    Writes are serialized on one connection, reads use one connection per thread and, thanks to WAL, do not wait for
+    writes. Coroutines get their own aiosqlite connections instead, one pair per event loop, closed along with it.
+    SQLite serializes their writes with the others.
+    Recently active sessions are cached, writers have to keep that cache up to date.
+    """
+
+    def __init__(self, db_file: Union[str, Path], cache_bytes: int = 64 * 1024 * 1024):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.readers: dict[threading.Thread, sqlite3.Connection] = {}
+        self.sessions = SessionCache(cache_bytes)
+
+        # Sessions and levels currently being compacted
+        self.compaction_lock = threading.Lock()
+        self.compacting: set[tuple[str, int]] = set()
+
+        self.loops_lock = threading.Lock()
+        self.loops: dict[asyncio.AbstractEventLoop, _AsyncConnections] = {}
+
+        self.conn = self._connect()
+        # Only takes effect on new databases, before their first table is created
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.migrate()
+
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            logging.warning(
+                f"{db_file} does not release pruned space, run `python -m scripts.vacuum_memory` with the server stopped."
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, timeout=30)
+        # Durable enough with WAL, a crash may only lose the latest transactions
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    async def _aconnect(self) -> aiosqlite.Connection:
+        conn = aiosqlite.connect(self.db_file, timeout=30)
+        # Its thread must not keep the process alive
+        conn.daemon = True
+        await conn
+        await conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    @property
+    def version(self) -> int:
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        """
+        Bring the schema up to date.
+        """
+        with self.lock:
+            for version in range(self.version, len(MIGRATIONS)):
+                with self.conn:
+                    self.conn.executescript(MIGRATIONS[version])
+                    self.conn.execute(f"PRAGMA user_version = {version + 1}")
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        """
+        The write connection, everything within is committed as one transaction, or rolled back on error.
+        """
+        with self.lock, self.conn:
+            yield self.conn
+
+    def read(self) -> sqlite3.Connection:
+        """
+        The read connection of the current thread.
+        """
+        thread = threading.current_thread()
+        conn = self.readers.get(thread)
+        if conn is None:
+            with self.lock:
+                # Worker threads come and go, drop the connections of finished ones
+                for finished in [t for t in self.readers if not t.is_alive()]:
+                    self.readers.pop(finished).close()
+
+                conn = self.readers[thread] = self._connect()
+        return conn
+
+    def _async_connections(self) -> _AsyncConnections:
+        """
+        The async connections of the running loop.
+        """
+        loop = asyncio.get_running_loop()
+        with self.loops_lock:
+            connections = self.loops.get(loop)
+            if connections is None:
+                # Loops closed without shutting down never closed theirs
+                for closed in [other for other in self.loops if other.is_closed()]:
+                    del self.loops[closed]
+
+                connections = self.loops[loop] = _AsyncConnections()
+                on_loop_shutdown(self.aclose)
+        return connections
+
+    @asynccontextmanager
+    async def awrite(self) -> AsyncIterator[aiosqlite.Connection]:
+        """
+        The async write connection, everything within is committed as one transaction, or rolled back on error.
+        """
+        connections = self._async_connections()
+        async with connections.lock:
+            if connections.writer is None:
+                connections.writer = await self._aconnect()
+            try:
+                yield connections.writer
+            except BaseException:
+                await connections.writer.rollback()
+                raise
+            await connections.writer.commit()
+
+    async def aread(self) -> aiosqlite.Connection:
+        """
+        The async read connection, shared by all coroutines of the running loop.
+        """
+        connections = self._async_connections()
+        if connections.reader is None:
+            conn = await self._aconnect()
+            if connections.reader is None:
+                connections.reader = conn
+            else:
+                await conn.close()
+        return connections.reader
+
+    @contextmanager
+    def compaction(self, session_id: str, level: int) -> Iterator[bool]:
+        """
+        Single-flight for compacting one level of a session, yields whether the caller got it.
+        Never blocks, thus also usable from coroutines.
+        """
+        key = (session_id, level)
+        with self.compaction_lock:
+            owner = key not in self.compacting
+            self.compacting.add(key)
+        try:
+            yield owner
+        finally:
+            if owner:
+                with self.compaction_lock:
+                    self.compacting.discard(key)
+
+    def shard(self, session_id: str) -> "MemoryStore":
+        """
+        The store holding a session, always this one.
+        """
+        return self
+
+    @property
+    def shards(self) -> list["MemoryStore"]:
+        return [self]
+
+    def partition(
+        self, memories: list["Memory"]
+    ) -> dict["MemoryStore", list["Memory"]]:
+        """
+        Group memories by the store holding their session.
+        """
+        return {self: memories} if memories else {}
+
+    def prune(self, cutoff: int, batch_size: int = 100) -> tuple[int, int, int]:
+        """
+        Remove sessions without memories newer than cutoff (in ms), one batch of sessions per transaction.
+        Returns the number of sessions, rows, and bytes reclaimed.
+        """
+        sessions = rows = reclaimed = 0
+        while True:
+            # Find candidates without holding the write lock
+            session_ids = [
+                row[0]
+                for row in self.read().execute(
+                    "SELECT session_id FROM memory GROUP BY session_id HAVING MAX(time) < ? LIMIT ?",
+                    (cutoff, batch_size),
+                )
+            ]
+            if not session_ids:
+                break
+
+            # Sessions may have become active again in the meantime
+            placeholders = ", ".join("?" * len(session_ids))
+            with self.write() as conn:
+                rows += conn.execute(
+                    f"""
+                    DELETE FROM memory WHERE session_id IN (
+                        SELECT session_id FROM memory
+                        WHERE session_id IN ({placeholders})
+                        GROUP BY session_id HAVING MAX(time) < ?
+                    )
+                    """,
+                    (*session_ids, cutoff),
+                ).rowcount
+            for session_id in session_ids:
+                self.sessions.discard(session_id)
+            sessions += len(session_ids)
+
+            reclaimed += self.vacuum()
+
+            if len(session_ids) < batch_size:
+                break
+
+        # Shrinking the file only happens once the WAL is checkpointed
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            database_bytes.set(self.size)
+
+        pruned_sessions.inc(sessions)
+        pruned_rows.inc(rows)
+        reclaimed_bytes.inc(reclaimed)
+        return sessions, rows, reclaimed
+
+    def vacuum(self) -> int:
+        """
+        Release free pages to the file system, returns the number of bytes released.
+        """
+        with self.lock:
+            page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+            free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+            self.conn.execute("PRAGMA incremental_vacuum").fetchall()
+            free_pages -= self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return free_pages * page_size
+
+    @property
+    def size(self) -> int:
+        return _size(self.conn)
+
+    def close(self):
+        with self.lock:
+            for conn in self.readers.values():
+                conn.close()
+            self.readers.clear()
+            self.conn.close()
+
+    async def aclose(self):
+        """
+        Close the async connections of the running loop, done anyway once it shuts down.
+        """
+        with self.loops_lock:
+            connections = self.loops.pop(asyncio.get_running_loop(), None)
+        if connections is None:
+            return
+        async with connections.lock:
+            for conn in [connections.reader, connections.writer]:
+                if conn is not None:
+                    await conn.close()
+
+
+def _size(conn: sqlite3.Connection) -> int:
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+
+
+def vacuum_database(db_file: Union[str, Path]) -> tuple[int, int]:
+    """
+    Rewrite a database so that pruning releases space from then on, returns its size before and after.
+    Takes a while and blocks all writers on large databases, run it offline.
+    """
+    conn = sqlite3.connect(db_file)
+    try:
+        before = _size(conn)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return before, _size(conn)
+    finally:
+        conn.close()
+
+
+def get_shard_files(db_file: Union[str, Path], shards: int) -> list[Path]:
+    """
+    The files of a sharded database, memory.db becomes memory.0.db, memory.1.db, ...
+    """
+    db_file = Path(db_file)
+    return [
+        db_file.with_name(f"{db_file.stem}.{i}{db_file.suffix}") for i in range(shards)
+    ]
+
+
+class ShardedMemoryStore:
+    """
+    Spreads sessions over several SQLite files by a stable hash of their id, each with its own write lock, connections,
+    and cache. Writes to different shards no longer wait for each other.
+    """
+
+    def __init__(
+        self,
+        db_file: Union[str, Path],
+        shards: int,
+        cache_bytes: int = 64 * 1024 * 1024,
+    ):
+        # Sessions would silently move to another shard
+        files = get_shard_files(db_file, shards)
+        existing = set(Path(db_file).parent.glob(files[0].name.replace(".0.", ".*.")))
+        if existing and existing != set(files):
+            raise ValueError(
+                f"Found {len(existing)} shards of {db_file}, but configured {shards}, migrate them first."
+            )
+
+        self.shards = [MemoryStore(f, cache_bytes // shards) for f in files]
+
+    def shard(self, session_id: str) -> MemoryStore:
+        """
+        The store holding a session.
+        """
+        return self.shards[zlib.crc32(session_id.encode()) % len(self.shards)]
+
+    def partition(self, memories: list["Memory"]) -> dict[MemoryStore, list["Memory"]]:
+        """
+        Group memories by the store holding their session.
+        """
+        partitions = {}
+        for memory in memories:
+            partitions.setdefault(self.shard(memory.session_id), []).append(memory)
+        return partitions
+
+    def prune(self, cutoff: int, batch_size: int = 100) -> tuple[int, int, int]:
+        """
+        Prune each shard, returns the total number of sessions, rows, and bytes reclaimed.
+        """
+        totals = [shard.prune(cutoff, batch_size) for shard in self.shards]
+        database_bytes.set(self.size)
+        return tuple(sum(t) for t in zip(*totals))
+
+    @property
+    def size(self) -> int:
+        return sum(shard.size for shard in self.shards)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    async def aclose(self):
+        for shard in self.shards:
+            await shard.aclose()
+
+
+def shard_database(
+    db_file: Union[str, Path], shards: int, batch_size: int = 10000
+) -> int:
+    """
+    Copy a single memory database into new shards, keeping the ids, returns the number of memories copied.
+    The source is only read, and not migrated.
+    """
+    if shards < 2:
+        raise ValueError("Sharding needs at least two shards.")
+    if any(f.exists() for f in get_shard_files(db_file, shards)):
+        raise ValueError(f"Shards of {db_file} exist already.")
+
+    source = sqlite3.connect(f"{Path(db_file).absolute().as_uri()}?mode=ro", uri=True)
+    tables = {
+        row[0]
+        for row in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    }
+    target = ShardedMemoryStore(db_file, shards)
+    copied = 0
+    try:
+        # The session id is the second column of both tables
+        for table, columns in [
+            ("memory", "id, session_id, name, time, content, level"),
+            ("memory_embedding", "memory_id, session_id, embedding"),
+        ]:
+            # Databases from before recall mode have no embeddings
+            if table not in tables:
+                continue
+            placeholders = ", ".join("?" * len(columns.split(", ")))
+            cursor = source.execute(f"SELECT {columns} FROM {table}")
+            while rows := cursor.fetchmany(batch_size):
+                partitions = {}
+                for row in rows:
+                    partitions.setdefault(target.shard(row[1]), []).append(row)
+                for shard, partition in partitions.items():
+                    with shard.write() as conn:
+                        conn.executemany(
+                            f"INSERT INTO {table} ({columns}) VALUES ({placeholders})",
+                            partition,
+                        )
+                if table == "memory":
+                    copied += len(rows)
+    finally:
+        source.close()
+        target.close()
+    return copied
+
+
+# Open stores by database file and shards, with the number of their users
+_stores: dict[tuple[str, int], Union[MemoryStore, ShardedMemoryStore]] = {}
+_store_users: dict[tuple[str, int], int] = {}
+_stores_lock = threading.Lock()
+
+
+def get_memory_store(
+    db_file: Union[str, Path], shards: int = 1
+) -> Union[MemoryStore, ShardedMemoryStore]:
+    """
+    The store of a database file, shared so that all managers see the same cache.
+    With more than one shard, sessions are spread over several files next to it.
+    Users which are done with it release it with `release_memory_store`.
+    """
+    key = (str(Path(db_file).absolute()), shards)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = (
+                ShardedMemoryStore(db_file, shards)
+                if shards > 1
+                else MemoryStore(db_file)
+            )
+            _store_users[key] = 0
+        _store_users[key] += 1
+        return _stores[key]
+
+
+def release_memory_store(store: Union[MemoryStore, ShardedMemoryStore]):
+    """
+    Release a store from `get_memory_store`, it is closed once its last user released it.
+    """
+    with _stores_lock:
+        key = next((k for k, s in _stores.items() if s is store), None)
+        if key is not None:
+            _store_users[key] -= 1
+            if _store_users[key] > 0:
+                return
+            del _stores[key], _store_users[key]
+    store.close()
+
+
+class MemoryPruner:
+    """
+    Periodically removes sessions idle for longer than the retention.
+    """
+
+    def __init__(
+        self,
+        store: Union[MemoryStore, ShardedMemoryStore],
+        retention_days: float = 365,
+        interval: float = 3600,
+        batch_size: int = 100,
+    ):
+        self.store = store
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch_size = batch_size
+        threading.Thread(target=self._work, name="memory-pruner", daemon=True).start()
+
+    def _work(self):
+        while True:
+            try:
+                cutoff = int((time.time() - self.retention_days * 86400) * 1000)
+                sessions, rows, reclaimed = self.store.prune(cutoff, self.batch_size)
+                if sessions:
+                    logging.info(
+                        f"Pruned {sessions} idle sessions with {rows} memories, reclaimed {reclaimed} bytes."
+                    )
+            except Exception:
+                logging.exception("Pruning memories failed")
+            time.sleep(self.interval)
@@ -1,27 +1,349 @@
+import asyncio
 import logging
+import random
+import threading
 import time
+from email.utils import parsedate_to_datetime
+from functools import cache
+from typing import Mapping, Optional
+from urllib.parse import urlsplit
 
+import httpx
+import openai
 from httpx import HTTPStatusError
-from langchain_core.runnables import RunnableSerializable
+from langchain_core.runnables import (
+    RunnableBinding,
+    RunnableSequence,
+    RunnableSerializable,
+)
 from langchain_core.runnables.utils import Input, Output
+from prometheus_client import Counter, Histogram
+
+from ..config import settings
+
+rate_limited = Counter(
+    "llm_rate_limited",
+    "Requests rejected by an LLM upstream with 429.",
+    ["provider", "model"],
+)
+upstream_errors = Counter(
+    "llm_upstream_errors",
+    "Retryable LLM upstream failures besides rate limits.",
+    ["provider", "model"],
+)
+circuit_opened = Counter(
+    "llm_circuit_opened",
+    "Times the circuit of an LLM upstream opened after repeated failures.",
+    ["provider", "model"],
+)
+limiter_wait = Histogram(
+    "llm_rate_limit_wait_seconds",
+    "Time requests waited for the shared budget of their upstream.",
+    ["provider"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def _number(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parse durations like "1s", "6m0s", "250ms", or plain seconds.
+    """
+    if value is None:
+        return None
+    seconds = _number(value)
+    if seconds is not None:
+        return seconds
+
+    total = 0.0
+    number = ""
+    i = 0
+    while i < len(value):
+        if value[i].isdigit() or value[i] == ".":
+            number += value[i]
+        elif value.startswith("ms", i):
+            total += float(number or 0) / 1000
+            number = ""
+            i += 1
+        elif value[i] in "hms":
+            total += float(number or 0) * {"h": 3600, "m": 60, "s": 1}[value[i]]
+            number = ""
+        else:
+            return None
+        i += 1
+    return total
+
+
+def _retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    milliseconds = _number(headers.get("retry-after-ms"))
+    if milliseconds is not None:
+        return milliseconds / 1000
+
+    value = headers.get("retry-after")
+    seconds = _number(value)
+    if seconds is not None or value is None:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamLimiter:
+    """
+    The shared client-side budget of one upstream model. A token bucket, unlimited until the upstream's rate limit
+    headers tell otherwise, and a circuit breaker which fails fast after repeated failures.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        model: str,
+        failure_threshold: int = 5,
+        cooldown: float = 10,
+        max_cooldown: float = 300,
+        backoff: float = 0.5,
+        max_backoff: float = 30,
+    ):
+        self.provider = provider
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+
+        # Requests per second, and the bucket
+        self.rate: Optional[float] = None
+        self.capacity = 1.0
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+        # Circuit breaker
+        self.failures = 0
+        self.cooldown = cooldown
+        self.open_until = 0.0
+        self.probing = False
+
+    def acquire(self) -> tuple[float, bool]:
+        """
+        Take a request from the budget, returns how long to wait before sending it, and whether it probes the circuit.
+        """
+        with self.lock:
+            now = time.monotonic()
+            probe = self.failures >= self.failure_threshold
+            if probe:
+                # Once cooled down, a single request probes whether the upstream recovered
+                if now < self.open_until or self.probing:
+                    raise CircuitOpenError(
+                        f"{self.provider}/{self.model} is failing, retry later."
+                    )
+                self.probing = True
+
+            wait = 0.0
+            if now < self.paused_until:
+                # Spread those waiting, so they do not all retry at once
+                wait = (self.paused_until - now) * random.uniform(1, 1.25)
+
+            if self.rate is not None:
+                elapsed = now - self.updated
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+
+        limiter_wait.labels(self.provider).observe(wait)
+        return wait, probe
+
+    def abandon(self):
+        """
+        Release the probe of a request which ended without an outcome, e.g., cancelled, so another can probe.
+        """
+        with self.lock:
+            self.probing = False
+
+    def learn(self, headers: Mapping[str, str]):
+        """
+        Adjust the budget to the rate limit headers of a response.
+        """
+        limit = _number(headers.get("x-ratelimit-limit-requests"))
+        remaining = _number(headers.get("x-ratelimit-remaining-requests"))
+        reset = _duration(headers.get("x-ratelimit-reset-requests"))
+        with self.lock:
+            if limit:
+                # Limits are usually per minute
+                self.capacity = limit
+                self.rate = limit / 60
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+                if remaining <= 0 and reset:
+                    self.paused_until = max(self.paused_until, time.monotonic() + reset)
+
+    def succeeded(self, headers: Optional[Mapping[str, str]] = None):
+        with self.lock:
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+            self.probing = False
+        if headers:
+            self.learn(headers)
+
+    def failed(self, error: Exception, attempt: int) -> Optional[float]:
+        """
+        Record a failed request, returns the delay before retrying, or None if it should not be retried.
+        """
+        response = getattr(error, "response", None)
+        status = response.status_code if isinstance(response, httpx.Response) else None
+        headers = response.headers if status is not None else {}
+
+        if status == 429:
+            rate_limited.labels(self.provider, self.model).inc()
+        elif (status is not None and status >= 500) or isinstance(
+            error, (openai.APIConnectionError, httpx.TransportError)
+        ):
+            upstream_errors.labels(self.provider, self.model).inc()
+        else:
+            # The request failed, which says nothing about the upstream
+            return None
+
+        if isinstance(error, (openai.APITimeoutError, httpx.TimeoutException)):
+            # Counts against the circuit, but retrying a request which already waited for the full timeout is not
+            # worth it
+            with self.lock:
+                self._failure(time.monotonic())
+            return None
+
+        # Honor Retry-After, else back off exponentially, both jittered
+        retry_after = _retry_after(headers)
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, retry_after * 0.25 + 0.05)
+        else:
+            delay = min(self.max_backoff, self.backoff * 2**attempt)
+            delay *= random.uniform(0.5, 1)
+
+        # Learn first, the announced limit is what the rate limit is halved from
+        if headers:
+            self.learn(headers)
+
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + delay)
+            if status == 429 and self.rate is not None:
+                self.rate = max(self.rate / 2, 0.1)
+
+            self._failure(now)
+        return delay
+
+    def _failure(self, now: float):
+        """
+        Count a failure of the upstream, opening the circuit once there are too many. Call within the lock.
+        """
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.failure_threshold:
+            self.open_until = now + self.cooldown
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            circuit_opened.labels(self.provider, self.model).inc()
+            logging.warning(
+                f"Circuit of {self.provider}/{self.model} open for {self.open_until - now:.0f}s."
+            )
+
+
+@cache
+def get_limiter(provider: str, model: str) -> UpstreamLimiter:
+    return UpstreamLimiter(provider, model, **settings["global"].get("llm_limiter", {}))
+
+
+def _upstream(llm: RunnableSerializable) -> tuple[str, str]:
+    """
+    The provider host and model of the chat model within a runnable.
+    """
+    steps = llm.steps if isinstance(llm, RunnableSequence) else [llm]
+    for step in steps:
+        if isinstance(step, RunnableBinding):
+            step = step.bound
+        model = getattr(step, "model_name", None)
+        if model is not None:
+            base_url = getattr(step, "openai_api_base", None) or ""
+            return urlsplit(base_url).netloc or "default", model
+    return "default", "default"
+
+
+def _headers(output: Output) -> Optional[Mapping[str, str]]:
+    metadata = getattr(output, "response_metadata", None) or {}
+    return metadata.get("headers")
+
+
+def _error(error: Exception) -> Exception:
+    if isinstance(error, HTTPStatusError):
+        return RuntimeError(f"An error occurred: {error.response.text}")
+    return error
 
 
 def rate_limited_call(
     llm: RunnableSerializable, prompt: Input, retries: int = 10
 ) -> Output:
     """
-    Call the LLM with a timeout.
+    Call the LLM within the shared budget of its upstream, retrying rate limits and transient failures.
+    """
+    limiter = get_limiter(*_upstream(llm))
+    for attempt in range(retries):
+        wait, probe = limiter.acquire()
+        try:
+            time.sleep(wait)
+            output = llm.invoke(prompt)
+        except Exception as e:
+            delay = limiter.failed(e, attempt)
+            if delay is None:
+                raise _error(e) from e
+            logging.info(f"Upstream failed with {e}, retrying after {delay:.2f}s.")
+            time.sleep(delay)
+            continue
+        else:
+            limiter.succeeded(_headers(output))
+            return output
+        finally:
+            if probe:
+                limiter.abandon()
+    raise RuntimeError("Rate limit exceeded after multiple retries.")
+
+
+async def arate_limited_call(
+    llm: RunnableSerializable, prompt: Input, retries: int = 10
+) -> Output:
+    """
+    Same as rate_limited_call, waiting without blocking the event loop or a thread.
     """
-    for _ in range(retries):
+    limiter = get_limiter(*_upstream(llm))
+    for attempt in range(retries):
+        wait, probe = limiter.acquire()
         try:
-            return llm.invoke(prompt)
-        except HTTPStatusError as e:
-            if e.response.status_code == 429:
-                # Rate limit error, wait and retry
-                retry_after = float(e.response.headers.get("Retry-After", 0.25))
-                logging.info(f"Rate limit hit, retrying after {retry_after} seconds.")
-                time.sleep(retry_after)
-                continue
-            else:
-                raise RuntimeError(f"An error occurred: {e.response.text}")
+            await asyncio.sleep(wait)
+            output = await llm.ainvoke(prompt)
+        except Exception as e:
+            delay = limiter.failed(e, attempt)
+            if delay is None:
+                raise _error(e) from e
+            logging.info(f"Upstream failed with {e}, retrying after {delay:.2f}s.")
+            await asyncio.sleep(delay)
+            continue
+        else:
+            limiter.succeeded(_headers(output))
+            return output
+        finally:
+            if probe:
+                limiter.abandon()
     raise RuntimeError("Rate limit exceeded after multiple retries.")
@@ -64,4 +64,8 @@ class Character(BaseModel):
     memory_characters_per_level: int = 1000
     memory_sentences_per_summary: int = 3
     memory_model: str = "mistral/mistral-medium"
+    # Recall mode, only the recent memories and the most relevant older ones, keeps the prompt size flat
+    memory_recall: bool = False
+    memory_recall_k: int = 8
+    memory_recall_characters: int = 2000
     stop: list[str] = ["\n"]
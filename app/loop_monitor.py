@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from fastapi import Request, Response
+from prometheus_client import Counter, Histogram
+
+loop_lag = Histogram(
+    "event_loop_lag_seconds",
+    "Delay of a periodic event loop wakeup beyond its scheduled time.",
+    ["loop"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+loop_stalls = Counter(
+    "event_loop_stalls",
+    "Callbacks blocking the event loop longer than the threshold, by route.",
+    ["loop", "route"],
+)
+loop_stall_duration = Histogram(
+    "event_loop_stall_seconds",
+    "Time a callback blocked the event loop, by route.",
+    ["loop", "route"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+# Route of the tasks handling requests, read by the watchdog thread
+task_routes: "weakref.WeakKeyDictionary[asyncio.Task, str]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def wrap(
+    name: str, handler: Callable[[Request], Awaitable[Response]]
+) -> Callable[[Request], Awaitable[Response]]:
+    """
+    Attribute event loop stalls to the route of the request task.
+    """
+
+    async def tracked_handler(request: Request) -> Response:
+        task = asyncio.current_task()
+        if task is not None:
+            task_routes[task] = f"{request.method} {name}"
+        return await handler(request)
+
+    return tracked_handler
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag with a periodic wakeup, and captures the stack and route of callbacks blocking the loop
+    longer than slow_callback seconds from a watchdog thread, while they are still blocking.
+    """
+
+    def __init__(
+        self,
+        name: str = "main",
+        interval: float = 0.1,
+        slow_callback: float = 0.25,
+        keep: int = 50,
+    ):
+        self.name = name
+        self.interval = interval
+        self.slow_callback = slow_callback
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread_id: Optional[int] = None
+        self.heartbeat = time.perf_counter()
+
+        # The loop only keeps weak references to its tasks
+        self.task: Optional[asyncio.Task] = None
+        self.stopped = threading.Event()
+
+        # The stall currently blocking the loop, and the most recent ones
+        self.stall: Optional[dict] = None
+        self.stalls: deque[dict] = deque(maxlen=keep)
+
+    def start(self):
+        """
+        Start monitoring the running loop.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.heartbeat = time.perf_counter()
+        self.task = self.loop.create_task(self._sample())
+        threading.Thread(target=self._watch, name="loop-monitor", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _sample(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(0.0, now - self.heartbeat - self.interval)
+            self.heartbeat = now
+            loop_lag.labels(self.name).observe(lag)
+
+            stall, self.stall = self.stall, None
+            if stall is not None:
+                stall["duration"] = lag
+                loop_stall_duration.labels(self.name, stall["route"]).observe(lag)
+                logging.warning(
+                    f"Event loop blocked for {lag:.3f}s by {stall['route']}:\n{stall['stack']}"
+                )
+
+    def _watch(self):
+        while not self.stopped.wait(self.slow_callback / 2):
+            heartbeat = self.heartbeat
+            blocked = time.perf_counter() - heartbeat - self.interval
+            if blocked < self.slow_callback or self.stall is not None:
+                continue
+
+            frame = sys._current_frames().get(self.thread_id)
+            task = asyncio.current_task(self.loop)
+            route = task_routes.get(task, "unknown") if task is not None else "unknown"
+
+            # The loop recovered while capturing
+            if heartbeat != self.heartbeat:
+                continue
+
+            self.stall = {
+                "time": time.time(),
+                "route": route,
+                "duration": blocked,
+                "stack": "".join(traceback.format_stack(frame)) if frame else "",
+            }
+            self.stalls.append(self.stall)
+            loop_stalls.labels(self.name, route).inc()
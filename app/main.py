@@ -4,21 +4,28 @@ import logging
 import os
 import shutil
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
 from pathlib import Path
+from typing import Optional
 
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.openapi.utils import get_openapi
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.redis import RedisBackend
-from prometheus_client import CollectorRegistry, multiprocess
+from prometheus_client import CollectorRegistry, Gauge, multiprocess
 from prometheus_fastapi_instrumentator import Instrumentator
 from redis.asyncio.client import Redis
+from starlette.routing import BaseRoute
 
+from . import jobs, request_profiler, threadpool
+from .compression import CompressionMiddleware
 from .config import settings
-from .configurator import Configurator, tags_metadata
+from .configurator import Configurator, LazyModule, tags_metadata
+from .import_profiler import profile_imports
+from .loop_monitor import LoopMonitor
 
 load_dotenv()
 
@@ -41,8 +48,10 @@ if prom_dir is not None:
 app = FastAPI()
 
 
-# Enable GZip compression
-app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
+# Enable zstd or gzip compression
+app.add_middleware(
+    CompressionMiddleware, **dict(settings["global"].get("compression", {}))
+)
 
 
 # Allow CORS
@@ -58,32 +67,178 @@ app.add_middleware(
 instrumentator = Instrumentator().instrument(app)
 
 
-def start_module(name: str):
+module_import_seconds = Gauge(
+    "module_import_seconds",
+    "Time spent importing a module during startup.",
+    ["module"],
+    multiprocess_mode="max",
+)
+module_init_seconds = Gauge(
+    "module_init_seconds",
+    "Time spent in a module's init() during startup.",
+    ["module"],
+    multiprocess_mode="max",
+)
+module_import_breakdown_seconds = Gauge(
+    "module_import_breakdown_seconds",
+    "Self-time of imports done while starting a module, by top-level package.",
+    ["module", "package"],
+    multiprocess_mode="max",
+)
+
+
+def start_module(
+    name: str, target: FastAPI = app, tags: Optional[list[dict]] = None
+) -> tuple[float, float]:
+    """
+    Import and initialize a module, returns the seconds spent importing and initializing it.
+    :param target: The app the module registers its routes on.
+    :param tags: Collects the module's OpenAPI tags, by default the global `tags_metadata`.
+    """
     print(f"Initializing {name}app.")
 
-    start_import = time.time()
-    module = importlib.import_module(f"app.modules.{name}.{name}")
-    initializer = getattr(module, "init")
+    with profile_imports() as breakdown:
+        start_import = time.time()
+        module = importlib.import_module(f"app.modules.{name}.{name}")
+        initializer = getattr(module, "init")
 
-    start_init = time.time()
-    initializer(Configurator(app, settings[name]))
-    end = time.time()
+        start_init = time.time()
+        initializer(Configurator(target, settings[name], tags))
+        end = time.time()
+
+    module_import_seconds.labels(name).set(start_init - start_import)
+    module_init_seconds.labels(name).set(end - start_init)
+
+    # Only keep packages which matter to limit the cardinality
+    slowest = sorted(
+        [
+            (package, seconds)
+            for package, seconds in breakdown.items()
+            if seconds >= 0.01
+        ],
+        key=lambda t: -t[1],
+    )
+    for package, seconds in slowest:
+        module_import_breakdown_seconds.labels(name, package).set(seconds)
 
     print(
         f"Initialized {name} in {end - start_import:.2f}s ({end - start_init:.2f}s spent initializing)"
     )
+    if slowest:
+        print(
+            "  Slowest imports:",
+            ", ".join(f"{package} {seconds:.2f}s" for package, seconds in slowest[:5]),
+        )
 
+    return start_init - start_import, end - start_init
 
-def start_all_modules():
+
+def get_enabled_modules() -> dict[str, set[str]]:
+    """
+    Returns the enabled modules in the order of their config sections, mapped to the enabled modules they have to wait
+    for.
+    """
     modules_path = Path(__file__).parent / "modules"
-    for module in modules_path.iterdir():
-        if not module.is_dir():
-            continue
-        name = module.name
-        if name in settings and getattr(settings[name], "enable", False):
-            start_module(name)
-        else:
-            print("Skipping", name)
+    modules = {module.name for module in modules_path.iterdir() if module.is_dir()}
+
+    enabled = {}
+    for name in [section.lower() for section in settings.as_dict()]:
+        if name in modules and getattr(settings[name], "enable", False):
+            enabled[name] = set(getattr(settings[name], "after", []))
+    for name in sorted(modules - enabled.keys()):
+        print("Skipping", name)
+    return {name: after & enabled.keys() for name, after in enabled.items()}
+
+
+def stage_module(name: str) -> tuple[tuple[float, float], list[BaseRoute], list[dict]]:
+    """
+    Initialize a module on a staging app, returns its timings, routes and OpenAPI tags to be registered later.
+    Anything else would be lost, thus fails.
+    """
+    staging = FastAPI(openapi_url=None)
+    tags = []
+    timings = start_module(name, staging, tags)
+
+    defaults = FastAPI(openapi_url=None)
+    changed = [
+        what
+        for what, value, default in [
+            ("middleware", staging.user_middleware, defaults.user_middleware),
+            (
+                "exception handlers",
+                staging.exception_handlers,
+                defaults.exception_handlers,
+            ),
+            (
+                "event handlers",
+                staging.router.on_startup + staging.router.on_shutdown,
+                [],
+            ),
+            ("state", staging.state._state, {}),
+        ]
+        if value != default
+    ]
+    if changed:
+        raise ValueError(
+            f"{name} changed the {', '.join(changed)} of the app, only routes are supported, or start it lazily."
+        )
+    return timings, staging.router.routes, tags
+
+
+def start_all_modules():
+    """
+    Initialize all enabled modules concurrently.
+    A module may list other modules in its `after` config to be initialized after them.
+    Lazy modules are only initialized on the first request to one of their `prefixes`.
+    Routes and tags are registered in config order once all modules are initialized, regardless of which finished first.
+    """
+    pending = get_enabled_modules()
+    order = list(pending)
+    timings = {}
+    staged = {}
+
+    lazy = {name for name in pending if getattr(settings[name], "lazy", False)}
+    for name in lazy:
+        del pending[name]
+        LazyModule(app, list(settings[name].prefixes), partial(start_module, name))
+        print(f"Deferred {name} until first request.")
+    for name, after in pending.items():
+        if after & lazy:
+            raise ValueError(
+                f"{name} has to be initialized after {sorted(after & lazy)}, which are only initialized on request."
+            )
+
+    start = time.time()
+    with ThreadPoolExecutor(
+        max_workers=settings["global"].get("init_workers", 4),
+        thread_name_prefix="init",
+    ) as executor:
+        running = {}
+        while pending or running:
+            for name, after in list(pending.items()):
+                if after.issubset(timings):
+                    running[executor.submit(stage_module, name)] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Cyclic module dependencies: {sorted(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                timings[name], *staged[name] = future.result()
+
+    for name in order:
+        if name in staged:
+            routes, tags = staged[name]
+            app.router.routes.extend(routes)
+            tags_metadata.extend(tags)
+
+    print(f"Initialized {len(timings)} modules in {time.time() - start:.2f}s")
+    for name, (import_time, init_time) in sorted(
+        timings.items(), key=lambda t: -sum(t[1])
+    ):
+        print(f"  {name:<16} import {import_time:6.2f}s  init {init_time:6.2f}s")
 
 
 # Custom OpenAPI to fix the missing description
@@ -120,9 +275,19 @@ async def startup():
         prefix="api",
     )
 
+    # Threads shared by sync endpoints of modules without a dedicated pool
+    threadpool.set_default_size(settings["global"].get("threadpool_size", 40))
+
     instrumentator.expose(app)
+    jobs.init(Configurator(app, settings["global"].get("jobs", {})))
+    request_profiler.init(Configurator(app, settings["global"].get("profiler", {})))
     start_all_modules()
 
-    # Enable asyncio debugging
+    # Watch for callbacks blocking the event loop
+    loop_monitor_config = dict(settings["global"].get("loop_monitor", {}))
+    if loop_monitor_config.pop("enable", True):
+        LoopMonitor(**loop_monitor_config).start()
+
+    # Enable asyncio debugging, very noisy
     if settings["global"]["asyncio_debug"]:
         asyncio.get_event_loop().set_debug(True)
@@ -7,25 +7,14 @@ from urllib.parse import urlparse
 
 import requests
 from fastapi import Query
-from fastapi_cache import Coder
-from fastapi_cache.decorator import cache
 from PIL import Image, ImageDraw, ImageFont
 from starlette.responses import Response
 
 from app.configurator import Configurator
+from app.response_cache import ResponseCache
 from app.utils import get_data_path
 
 
-class BytesCoder(Coder):
-    @classmethod
-    def encode(cls, value: bytes) -> bytes:
-        return value
-
-    @classmethod
-    def decode(cls, value: bytes) -> bytes:
-        return value
-
-
 def encode_image(texture: Image.Image) -> bytes:
     buffer = io.BytesIO()
     texture.save(buffer, format="PNG")
@@ -169,13 +158,6 @@ def render_embed(
     return encode_image(img)
 
 
-@cache(expire=86400, coder=BytesCoder)
-async def cached_render_embed(
-    **kwargs,
-) -> bytes:
-    return await asyncio.to_thread(render_embed, **kwargs)
-
-
 def init(configurator: Configurator):
     configurator.register("Asset Generator", "Misc Assets for websites and co.")
 
@@ -183,6 +165,7 @@ def init(configurator: Configurator):
     @configurator.get(
         "/embed",
         responses={200: {"content": {"image/png": {}}}},
+        cache=ResponseCache(expire=86400),
     )
     async def get_embed(
         title: str = Query(
@@ -211,7 +194,8 @@ def init(configurator: Configurator):
         background_color: str = Query(default="555555", title="Background Color"),
     ) -> Response:
         try:
-            result = await cached_render_embed(
+            result = await asyncio.to_thread(
+                render_embed,
                 title=title,
                 description=description,
                 icon_url=icon_url,
@@ -58,7 +58,7 @@ def init(configurator: Configurator):
         "Hugging", "Endpoints mostly relying on HuggingFace or similar ML models."
     )
 
-    @configurator.get("/v1/tts/xtts-v2/model", deprecated=True)
+    @configurator.get("/v1/tts/xtts-v2/model", deprecated=True, limited=False)
     def get_tts_xtts_model():
         return {
             "speakers": get_speakers(),
@@ -66,6 +66,7 @@ def init(configurator: Configurator):
             "base_speakers": get_base_speakers(),
         }
 
+    @configurator.job("/v1/tts/xtts-v2/jobs", deprecated=True)
     @configurator.post("/v1/tts/xtts-v2", deprecated=True)
     def post_tts_xtts(
         text: str,
@@ -112,7 +113,7 @@ def init(configurator: Configurator):
 
         return Response(content=audio, media_type=f"audio/{file_format}")
 
-    @configurator.get("/v1/tts/piper/voices")
+    @configurator.get("/v1/tts/piper/voices", limited=False)
     async def get_tts_piper_voices(high_quality: bool = True):
         speakers = get_best_voices()
 
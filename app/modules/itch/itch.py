@@ -1,15 +1,14 @@
 import os
 
 import itchio
-from cachetools import TTLCache, cached
 
 from app.configurator import Configurator
+from app.response_cache import ResponseCache
 
 
 def init(configurator: Configurator):
     configurator.register("Itch", "Proxy for the Itch.io API to list projects.")
 
-    @cached(TTLCache(maxsize=1, ttl=86400))
     def get_games() -> list:
         apikey = os.getenv("ITCHIO_API_KEY")
         if apikey:
@@ -42,7 +41,7 @@ def init(configurator: Configurator):
 
         return games
 
-    @configurator.get("/v1/itchio")
+    @configurator.get("/v1/itchio", cache=ResponseCache(expire=86400))
     def get_itchio():
         return get_games()
 
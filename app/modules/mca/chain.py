@@ -1,29 +1,61 @@
+import asyncio
 import os
 import re
+import time
 from contextlib import contextmanager
 from functools import cache
+from typing import Awaitable, Callable, Optional, TypeVar
 
 import requests
 from cachetools import TTLCache, cached
 from dotenv import load_dotenv
 from langchain_core.messages import AIMessage, BaseMessage, SystemMessage
-from langchain_openai import ChatOpenAI
+from prometheus_client import Histogram
 
 from app.config import settings
+from app.llm.clients import get_chat_model
 from app.llm.glossary_manager import GlossaryManager
 from app.llm.memory import MemoryManager, clean_conversation
-from app.llm.ratelimit import rate_limited_call
+from app.llm.ratelimit import arate_limited_call
 from app.llm.types import Character, GlossarySearch, Message, Model, Role
 from app.llm.vector_compressor import VectorCompressor
 from app.rag.git_document_manager import GitDocumentManager
 from app.rag.wiki_document_manager import WikiDocumentManager
+from app.shared_models import ADDITIONAL_QUERY_PROMPTS, get_sentence_embeddings
+from app.threadpool import default_pool
+
+from .openai_utils import check_prompt_openai
 
 load_dotenv()
 
+T = TypeVar("T")
+
+stage_time = Histogram(
+    "mca_stage_seconds",
+    "Time spent in each stage of a chat completion.",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
 
 @cache
-def get_memory_manager(**kwargs):
-    return MemoryManager(**kwargs)
+def get_memory_manager(recall: bool = False, **kwargs):
+    if recall:
+        embedding = get_sentence_embeddings()
+        kwargs["embedding"] = embedding
+        kwargs["query_prefix"] = ADDITIONAL_QUERY_PROMPTS.get(embedding.name, "")
+    return MemoryManager(shards=settings["mca"].get("memory_shards", 1), **kwargs)
+
+
+def get_character_memory_manager(character: Character) -> MemoryManager:
+    return get_memory_manager(
+        characters_per_level=character.memory_characters_per_level,
+        sentences_per_summary=character.memory_sentences_per_summary,
+        model=character.memory_model,
+        recall=character.memory_recall,
+        recall_k=character.memory_recall_k,
+        recall_characters=character.memory_recall_characters,
+    )
 
 
 @cache
@@ -125,128 +157,169 @@ def get_models():
     ]
 
 
-def get_chat_completion(
-    model: Model,
-    character: Character,
-    messages: list[Message],
-    tools: list[dict],
-    auth_token: str,
-) -> AIMessage:
-    # Preload
+def preload():
     get_glossary_manager()
     get_vector_compressor()
 
-    # Instantiate model
-    if model.provider == "horde":
-        # A model with `llama-3-instruct` format is added to have consistent results
-        # TODO: Filter by template
-        models = ["koboldcpp/L3-8B-Stheno-v3.2"] + get_models()
-
-        if len(models) == 1:
-            raise ValueError("No models available.")
-
-        llm = ChatOpenAI(
-            base_url="https://api.conczin.net/v1",
-            model=",".join(models),
-            api_key=os.environ.get("HORDE_API_KEY"),
-            max_retries=3,
-            temperature=0.85,
-            max_tokens=100,
-            stop_sequences=character.stop,
-            timeout=180,
-        )
-    else:
-        llm = ChatOpenAI(
-            base_url=os.environ.get("LITELLM_URL", "https://llm.conczin.net"),
-            model=model.model,
-            api_key=os.environ.get("LITELLM_API_KEY"),
-            max_retries=3,
-            temperature=0.85,
-            max_tokens=150,
-            stop_sequences=character.stop,
-        )
 
-    # Enable tools and add glossary functions if requested
-    if model.tools and len(tools) > 0:
-        llm = llm.bind_tools(tools)
+async def timed(stage: str, awaitable: Awaitable[T]) -> T:
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        stage_time.labels(stage).observe(time.perf_counter() - start)
 
-    # Process system prompt
-    static_system = character.system + "\n" + model.system
-    if messages[0].role == Role.system:
-        flags, dynamic_system = get_system_flags(messages[0].content)
-    else:
-        flags, dynamic_system = {}, ""
-
-    # Extract session-related data
-    world_id = flags.get("world_id", auth_token)
-    player_id = flags.get("player_id", auth_token)
-    character_id = (
-        flags["character_id"]
-        if "character_id" in flags
-        else get_villager(messages[0].content)
-    )
-    use_memory = get_boolean(flags, "use_memory", False)
-    shared_memory = get_boolean(flags, "shared_memory", False)
-    session_id = (
-        None
-        if character_id is None
-        else f"{world_id if shared_memory else player_id}_{character_id}"
+
+async def get_chat_completion(
+    model: Model,
+    character: Character,
+    messages: list[Message],
+    tools: list[dict],
+    auth_token: str,
+    threaded: Callable[[Callable], Callable] = lambda func: default_pool.wrap(
+        "default", func
+    ),
+    moderate: bool = False,
+) -> Optional[AIMessage]:
+    """
+    Assemble the prompt and launch the LLM. The stages of the prompt run concurrently, blocking ones on the threads
+    provided by `threaded`. Returns None if moderation flagged the conversation.
+    """
+    # Moderation only gates what is remembered and the LLM call, it runs alongside everything else
+    moderation = asyncio.ensure_future(
+        timed("moderation", threaded(check_prompt_openai)(messages))
+        if moderate
+        else asyncio.sleep(0, False)
     )
-    enabled_glossaries = {g.strip() for g in flags.get("glossaries", "").split(",")}
 
-    # Clean the remaining messages and construct a query for RAG
-    messages = clean_conversation(messages, player_id)
-    query = to_conversation(crop_conversation(messages, 400))
+    # Loaded once, on a thread since that takes a while
+    preloaded = asyncio.ensure_future(threaded(preload)())
+
+    try:
+        # Instantiate model
+        if model.provider == "horde":
+            # A model with `llama-3-instruct` format is added to have consistent results
+            # TODO: Filter by template
+            models = ["koboldcpp/L3-8B-Stheno-v3.2"] + await threaded(get_models)()
+
+            if len(models) == 1:
+                raise ValueError("No models available.")
+
+            llm = get_chat_model(
+                base_url="https://api.conczin.net/v1",
+                model=",".join(models),
+                api_key=os.environ.get("HORDE_API_KEY"),
+                stop=character.stop,
+                max_retries=0,
+                temperature=0.85,
+                max_tokens=100,
+                timeout=180,
+            )
+        else:
+            llm = get_chat_model(
+                base_url=os.environ.get("LITELLM_URL", "https://llm.conczin.net"),
+                model=model.model,
+                api_key=os.environ.get("LITELLM_API_KEY"),
+                stop=character.stop,
+                max_retries=0,
+                temperature=0.85,
+                max_tokens=150,
+            )
 
-    # If the system is too large, compress it using a RAG
-    dynamic_system = (
-        get_vector_compressor().invoke(
-            {
-                "input": dynamic_system,
-                "query": query,
-                "k": 3,
-            }
-        )
-        if dynamic_system
-        else ""
-    )
+        # Enable tools and add glossary functions if requested
+        if model.tools and len(tools) > 0:
+            llm = llm.bind_tools(tools)
 
-    # Construct the prompt
-    prompt: list[BaseMessage] = (
-        [SystemMessage(f"{static_system}\n{dynamic_system}")]
-        + [
-            AIMessage(
-                content=get_glossary_entry(query, glossary),
-                name="Glossary",
+        # Process system prompt
+        static_system = character.system + "\n" + model.system
+        if messages[0].role == Role.system:
+            flags, dynamic_system = get_system_flags(messages[0].content)
+        else:
+            flags, dynamic_system = {}, ""
+
+        # Extract session-related data
+        world_id = flags.get("world_id", auth_token)
+        player_id = flags.get("player_id", auth_token)
+        character_id = (
+            flags["character_id"]
+            if "character_id" in flags
+            else get_villager(messages[0].content)
+        )
+        use_memory = get_boolean(flags, "use_memory", False)
+        shared_memory = get_boolean(flags, "shared_memory", False)
+        session_id = (
+            None
+            if character_id is None
+            else f"{world_id if shared_memory else player_id}_{character_id}"
+        )
+        enabled_glossaries = {g.strip() for g in flags.get("glossaries", "").split(",")}
+
+        # Clean the remaining messages and construct a query for RAG
+        conversation = clean_conversation(messages, player_id)
+        query = to_conversation(crop_conversation(conversation, 400))
+
+        # If the system is too large, compress it using a RAG
+        async def compress_system() -> str:
+            if not dynamic_system:
+                return ""
+            await preloaded
+            return await timed(
+                "vector_compressor",
+                threaded(get_vector_compressor().invoke)(
+                    {"input": dynamic_system, "query": query, "k": 3}
+                ),
             )
-            for key, glossary in character.glossary.items()
-            if glossary.always or key in enabled_glossaries
-        ]
-        + (
-            get_memory_manager(
-                characters_per_level=character.memory_characters_per_level,
-                sentences_per_summary=character.memory_sentences_per_summary,
-                model=character.memory_model,
-            ).invoke(
-                {
-                    "session_id": session_id,
-                    "conversation": messages,
-                }
+
+        async def glossary_entry(glossary: GlossarySearch) -> AIMessage:
+            await preloaded
+            content = await timed(
+                "glossary", threaded(get_glossary_entry)(query, glossary)
             )
-            if use_memory and session_id is not None
-            else [
+            return AIMessage(content=content, name="Glossary")
+
+        async def memory() -> list[BaseMessage]:
+            if use_memory and session_id is not None:
+                if await moderation:
+                    return []
+                return await timed(
+                    "memory",
+                    get_character_memory_manager(character).ainvoke(
+                        {"session_id": session_id, "conversation": conversation}
+                    ),
+                )
+            return [
                 m.as_langchain()
                 for m in crop_conversation(
-                    messages, character.fallback_memory_characters
+                    conversation, character.fallback_memory_characters
                 )
             ]
+
+        # Construct the prompt, all stages at once
+        system, history, *glossary = await asyncio.gather(
+            compress_system(),
+            memory(),
+            *[
+                glossary_entry(glossary)
+                for key, glossary in character.glossary.items()
+                if glossary.always or key in enabled_glossaries
+            ],
         )
-    )
+        if await moderation:
+            return None
 
-    # Launch
-    response = rate_limited_call(llm, prompt)
+        prompt: list[BaseMessage] = (
+            [SystemMessage(f"{static_system}\n{system}")] + glossary + history
+        )
 
-    return response
+        # Launch
+        return await timed("llm", arate_limited_call(llm, prompt))
+    finally:
+        # Left behind if a stage failed, cancel them rather than leaving their outcome unretrieved
+        for task in [moderation, preloaded]:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
 
 
 def message_to_dict(message: AIMessage) -> dict:
@@ -10,12 +10,18 @@ from pyrate_limiter import (
 )
 
 from app.configurator import Configurator
+from app.llm.memory import IdleCompactor
+from app.llm.memory_store import MemoryPruner, get_memory_store
 from app.llm.types import Body, Character, GlossarySearch, Model
 from app.patreon_utils import verify_patron
+from app.utils import get_cache_path
 
-from .chain import get_chat_completion, message_to_dict
+from .chain import (
+    get_character_memory_manager,
+    get_chat_completion,
+    message_to_dict,
+)
 from .multi_bucket_factory import MultiBucketFactory
-from .openai_utils import check_prompt_openai
 from .premium import PremiumManager
 
 # Settings
@@ -116,6 +122,9 @@ CHARACTERS["villager"] = Character(
     name="Villager", system=system_prompt, memory_characters_per_level=900
 )
 
+# Villager sessions end with the villager's UUID, other characters use their own ids
+VILLAGER_SESSIONS = "*_" + "-".join("[0-9a-fA-F]" * n for n in (8, 4, 4, 4, 12))
+
 # Maps renamed models to their new names
 ALIASES = {
     "default": "mistral-medium",
@@ -198,6 +207,34 @@ def init(configurator: Configurator):
 
     stats = Stats()
 
+    def acquire(premium: bool, player: str, ip: str, weight: int):
+        # Rate limit per user
+        lim = limiter_premium if premium else limiter
+        # noinspection PyAsyncCall
+        lim.try_acquire(name=player, weight=weight)
+
+        # Rate limit per ip
+        lim = limiter_ip_premium if premium else limiter_ip
+        lim.try_acquire(name=ip, weight=weight)
+
+    # Forget sessions idle for too long
+    MemoryPruner(
+        get_memory_store(
+            get_cache_path("memory.db"), configurator.config.get("memory_shards", 1)
+        ),
+        retention_days=configurator.config.get("memory_retention_days", 365),
+        interval=configurator.config.get("memory_prune_interval", 3600),
+    )
+
+    # Compact the tails of idle villager sessions off-peak
+    idle_compaction = dict(configurator.config.get("idle_compaction", {}))
+    if idle_compaction.pop("enable", False):
+        IdleCompactor(
+            get_character_memory_manager(CHARACTERS["villager"]),
+            session_glob=VILLAGER_SESSIONS,
+            **idle_compaction,
+        ).start()
+
     @configurator.get("/v1/mca/verify")
     def verify(email: str, player: str):
         days_left = verify_patron(email)
@@ -212,7 +249,7 @@ def init(configurator: Configurator):
         return stats
 
     @configurator.post("/v1/mca/chat")
-    def chat_completions(
+    async def chat_completions(
         body: Body, request: Request, authorization: str = Header(None)
     ):
         if not authorization or not authorization.startswith("Bearer "):
@@ -220,7 +257,7 @@ def init(configurator: Configurator):
 
         # Authorization
         player = authorization.split("Bearer ")[-1]
-        premium = premium_manager.is_premium(player)
+        premium = await configurator.threaded(premium_manager.is_premium)(player)
 
         # Forward legacy models
         model = body.model
@@ -245,31 +282,28 @@ def init(configurator: Configurator):
             # Calculate the cost of this request
             weight = int(sum([len(m.content) for m in body.messages]) * model.price + 1)
 
-            # Rate limit per user
-            lim = limiter_premium if premium else limiter
-            # noinspection PyAsyncCall
-            lim.try_acquire(name=player, weight=weight)
-
-            # Rate limit per ip
-            lim = limiter_ip_premium if premium else limiter_ip
-            lim.try_acquire(
-                name=str(request.client.host),
-                weight=weight,
+            # Rate limit per user and ip, their buckets may block
+            await configurator.threaded(acquire)(
+                premium, player, str(request.client.host), weight
             )
 
-            # Content moderation
-            if model.provider == "openai" and check_prompt_openai(body.messages):
+            # Process, with content moderation alongside
+            message = await get_chat_completion(
+                model,
+                character,
+                body.messages,
+                body.tools,
+                player,
+                threaded=configurator.threaded,
+                moderate=model.provider == "openai",
+            )
+            if message is None:
                 return {
                     "choices": [
                         {"message": {"content": "I don't want to talk about that."}}
                     ]
                 }
 
-            # Process
-            message = get_chat_completion(
-                model, character, body.messages, body.tools, player
-            )
-
             actual_model_name = message.response_metadata.get("model_name", model.model)
             for model_name, stats_container in [(model.model, stats.models)] + [
                 (actual_model_name, stats.actual_models)
@@ -1,6 +1,7 @@
 import dbm.dumb
 import os
 import shelve
+import threading
 from datetime import datetime, timedelta
 
 from app.utils import get_cache_path
@@ -13,18 +14,22 @@ class PremiumManager:
         self.db = shelve.Shelf(
             dbm.dumb.open(get_cache_path("premium_data"), "c"), writeback=True
         )
+        # Accessed from worker threads
+        self.lock = threading.Lock()
 
     def __del__(self):
         self.db.close()
 
     def set_premium(self, username: str, days: int):
         expiration_date = datetime.now() + timedelta(days=days)
-        self.db[username] = expiration_date
-        self.db.sync()
+        with self.lock:
+            self.db[username] = expiration_date
+            self.db.sync()
 
     def is_premium(self, username: str):
-        if username in self.db:
-            expiration_date = self.db[username]
+        with self.lock:
+            expiration_date = self.db.get(username)
+        if expiration_date is not None:
             return expiration_date > datetime.now()
         else:
             return False
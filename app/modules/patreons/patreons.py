@@ -3,10 +3,10 @@ import os
 from collections import defaultdict
 
 import patreon as patreon
-from cachetools import TTLCache, cached
 
 from app.configurator import Configurator
 from app.patreon_utils import fetch_members, get_member_list
+from app.response_cache import ResponseCache
 
 creator_access_token = os.getenv("PATREON_API_KEY")
 
@@ -20,8 +20,7 @@ def hash_email(email: str) -> str:
 def init(configurator: Configurator):
     configurator.register("Patreon", "Proxy for the Patreon API to list patrons.")
 
-    @configurator.get("/v1/patron_names")
-    @cached(TTLCache(maxsize=1, ttl=1800))
+    @configurator.get("/v1/patron_names", cache=ResponseCache(expire=1800))
     def get_patron_names():
         return get_member_list()
 
@@ -33,8 +32,7 @@ def init(configurator: Configurator):
                 verified[hash_email(m["email"])] = m["tiers"]
         return {email: list(verified.get(email, [])) for email in emails.split(",")}
 
-    @configurator.get("/v1/patrons")
-    @cached(TTLCache(maxsize=1, ttl=1800))
+    @configurator.get("/v1/patrons", cache=ResponseCache(expire=1800))
     def get_patrons():
         users = {}
         pledges = defaultdict(int)
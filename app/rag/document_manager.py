@@ -7,9 +7,9 @@ from typing import List, Optional
 
 from langchain_core.messages import AIMessage
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
 from pydantic import BaseModel
 
+from ..llm.clients import get_chat_model
 from ..llm.ratelimit import rate_limited_call
 from ..rag.html_processor import get_chapters
 from ..utils import get_cache_path
@@ -22,11 +22,11 @@ class Summary(BaseModel):
 
 
 def get_model(model: str, max_tokens: Optional[int] = None):
-    return ChatOpenAI(
+    return get_chat_model(
         base_url=os.environ.get("LITELLM_URL", "https://llm.conczin.net"),
         model=model,
         api_key=os.environ.get("LITELLM_API_KEY"),
-        max_retries=3,
+        max_retries=0,
         temperature=0,
         max_tokens=max_tokens,
     )
@@ -0,0 +1,209 @@
+import os
+import random
+import secrets
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from functools import wraps
+from types import FrameType
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
+
+from fastapi import Header, HTTPException, Request, Response
+
+from .config import settings
+
+if TYPE_CHECKING:
+    from .configurator import Configurator
+
+config = settings["global"].get("profiler", {})
+sample_rate = config.get("sample_rate", 0.0)
+interval = config.get("interval", 0.005)
+
+# Most recent profiles, served by the admin endpoints
+profiles: deque["Profile"] = deque(maxlen=config.get("keep", 50))
+
+current_profile: ContextVar[Optional["Profile"]] = ContextVar(
+    "current_profile", default=None
+)
+
+
+def is_admin(token: Optional[str]) -> bool:
+    admin_token = os.getenv("ADMIN_TOKEN")
+    return bool(admin_token and token and secrets.compare_digest(token, admin_token))
+
+
+def _within(frame: Optional[FrameType], root: FrameType) -> bool:
+    while frame is not None:
+        if frame is root:
+            return True
+        frame = frame.f_back
+    return False
+
+
+class Profile:
+    """
+    Samples the stacks of the threads working on a single request.
+    The event loop also runs other requests, it is only sampled while running the request's handler, tasks spawned by
+    it are missed.
+    """
+
+    def __init__(self, name: str, root: Optional[FrameType] = None):
+        """
+        :param root: The frame of the request's handler, required to be on sampled stacks of the current thread.
+        """
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.time()
+        self.end = self.start
+
+        # The thread handling the request, sync endpoints add their worker thread, mapped to their root frame
+        self.threads: dict[int, Optional[FrameType]] = {threading.get_ident(): root}
+
+        self.frames: dict[tuple[str, str, int], int] = {}
+        self.samples: dict[int, list[list[int]]] = {}
+        self.stopped = threading.Event()
+
+        self.sampler = threading.Thread(
+            target=self._sample, name="profiler", daemon=True
+        )
+        self.sampler.start()
+
+    def _stack(self, frame) -> list[int]:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            key = (
+                getattr(code, "co_qualname", code.co_name),
+                code.co_filename,
+                code.co_firstlineno,
+            )
+            if key not in self.frames:
+                self.frames[key] = len(self.frames)
+            stack.append(self.frames[key])
+            frame = frame.f_back
+        return stack[::-1]
+
+    def _sample(self):
+        while not self.stopped.wait(interval):
+            frames = sys._current_frames()
+            for ident, root in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is not None and (root is None or _within(frame, root)):
+                    self.samples.setdefault(ident, []).append(self._stack(frame))
+
+    def stop(self):
+        self.end = time.time()
+        self.stopped.set()
+        self.sampler.join()
+
+    def to_speedscope(self) -> dict:
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "ImmersiveAPI",
+            "shared": {
+                "frames": [
+                    {"name": name, "file": file, "line": line}
+                    for name, file, line in self.frames
+                ]
+            },
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": f"Thread {ident}",
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": len(samples) * interval,
+                    "samples": samples,
+                    "weights": [interval] * len(samples),
+                }
+                for ident, samples in self.samples.items()
+            ],
+        }
+
+
+def wrap(
+    name: str, handler: Callable[[Request], Awaitable[Response]]
+) -> Callable[[Request], Awaitable[Response]]:
+    """
+    Profile requests which ask for it via the `X-Profile` admin header, or are randomly sampled.
+    """
+
+    async def profiled_handler(request: Request) -> Response:
+        if not (
+            "x-profile" in request.headers
+            and is_admin(request.headers["x-profile"])
+            or sample_rate > 0
+            and random.random() < sample_rate
+        ):
+            return await handler(request)
+
+        profile = Profile(f"{request.method} {name}", sys._getframe())
+        token = current_profile.set(profile)
+        try:
+            response = await handler(request)
+        finally:
+            current_profile.reset(token)
+            profile.stop()
+            profiles.append(profile)
+
+        response.headers["X-Profile-Id"] = profile.id
+        return response
+
+    return profiled_handler
+
+
+def track_thread(func: Callable) -> Callable:
+    """
+    Let the profile of the current request also sample the thread a sync endpoint runs on.
+    """
+
+    @wraps(func)
+    def tracked(*args, **kwargs):
+        profile = current_profile.get()
+        if profile is None:
+            return func(*args, **kwargs)
+
+        ident = threading.get_ident()
+        profile.threads[ident] = None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.threads.pop(ident, None)
+
+    return tracked
+
+
+def init(configurator: "Configurator"):
+    configurator.register("Profiler", "Sampled request profiles, admin only.")
+
+    def verify(token: Optional[str]):
+        if not is_admin(token):
+            raise HTTPException(status_code=403, detail="Forbidden")
+
+    @configurator.get("/v1/profiles")
+    def get_profiles(x_admin_token: Optional[str] = Header(None)):
+        verify(x_admin_token)
+        return [
+            {
+                "id": p.id,
+                "name": p.name,
+                "start": p.start,
+                "duration": p.end - p.start,
+            }
+            for p in profiles
+        ]
+
+    @configurator.get("/v1/profiles/{profile_id}")
+    def get_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+        """
+        A profile in the speedscope format, open it at https://www.speedscope.app.
+        """
+        verify(x_admin_token)
+        for p in profiles:
+            if p.id == profile_id:
+                return p.to_speedscope()
+        raise HTTPException(status_code=404, detail="Unknown profile.")
@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import json
+import logging
+import struct
+import time
+from typing import Awaitable, Callable, Optional
+
+from cachetools import LRUCache
+from fastapi import Request, Response
+from fastapi_cache import FastAPICache
+from fastapi_cache.types import Backend
+from prometheus_client import Counter, Gauge
+
+from .config import settings
+
+cache_requests = Counter(
+    "response_cache_requests",
+    "Cached route lookups by result (memory, redis, miss, coalesced).",
+    ["module", "result"],
+)
+cache_bytes = Counter(
+    "response_cache_served_bytes",
+    "Bytes served from the response cache, by tier.",
+    ["module", "tier"],
+)
+memory_cache_bytes = Gauge(
+    "response_cache_bytes",
+    "Bytes held by the response cache, by tier.",
+    ["tier"],
+    multiprocess_mode="livesum",
+)
+
+# In-process tier, shared by all routes and bounded by the size of the encoded responses
+memory_cache: LRUCache[str, tuple[float, bytes]] = LRUCache(
+    maxsize=settings["global"].get("response_cache_bytes", 64 * 1024 * 1024),
+    getsizeof=lambda entry: len(entry[1]),
+)
+
+
+class ResponseCoder:
+    """
+    Encodes a response as a length-prefixed JSON head, followed by the raw body.
+    """
+
+    @classmethod
+    def encode(cls, response: Response) -> bytes:
+        head = json.dumps(
+            {
+                "status": response.status_code,
+                "headers": [
+                    (k.decode("latin-1"), v.decode("latin-1"))
+                    for k, v in response.raw_headers
+                    if k != b"content-length"
+                ],
+            }
+        ).encode()
+        return struct.pack("!I", len(head)) + head + response.body
+
+    @classmethod
+    def decode(cls, value: bytes) -> Response:
+        (length,) = struct.unpack_from("!I", value)
+        head = json.loads(value[4 : 4 + length])
+        response = Response(content=value[4 + length :], status_code=head["status"])
+        response.raw_headers = [
+            (k.encode("latin-1"), v.encode("latin-1")) for k, v in head["headers"]
+        ] + [(b"content-length", str(len(response.body)).encode("latin-1"))]
+        return response
+
+
+async def default_key_builder(request: Request) -> str:
+    """
+    Keys a request by its method, path, query and body.
+    """
+    h = hashlib.sha256()
+    h.update(request.method.encode())
+    h.update(request.url.path.encode())
+    h.update(str(sorted(request.query_params.multi_items())).encode())
+    if request.method in ("POST", "PUT"):
+        h.update(await request.body())
+    return h.hexdigest()
+
+
+def _get_redis_backend() -> Optional[Backend]:
+    try:
+        return FastAPICache.get_backend()
+    except AssertionError:
+        return None
+
+
+def _get_prefix() -> str:
+    try:
+        return FastAPICache.get_prefix()
+    except AssertionError:
+        return "api"
+
+
+class ResponseCache:
+    """
+    Caches successful responses of a route in-process and in Redis.
+    Concurrent misses for the same key are coalesced into a single call to the endpoint.
+    """
+
+    def __init__(
+        self,
+        expire: int = 60,
+        key_builder: Callable[[Request], Awaitable[str]] = default_key_builder,
+        coder: type[ResponseCoder] = ResponseCoder,
+        redis: bool = True,
+    ):
+        """
+        :param expire: Time to live in seconds.
+        :param key_builder: Builds the cache key for a request.
+        :param coder: Converts responses from and to bytes.
+        :param redis: Whether to also store responses in Redis, shared between processes and restarts.
+        """
+        self.expire = expire
+        self.key_builder = key_builder
+        self.coder = coder
+        self.redis = redis
+
+        self.inflight: dict[str, asyncio.Task] = {}
+
+    async def get(self, module: str, key: str) -> Optional[bytes]:
+        entry = memory_cache.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                cache_requests.labels(module, "memory").inc()
+                cache_bytes.labels(module, "memory").inc(len(entry[1]))
+                return entry[1]
+            del memory_cache[key]
+
+        backend = _get_redis_backend() if self.redis else None
+        if backend is not None:
+            try:
+                ttl, value = await backend.get_with_ttl(key)
+            except Exception as e:
+                logging.warning(f"Response cache lookup failed: {e}")
+                ttl, value = None, None
+            if value is not None:
+                cache_requests.labels(module, "redis").inc()
+                cache_bytes.labels(module, "redis").inc(len(value))
+
+                # Expire along with the Redis entry, rather than living another full lifetime in memory
+                if ttl is not None and ttl >= 0:
+                    self._set_memory(key, value, min(ttl, self.expire))
+                else:
+                    self._set_memory(key, value)
+                return value
+
+        return None
+
+    def _set_memory(self, key: str, value: bytes, expire: Optional[float] = None):
+        if len(value) <= memory_cache.maxsize:
+            memory_cache[key] = (
+                time.time() + (self.expire if expire is None else expire),
+                value,
+            )
+            memory_cache_bytes.labels("memory").set(memory_cache.currsize)
+
+    async def set(self, key: str, value: bytes):
+        self._set_memory(key, value)
+
+        backend = _get_redis_backend() if self.redis else None
+        if backend is not None:
+            try:
+                await backend.set(key, value, expire=self.expire)
+            except Exception as e:
+                logging.warning(f"Response cache store failed: {e}")
+
+    def wrap(
+        self, module: str, handler: Callable[[Request], Awaitable[Response]]
+    ) -> Callable[[Request], Awaitable[Response]]:
+        async def compute(
+            key: str, request: Request
+        ) -> tuple[Response, Optional[bytes]]:
+            response = await handler(request)
+
+            # Only complete, successful responses can be stored and shared
+            if response.status_code != 200 or not hasattr(response, "body"):
+                return response, None
+
+            value = self.coder.encode(response)
+            await self.set(key, value)
+            return response, value
+
+        async def cached_handler(request: Request) -> Response:
+            key = f"{_get_prefix()}:response:{module}:{await self.key_builder(request)}"
+
+            value = await self.get(module, key)
+            if value is not None:
+                return self.coder.decode(value)
+
+            # Another request is already computing this response, wait for it instead
+            if key in self.inflight:
+                cache_requests.labels(module, "coalesced").inc()
+                _, value = await asyncio.shield(self.inflight[key])
+                if value is not None:
+                    return self.coder.decode(value)
+                return await handler(request)
+
+            cache_requests.labels(module, "miss").inc()
+            task = asyncio.ensure_future(compute(key, request))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+            response, _ = await asyncio.shield(task)
+            return response
+
+        return cached_handler
@@ -0,0 +1,97 @@
+import time
+from functools import wraps
+from typing import Callable, Optional
+
+import anyio.to_thread
+from anyio import CapacityLimiter
+from prometheus_client import Gauge, Histogram
+
+threadpool_size = Gauge(
+    "threadpool_size",
+    "Number of threads a pool may use for sync endpoints.",
+    ["pool"],
+    multiprocess_mode="max",
+)
+threadpool_active = Gauge(
+    "threadpool_active_threads",
+    "Sync endpoints currently running on a pool's threads.",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+threadpool_waiting = Gauge(
+    "threadpool_waiting_tasks",
+    "Sync endpoints currently waiting for a free thread.",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+threadpool_wait_time = Histogram(
+    "threadpool_wait_seconds",
+    "Time sync endpoints waited for a free thread.",
+    ["pool"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+def set_default_size(size: int):
+    """
+    Resize the default pool of the running event loop, shared by all modules without a dedicated pool.
+    """
+    anyio.to_thread.current_default_thread_limiter().total_tokens = size
+    threadpool_size.labels("default").set(size)
+
+
+class ThreadPool:
+    """
+    A dedicated capacity of worker threads, so that slow endpoints of one module can not starve the others.
+    Without a size, the default pool is used.
+    """
+
+    def __init__(self, size: Optional[int] = None):
+        self.size = size
+        self._limiter: Optional[CapacityLimiter] = None
+
+    @property
+    def limiter(self) -> CapacityLimiter:
+        if self.size is None:
+            return anyio.to_thread.current_default_thread_limiter()
+
+        # Limiters can only be created within the event loop
+        if self._limiter is None:
+            self._limiter = CapacityLimiter(self.size)
+        return self._limiter
+
+    def wrap(self, name: str, func: Callable) -> Callable:
+        """
+        Turn a sync endpoint into an async one running on this pool, instrumented under the given pool name.
+        """
+        if self.size is not None:
+            threadpool_size.labels(name).set(self.size)
+
+        @wraps(func)
+        async def threaded(*args, **kwargs):
+            queued = time.perf_counter()
+            started = False
+
+            def run():
+                nonlocal started
+                started = True
+                threadpool_waiting.labels(name).dec()
+                threadpool_wait_time.labels(name).observe(time.perf_counter() - queued)
+                threadpool_active.labels(name).inc()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    threadpool_active.labels(name).dec()
+
+            threadpool_waiting.labels(name).inc()
+            try:
+                return await anyio.to_thread.run_sync(run, limiter=self.limiter)
+            finally:
+                # Cancelled while still waiting for a thread
+                if not started:
+                    threadpool_waiting.labels(name).dec()
+
+        return threaded
+
+
+default_pool = ThreadPool()
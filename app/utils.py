@@ -1,5 +1,8 @@
+import asyncio
+import threading
+from contextlib import suppress
 from pathlib import Path
-from typing import Optional, TypeVar
+from typing import AsyncGenerator, Awaitable, Callable, Optional, TypeVar
 
 import aiofiles
 import aiohttp
@@ -33,3 +36,32 @@ def get_data_path(path: str) -> Path:
 
 def get_cache_path(path: str) -> Path:
     return root / "cache" / path
+
+
+# Async generators finalized on shutdown of their loop, kept alive until then
+_shutdown_hooks: dict[asyncio.AbstractEventLoop, list[AsyncGenerator]] = {}
+_shutdown_hooks_lock = threading.Lock()
+
+
+def on_loop_shutdown(callback: Callable[[], Awaitable[None]]):
+    """
+    Await callback within the running loop once it shuts down, i.e., when `asyncio.run` finalizes async generators.
+    Loops closed without doing so skip it.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def finalize():
+        try:
+            yield
+        finally:
+            await callback()
+
+    # Starting it registers it with the loop, and runs it up to the yield
+    generator = finalize()
+    with suppress(StopIteration):
+        generator.asend(None).send(None)
+
+    with _shutdown_hooks_lock:
+        for closed in [other for other in _shutdown_hooks if other.is_closed()]:
+            del _shutdown_hooks[closed]
+        _shutdown_hooks.setdefault(loop, []).append(generator)
@@ -0,0 +1,142 @@
+"""
+Compares the CPU spent by the old GZip middleware and the content-aware compression middleware on a synthetic mix
+resembling our traffic. Payloads and shares are estimates rather than recorded responses, treat the results as such.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+
+from starlette.applications import Starlette
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from app.compression import CompressionMiddleware
+
+random.seed(42)
+
+# Already compressed media is close to random data
+PNG = b"\x89PNG" + os.urandom(24 * 1024)
+MP3 = [os.urandom(4096) for _ in range(16)]
+CHAT = {
+    "choices": [
+        {
+            "message": {
+                "content": "Well met, traveller! The harvest was good this year.",
+                "role": "assistant",
+            }
+        }
+    ]
+}
+VOICES = {
+    "voices": [
+        {"id": f"voice_{i}:-1", "name": f"voice_{i}", "language": "en", "gender": "x"}
+        for i in range(1500)
+    ]
+}
+
+# Path, share of requests
+MIX = [
+    ("/v1/mca/chat", 0.55),
+    ("/embed", 0.2),
+    ("/v1/tts/piper/speak", 0.15),
+    ("/v1/convert/png", 0.05),
+    ("/v1/tts/piper/voices", 0.05),
+]
+
+
+async def chat(_):
+    return JSONResponse(CHAT)
+
+
+async def embed(_):
+    return Response(PNG, media_type="image/png")
+
+
+async def speak(_):
+    return StreamingResponse(iter(MP3), media_type="audio/mpeg")
+
+
+async def convert(_):
+    return Response(PNG, media_type="image")
+
+
+async def voices(_):
+    return JSONResponse(VOICES)
+
+
+app = Starlette(
+    routes=[
+        Route("/v1/mca/chat", chat),
+        Route("/embed", embed),
+        Route("/v1/tts/piper/speak", speak),
+        Route("/v1/convert/png", convert),
+        Route("/v1/tts/piper/voices", voices),
+    ]
+)
+
+
+async def request(asgi, path: str, accept_encoding: str) -> int:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "GET",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "scheme": "http",
+        "query_string": b"",
+        "headers": [(b"accept-encoding", accept_encoding.encode())],
+        "client": ("127.0.0.1", 1234),
+        "server": ("test", 80),
+    }
+    size = 0
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal size
+        if message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+
+    await asgi(scope, receive, send)
+    return size
+
+
+async def run(asgi, paths: list[str], accept_encoding: str) -> tuple[float, int]:
+    start = time.process_time()
+    size = 0
+    for path in paths:
+        size += await request(asgi, path, accept_encoding)
+    return time.process_time() - start, size
+
+
+def main(requests: int = 2000):
+    paths = random.choices([p for p, _ in MIX], [w for _, w in MIX], k=requests)
+
+    variants = {
+        "gzip (previous)": (
+            GZipMiddleware(app, minimum_size=1024, compresslevel=6),
+            "gzip",
+        ),
+        "content-aware gzip": (CompressionMiddleware(app), "gzip"),
+        "content-aware zstd": (CompressionMiddleware(app), "zstd, gzip"),
+    }
+
+    print(f"{requests} requests: {json.dumps(dict(MIX))}")
+    baseline = None
+    for name, (asgi, accept_encoding) in variants.items():
+        cpu, size = asyncio.run(run(asgi, paths, accept_encoding))
+        baseline = baseline or cpu
+        print(
+            f"{name:<20} cpu {cpu:6.3f}s ({cpu / baseline:6.1%})  sent {size / 1024 / 1024:7.2f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Compares chat calls with a new client per request against the shared client registry, against the local stand-in LLM.
+Locally this only shows the client construction and TCP connect, against a remote upstream the TLS handshake adds to it.
+"""
+
+import os
+import statistics
+import time
+
+from langchain_openai import ChatOpenAI
+from prometheus_client import REGISTRY
+
+from app.llm.clients import get_chat_model
+from scripts.fake_llm import FakeLLM
+
+CALLS = 200
+
+
+def fresh(url: str) -> ChatOpenAI:
+    return ChatOpenAI(
+        base_url=url, model="fake", api_key="unused", max_retries=3, temperature=0.85
+    )
+
+
+def shared(url: str) -> ChatOpenAI:
+    return get_chat_model(
+        base_url=url, model="fake", api_key="unused", max_retries=3, temperature=0.85
+    )
+
+
+def connections(host: str) -> tuple[float, float]:
+    return tuple(
+        REGISTRY.get_sample_value(
+            "llm_client_requests_total", {"host": host, "connection": connection}
+        )
+        or 0
+        for connection in ["new", "reused"]
+    )
+
+
+def main():
+    with FakeLLM() as llm:
+        os.environ["LITELLM_URL"] = llm.url
+        for name, get in [("new client per call", fresh), ("shared registry", shared)]:
+            latencies = []
+            for i in range(CALLS):
+                start = time.perf_counter()
+                get(llm.url).invoke(f"Hello {i}")
+                latencies.append(time.perf_counter() - start)
+            print(
+                f"{name:<20} p50 {statistics.median(latencies) * 1000:6.2f}ms"
+                f"  mean {statistics.mean(latencies) * 1000:6.2f}ms"
+            )
+
+        new, reused = connections(llm.url)
+        print(f"shared registry: {new:.0f} new connections, {reused:.0f} reused")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Runs the memory manager over long synthetic conversations against a local stand-in LLM, for a grid of memory settings.
+Reports per-turn latency, time spent in the store, summarization calls, and how much the prompt was compressed.
+
+    python -m scripts.benchmark_memory --turns 300 --latency 0.05
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from app.llm.memory import Memory, MemoryManager
+from app.llm.memory_cache import CachedSession
+from app.llm.types import Message, Role
+from scripts.fake_llm import WORDS, FakeLLM
+
+# The game sends the most recent messages of the conversation with every turn
+WINDOW = 20
+
+
+class TimedMemoryManager(MemoryManager):
+    """
+    Accumulates the time spent reading and writing the store.
+    """
+
+    store_time = 0.0
+
+    def _timed(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.store_time += time.perf_counter() - start
+
+    def _fetch_session(self, session_id: str) -> CachedSession:
+        return self._timed(super()._fetch_session, session_id)
+
+    def add_memories(self, memories: list[Memory]):
+        return self._timed(super().add_memories, memories)
+
+    def replace_memories(self, memories: list[Memory], summary: Memory):
+        return self._timed(super().replace_memories, memories, summary)
+
+
+def get_conversation(turns: int, seed: int = 42) -> list[Message]:
+    rng = random.Random(seed)
+    conversation = []
+    for i in range(turns):
+        for role, name in [(Role.user, "Josef"), (Role.assistant, "You")]:
+            words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 40)))
+            conversation.append(
+                Message(role=role, content=f"{words.capitalize()}.", name=name)
+            )
+    return conversation
+
+
+def run(
+    directory: Path,
+    llm: FakeLLM,
+    conversation: list[Message],
+    characters_per_level: int,
+    sentences_per_summary: int,
+) -> dict:
+    manager = TimedMemoryManager(
+        directory / f"memory_{characters_per_level}_{sentences_per_summary}.db",
+        characters_per_level=characters_per_level,
+        sentences_per_summary=sentences_per_summary,
+        background_compaction=False,
+    )
+    calls = llm.calls
+
+    latencies = []
+    prompt_sizes = []
+    for turn in range(2, len(conversation) + 1, 2):
+        start = time.perf_counter()
+        history = manager.add_fetch_compress(
+            "villager", conversation[max(0, turn - WINDOW) : turn]
+        )
+        latencies.append(time.perf_counter() - start)
+        prompt_sizes.append(sum(len(m.content) for m in history))
+    manager.close()
+
+    total = sum(len(m.content) for m in conversation)
+    return {
+        "p50": statistics.median(latencies),
+        "p99": sorted(latencies)[int(len(latencies) * 0.99)],
+        "store": manager.store_time / len(latencies),
+        "calls": llm.calls - calls,
+        "prompt": prompt_sizes[-1],
+        "ratio": total / prompt_sizes[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument(
+        "--characters-per-level", type=int, nargs="+", default=[400, 700, 1200]
+    )
+    parser.add_argument(
+        "--sentences-per-summary", type=int, nargs="+", default=[2, 3, 5]
+    )
+    args = parser.parse_args()
+
+    conversation = get_conversation(args.turns)
+    with FakeLLM(args.latency) as llm, tempfile.TemporaryDirectory() as directory:
+        os.environ["LITELLM_URL"] = llm.url
+        os.environ.setdefault("LITELLM_API_KEY", "unused")
+
+        print(
+            f"{args.turns} turns, {sum(len(m.content) for m in conversation)} characters,"
+            f" {args.latency * 1000:.0f}ms LLM latency"
+        )
+        print(
+            f"{'chars/level':>11} {'sentences':>9} {'p50':>9} {'p99':>9} {'store':>9}"
+            f" {'calls':>6} {'prompt':>7} {'ratio':>6}"
+        )
+        for characters_per_level in args.characters_per_level:
+            for sentences_per_summary in args.sentences_per_summary:
+                result = run(
+                    Path(directory),
+                    llm,
+                    conversation,
+                    characters_per_level,
+                    sentences_per_summary,
+                )
+                print(
+                    f"{characters_per_level:>11} {sentences_per_summary:>9}"
+                    f" {result['p50'] * 1000:7.2f}ms {result['p99'] * 1000:7.2f}ms"
+                    f" {result['store'] * 1000:7.3f}ms {result['calls']:>6}"
+                    f" {result['prompt']:>7} {result['ratio']:>5.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares finding the first untracked message of a resent conversation, scanning all memories per message versus
+the per-session index of tracked messages.
+"""
+
+import random
+import time
+
+from app.llm.memory import Memory
+from app.llm.memory_cache import CachedSession
+from app.llm.types import Message, Role
+
+random.seed(42)
+
+# Memories of a session, length of the resent conversation
+SIZES = [(100, 100), (500, 1000), (2000, 4000)]
+REPEATS = 20
+
+
+def get_session(memories: int, messages: int) -> tuple[list[Memory], list[Message]]:
+    conversation = [
+        Message(
+            role=Role.user if i % 2 == 0 else Role.assistant,
+            content=f"Message {i} {random.random()}, about as long as a usual chat message.",
+            name="Josef" if i % 2 == 0 else "You",
+        )
+        for i in range(messages)
+    ]
+
+    # Older messages have been summarized, the last one is new
+    tracked = conversation[-memories - 1 : -1]
+    return [
+        Memory(i, "test", m.name, i, m.content, 0) for i, m in enumerate(tracked)
+    ], conversation
+
+
+def scan(memories: list[Memory], conversation: list[Message]) -> int:
+    for index, message in enumerate(conversation[::-1]):
+        if any(
+            memory.level == 0
+            and memory.name == message.name
+            and memory.content == message.content
+            for memory in memories
+        ):
+            return index
+    return -1
+
+
+def indexed(memories: list[Memory], conversation: list[Message]) -> int:
+    # A fresh entry, so building the index is included
+    return find(CachedSession(tuple(memories)), conversation)
+
+
+def find(session: CachedSession, conversation: list[Message]) -> int:
+    tracked = session.tracked
+    for index, message in enumerate(conversation[::-1]):
+        if (message.name, message.content) in tracked:
+            return index
+    return -1
+
+
+def worst_case(memories: list[Memory], conversation: list[Message]):
+    # Nothing tracked, the whole conversation is checked
+    return [
+        Memory(m.id, m.session_id, m.name, m.time, m.content + "!", 0) for m in memories
+    ], conversation
+
+
+def measure(func, *args) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func(*args)
+    return (time.perf_counter() - start) / REPEATS
+
+
+def main():
+    for memories_count, messages_count in SIZES:
+        memories, conversation = get_session(memories_count, messages_count)
+        assert scan(memories, conversation) == indexed(memories, conversation) == 1
+
+        for name, (m, c) in {
+            "usual": (memories, conversation),
+            "untracked": worst_case(memories, conversation),
+        }.items():
+            session = CachedSession(tuple(m))
+            before = measure(scan, m, c)
+            after = measure(indexed, m, c)
+            cached = measure(find, session, c)
+            print(
+                f"{memories_count:>5} memories {messages_count:>5} messages {name:<10}"
+                f"  scan {before * 1000:9.3f}ms  indexed {after * 1000:7.3f}ms"
+                f"  cached index {cached * 1000:7.3f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Measures write throughput of concurrent writers against the memory database with an increasing number of shards.
+Each write is one chat turn, a transaction adding two messages to a random session.
+With synchronous = FULL every commit waits for the disk, as on hosts where the WAL is synced more often.
+"""
+
+import os
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from app.llm.memory import Memory, _insert_memories
+from app.llm.memory_store import MemoryStore, ShardedMemoryStore
+
+random.seed(42)
+
+WRITERS = 16
+SHARDS = [1, 2, 4, 8]
+DURATION = 5
+SESSIONS = 10_000
+
+
+def get_store(directory: Path, shards: int, synchronous: str):
+    db_file = directory / f"{synchronous}_{shards}" / "memory.db"
+    db_file.parent.mkdir()
+    store = ShardedMemoryStore(db_file, shards) if shards > 1 else MemoryStore(db_file)
+    for shard in getattr(store, "shards", [store]):
+        shard.conn.execute(f"PRAGMA synchronous = {synchronous}")
+    return store
+
+
+def write(store, stop: threading.Event, counts: list[int], index: int):
+    while not stop.is_set():
+        session_id = f"player_{random.randrange(SESSIONS)}"
+        now = int(time.time() * 1000)
+        memories = [
+            Memory(-1, session_id, "Josef", now, "Hello there, how are you today?", 0),
+            Memory(-1, session_id, "You", now, "I am fine, thanks for asking.", 0),
+        ]
+        shard = store.shard(session_id)
+        with shard.write() as conn:
+            _insert_memories(conn, memories)
+        counts[index] += 1
+
+
+def measure(store) -> float:
+    stop = threading.Event()
+    counts = [0] * WRITERS
+    threads = [
+        threading.Thread(target=write, args=(store, stop, counts, i))
+        for i in range(WRITERS)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / DURATION
+
+
+def main():
+    # Writes mostly hold the GIL, more shards only help with more cores or slow disks
+    print(f"{os.cpu_count()} cores")
+    with tempfile.TemporaryDirectory(dir=Path.cwd()) as directory:
+        for synchronous in ["NORMAL", "FULL"]:
+            baseline = None
+            for shards in SHARDS:
+                store = get_store(Path(directory), shards, synchronous)
+                throughput = measure(store)
+                store.close()
+
+                baseline = baseline or throughput
+                print(
+                    f"synchronous {synchronous:<6} {shards} shards, {WRITERS} writers"
+                    f"  {throughput:8.0f} writes/s  {throughput / baseline:5.2f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Compares fetch latency of the memory database before and after the storage layer, at over a million rows.
+The legacy variant is the previous schema without index, rollback journal, and one connection shared by all threads.
+"""
+
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from app.llm.memory_store import MIGRATIONS, MemoryStore
+
+random.seed(42)
+
+ROWS = 1_200_000
+SESSIONS = 20_000
+FETCHES = 2_000
+THREADS = 8
+
+# Full scans are slow, fewer fetches suffice. Concurrent readers on the one legacy connection convoy on the GIL with
+# every row stepped, so the legacy variant is measured from a single thread, its best case.
+LEGACY_FETCHES = 50
+
+QUERY = """
+SELECT * FROM memory
+WHERE session_id = ?
+ORDER BY time, level DESC, ROWID
+"""
+
+
+def create_legacy(db_file: Path):
+    conn = sqlite3.connect(db_file)
+    conn.execute(MIGRATIONS[0])
+    start = int(time.time() * 1000)
+    conn.executemany(
+        "INSERT INTO memory (session_id, name, time, content, level) VALUES (?, ?, ?, ?, ?)",
+        (
+            (
+                f"player_{i % SESSIONS}",
+                "You" if i % 2 else "Josef",
+                start + i,
+                f"Message {i}, which is about as long as an average chat message.",
+                0 if i % 10 else 1,
+            )
+            for i in range(ROWS)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+def report(name: str, latencies: list[float], elapsed: float):
+    latencies = sorted(latencies)
+    print(
+        f"{name:<28} p50 {statistics.median(latencies) * 1000:8.3f}ms"
+        f"  p99 {latencies[int(len(latencies) * 0.99)] * 1000:8.3f}ms"
+        f"  {len(latencies) / elapsed:8.0f} fetches/s"
+    )
+
+
+def run(fetch, fetches: int, threads: int, writer=None) -> tuple[list[float], float]:
+    """
+    Fetch random sessions from several threads, optionally while another thread writes.
+    """
+    sessions = [f"player_{random.randrange(SESSIONS)}" for _ in range(fetches)]
+    stop = threading.Event()
+
+    def write():
+        i = 0
+        while not stop.is_set():
+            writer(i)
+            i += 1
+
+    def timed(session_id: str) -> float:
+        start = time.perf_counter()
+        fetch(session_id)
+        return time.perf_counter() - start
+
+    thread = threading.Thread(target=write) if writer else None
+    if thread:
+        thread.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        latencies = list(executor.map(timed, sessions))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    if thread:
+        thread.join()
+    return latencies, elapsed
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_file = Path(directory) / "legacy.db"
+        store_file = Path(directory) / "store.db"
+
+        start = time.perf_counter()
+        create_legacy(legacy_file)
+        print(f"Created {ROWS} rows in {time.perf_counter() - start:.1f}s")
+        shutil.copy(legacy_file, store_file)
+
+        # Legacy, one connection and a lock for writes
+        conn = sqlite3.connect(legacy_file, check_same_thread=False)
+        lock = threading.Lock()
+
+        def legacy_fetch(session_id: str):
+            return conn.execute(QUERY, (session_id,)).fetchall()
+
+        def legacy_write(i: int):
+            with lock:
+                conn.execute(
+                    "INSERT INTO memory (session_id, name, time, content, level) VALUES (?, ?, ?, ?, ?)",
+                    (f"player_{i % SESSIONS}", "Josef", i, "Hello", 0),
+                )
+                conn.commit()
+
+        # Migrating builds the index
+        start = time.perf_counter()
+        store = MemoryStore(store_file)
+        print(
+            f"Migrated to version {store.version} in {time.perf_counter() - start:.1f}s"
+        )
+
+        def store_fetch(session_id: str):
+            return store.read().execute(QUERY, (session_id,)).fetchall()
+
+        def store_write(i: int):
+            with store.write() as c:
+                c.execute(
+                    "INSERT INTO memory (session_id, name, time, content, level) VALUES (?, ?, ?, ?, ?)",
+                    (f"player_{i % SESSIONS}", "Josef", i, "Hello", 0),
+                )
+
+        report("legacy", *run(legacy_fetch, LEGACY_FETCHES, 1))
+        report(
+            "legacy, while writing",
+            *run(legacy_fetch, LEGACY_FETCHES, 1, legacy_write),
+        )
+        report(f"store, {THREADS} threads", *run(store_fetch, FETCHES, THREADS))
+        report(
+            f"store, {THREADS} threads, writing",
+            *run(store_fetch, FETCHES, THREADS, store_write),
+        )
+
+        conn.close()
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+A local stand-in for an OpenAI compatible chat completions endpoint, with a fixed latency and deterministic answers.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "the villager remembers that player asked about trade house farm wheat iron sword gift wedding "
+    "mine night zombie friend family village church bell library book emerald promise"
+).split()
+
+
+def summarize(text: str, sentences: int) -> str:
+    """
+    A summary of roughly realistic length, the same for the same input.
+    """
+    rng = random.Random(zlib.crc32(text.encode()))
+    return " ".join(
+        " ".join(rng.choice(WORDS) for _ in range(14)).capitalize() + "."
+        for _ in range(sentences)
+    )
+
+
+class FakeLLM:
+    """
+    Serves /chat/completions on a random local port, use as context manager.
+    """
+
+    def __init__(self, latency: float = 0.0, sentences: int = 3):
+        self.latency = latency
+        self.sentences = sentences
+        self.calls = 0
+        self.lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections alive, like real upstreams
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with fake.lock:
+                    fake.calls += 1
+                time.sleep(fake.latency)
+
+                prompt = body["messages"][-1]["content"]
+                # Follow the requested length, as the memory compression prompt asks for one
+                requested = re.search(
+                    r"up to (\d+) sentences", body["messages"][0]["content"]
+                )
+                sentences = int(requested.group(1)) if requested else fake.sentences
+                response = json.dumps(
+                    {
+                        "id": "fake",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": body["model"],
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {
+                                    "role": "assistant",
+                                    "content": summarize(prompt, sentences),
+                                },
+                                "finish_reason": "stop",
+                            }
+                        ],
+                        "usage": {
+                            "prompt_tokens": len(prompt) // 4,
+                            "completion_tokens": 0,
+                            "total_tokens": len(prompt) // 4,
+                        },
+                    }
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self) -> "FakeLLM":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
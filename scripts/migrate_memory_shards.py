@@ -0,0 +1,31 @@
+"""
+Splits the single memory database into shards, run with the server stopped, then set mca.memory_shards.
+
+    python -m scripts.migrate_memory_shards 4
+"""
+
+import argparse
+import time
+
+from app.llm.memory_store import get_shard_files, shard_database
+from app.utils import get_cache_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("shards", type=int)
+    parser.add_argument("--db-file", default=str(get_cache_path("memory.db")))
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    copied = shard_database(args.db_file, args.shards)
+    print(
+        f"Copied {copied} memories into {args.shards} shards in {time.perf_counter() - start:.1f}s:"
+    )
+    for shard_file in get_shard_files(args.db_file, args.shards):
+        print(f"  {shard_file}")
+    print(f"{args.db_file} is no longer used once memory_shards = {args.shards}.")
+
+
+if __name__ == "__main__":
+    main()
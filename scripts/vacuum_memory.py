@@ -0,0 +1,32 @@
+"""
+Rewrites memory databases created before incremental vacuum, so that pruning releases space. Run with the server
+stopped, it takes a while on large databases.
+
+    python -m scripts.vacuum_memory
+    python -m scripts.vacuum_memory cache/memory.0.db cache/memory.1.db
+"""
+
+import argparse
+import time
+
+from app.llm.memory_store import vacuum_database
+from app.utils import get_cache_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "db_files", nargs="*", default=[str(get_cache_path("memory.db"))]
+    )
+    args = parser.parse_args()
+
+    for db_file in args.db_files:
+        start = time.perf_counter()
+        before, after = vacuum_database(db_file)
+        print(
+            f"{db_file}: {before / 1024**2:.1f} MB to {after / 1024**2:.1f} MB in {time.perf_counter() - start:.1f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from prometheus_client import REGISTRY
+
+from app.bulkhead import Bulkhead
+from app.configurator import Configurator
+
+
+def rejected(reason: str) -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "module_rejected_requests_total",
+            {"module": "BulkheadTest", "reason": reason},
+        )
+        or 0
+    )
+
+
+def test():
+    bulkhead = Bulkhead(1, 1, 0.05)
+    release = asyncio.Event()
+
+    async def handler(request) -> str:
+        await release.wait()
+        return "done"
+
+    limited = bulkhead.wrap("BulkheadTest", handler)
+
+    async def run():
+        busy = asyncio.ensure_future(limited(None))
+        await asyncio.sleep(0.01)
+
+        # One request may queue, the next one is shed right away
+        queued = asyncio.ensure_future(limited(None))
+        await asyncio.sleep(0.01)
+        with pytest.raises(HTTPException) as e:
+            await limited(None)
+        assert e.value.status_code == 503
+
+        # The queued one is shed once it waited for too long
+        with pytest.raises(HTTPException):
+            await queued
+
+        # A cancelled waiter does not take a slot with it
+        cancelled = asyncio.ensure_future(limited(None))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        release.set()
+        assert await busy == "done"
+        assert await limited(None) == "done"
+        assert not bulkhead.semaphore.locked()
+
+    asyncio.run(run())
+    assert rejected("queue_full") == 1
+    assert rejected("queue_timeout") == 1
+
+
+def test_configurator():
+    app = FastAPI()
+    configurator = Configurator(app, {"max_concurrency": 2})
+    configurator.register("BulkheadTest", "Bulkhead test.")
+
+    # Queues as many as are handled at once by default
+    assert configurator.bulkhead.max_queue == 2
+
+    @configurator.get("/slow")
+    async def slow():
+        return "slow"
+
+    @configurator.get("/cheap", limited=False)
+    async def cheap():
+        return "cheap"
+
+    # Cheap endpoints skip the bulkhead
+    routes = {route.path: route for route in app.router.routes}
+    assert routes["/slow"].bulkhead is configurator.bulkhead
+    assert routes["/cheap"].bulkhead is None
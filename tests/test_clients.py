@@ -0,0 +1,30 @@
+import asyncio
+
+from app.llm.clients import LoopAsyncClient, get_chat_model
+from scripts.fake_llm import FakeLLM
+
+
+def test_event_loops():
+    with FakeLLM() as llm:
+        model = get_chat_model(
+            base_url=llm.url, model="fake", api_key="unused", max_retries=0
+        )
+
+        # Each loop, e.g., of a job, uses its own pooled connections
+        for i in range(3):
+            assert asyncio.run(model.ainvoke(f"Hello {i}")).content
+            assert model.invoke(f"Hello {i}").content
+        assert llm.calls == 6
+
+
+def test_loop_shutdown():
+    client = LoopAsyncClient("llm.test")
+
+    async def run():
+        return client.get_client()
+
+    # Pools are closed along with their loop
+    pools = [asyncio.run(run()) for _ in range(2)]
+    assert pools[0] is not pools[1]
+    assert all(pool.is_closed for pool in pools)
+    assert not client.clients
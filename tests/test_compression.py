@@ -0,0 +1,80 @@
+import asyncio
+
+import httpx
+from fastapi import FastAPI, Response
+from fastapi.responses import StreamingResponse
+
+from app.compression import CompressionMiddleware, negotiate
+from app.configurator import Configurator
+
+TEXT = "Well met, traveller! " * 100
+
+
+def get_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=100)
+    configurator = Configurator(app, {})
+    configurator.register("CompressionTest", "Compression test.")
+
+    @configurator.get("/text")
+    async def text():
+        return Response(TEXT, media_type="text/plain")
+
+    @configurator.get("/small")
+    async def small():
+        return Response("Hello", media_type="text/plain")
+
+    @configurator.get("/image")
+    async def image():
+        return Response(TEXT, media_type="image/png")
+
+    @configurator.get("/stream")
+    async def stream():
+        return StreamingResponse(iter([TEXT, TEXT]), media_type="text/plain")
+
+    @configurator.get("/never", compress=False)
+    async def never():
+        return Response(TEXT, media_type="text/plain")
+
+    return app
+
+
+def test_negotiate():
+    assert negotiate("gzip, deflate, br, zstd") == "zstd"
+    assert negotiate("gzip;q=0.5, zstd;q=0") == "gzip"
+    assert negotiate("br") is None
+    assert negotiate("") is None
+
+
+def test():
+    app = get_app()
+
+    async def get(path: str, accept: str) -> httpx.Response:
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            return await client.get(path, headers={"Accept-Encoding": accept})
+
+    def run(path: str, accept: str = "gzip, zstd") -> httpx.Response:
+        response = asyncio.run(get(path, accept))
+        assert response.status_code == 200
+        return response
+
+    # The best encoding the client accepts, decoded by httpx
+    for accept, encoding in [("gzip, zstd", "zstd"), ("gzip", "gzip")]:
+        response = run("/text", accept)
+        assert response.headers["content-encoding"] == encoding
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert int(response.headers["content-length"]) < len(TEXT)
+        assert response.text == TEXT
+    assert "content-encoding" not in run("/text", "identity").headers
+
+    # Small responses, compressed media and routes opting out are passed through
+    for path in ["/small", "/image", "/never"]:
+        assert "content-encoding" not in run(path).headers
+
+    # Streamed responses are compressed chunk by chunk
+    response = run("/stream", "gzip")
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert response.text == TEXT * 2
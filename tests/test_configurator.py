@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+import httpx
+from fastapi import FastAPI
+from prometheus_client import REGISTRY
+
+from app.configurator import Configurator, LazyModule
+
+
+def get_errors(module: str) -> dict[str, float]:
+    return {
+        status: REGISTRY.get_sample_value(
+            "module_request_errors_total", {"module": module, "status": status}
+        )
+        or 0
+        for status in ["4xx", "5xx"]
+    }
+
+
+def test_metrics():
+    app = FastAPI()
+    configurator = Configurator(app, {})
+    configurator.register("MetricsTest", "Request metrics test.")
+
+    @configurator.get("/square")
+    async def square(x: int):
+        if x < 0:
+            raise ValueError("Negative")
+        return {"square": x * x}
+
+    async def run():
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app, raise_app_exceptions=False),
+            base_url="http://test",
+        ) as client:
+            assert (await client.get("/square", params={"x": 3})).status_code == 200
+            assert (await client.get("/square", params={"x": "a"})).status_code == 422
+            assert (await client.get("/square", params={"x": -1})).status_code == 500
+
+    asyncio.run(run())
+
+    # Invalid requests are client errors, only unhandled exceptions are server errors
+    assert get_errors("MetricsTest") == {"4xx": 1, "5xx": 1}
+
+
+def test_lazy_module():
+    app = FastAPI()
+    calls = []
+
+    def init():
+        calls.append(time.monotonic())
+        time.sleep(0.05)
+        configurator = Configurator(app, {})
+        configurator.register("LazyTest", "Lazy module test.")
+
+        @configurator.get("/v1/lazy/hello")
+        async def hello():
+            return "Hello"
+
+    module = LazyModule(app, ["/v1/lazy"], init)
+
+    async def run():
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            # Only the prefix itself and paths below it
+            assert (await client.get("/v1/lazyness/hello")).status_code == 404
+            assert not calls
+
+            return await asyncio.gather(
+                *[client.get("/v1/lazy/hello") for _ in range(8)]
+            )
+
+    # Concurrent first requests wait for a single initialization
+    responses = asyncio.run(run())
+    assert [response.json() for response in responses] == ["Hello"] * 8
+    assert len(calls) == 1
+
+    # The placeholder is gone afterward
+    assert not any(route in app.router.routes for route in module.routes)
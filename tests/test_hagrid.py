@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import time
@@ -10,22 +11,24 @@ logging.basicConfig(level=logging.INFO)
 
 
 def main():
-    response = get_chat_completion(
-        MODELS["gpt-4.1-mini"],
-        CHARACTERS[HAGRID_SECRET],
-        [
-            Message(
-                role=Role.system,
-                content="[use_memory:true][shared_memory:true][world_id:default][character_id:hagrid][glossaries:mca_wiki]",
-            ),
-            Message(
-                role=Role.user,
-                content="How to get amethysts?",
-                name="Conczin",
-            ),
-        ],
-        [],
-        HAGRID_SECRET,
+    response = asyncio.run(
+        get_chat_completion(
+            MODELS["gpt-4.1-mini"],
+            CHARACTERS[HAGRID_SECRET],
+            [
+                Message(
+                    role=Role.system,
+                    content="[use_memory:true][shared_memory:true][world_id:default][character_id:hagrid][glossaries:mca_wiki]",
+                ),
+                Message(
+                    role=Role.user,
+                    content="How to get amethysts?",
+                    name="Conczin",
+                ),
+            ],
+            [],
+            HAGRID_SECRET,
+        )
     )
 
     print(json.dumps(message_to_dict(response), indent=2))
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import pickle
+import threading
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from app import jobs
+from app.configurator import Configurator
+from app.jobs import (
+    Job,
+    JobManager,
+    JobStatus,
+    MemoryJobStore,
+    RedisJobStore,
+    SQLiteJobStore,
+)
+
+
+class LocalRedis:
+    """
+    A local stand-in for the subset of the Redis client used by the job store.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.lists = {}
+        self.condition = threading.Condition()
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode() if isinstance(value, str) else value
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def rpush(self, key, value):
+        with self.condition:
+            self.lists.setdefault(key, []).append(value.encode())
+            self.condition.notify_all()
+
+    def blpop(self, keys, timeout=0):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: any(self.lists.get(k) for k in keys), timeout=timeout
+            )
+            for key in keys:
+                if self.lists.get(key):
+                    return key.encode(), self.lists[key].pop(0)
+        return None
+
+
+def wait_for(manager: JobManager, job_id: str, timeout: float = 5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = manager.store.get(job_id)
+        if job.status in (JobStatus.done, JobStatus.failed):
+            return job
+        time.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+@pytest.mark.parametrize("store", ["memory", "sqlite", "redis"])
+def test(store, tmp_path):
+    if store == "memory":
+        job_store = MemoryJobStore()
+    elif store == "sqlite":
+        job_store = SQLiteJobStore(str(tmp_path / "jobs.db"), poll_interval=0.01)
+    else:
+        job_store = RedisJobStore(LocalRedis())
+
+    manager = JobManager(job_store, workers=2)
+    manager.register("square", lambda x: {"square": x * x})
+    manager.register("fail", lambda: 1 / 0)
+
+    job = wait_for(manager, manager.submit("square", {"x": 3}).id)
+    assert job.status == JobStatus.done
+    assert job.media_type == "application/json"
+    assert json.loads(manager.store.get_result(job.id)) == {"square": 9}
+
+    job = wait_for(manager, manager.submit("fail", {}).id)
+    assert job.status == JobStatus.failed
+    assert job.error == "division by zero"
+
+
+def test_expire():
+    store = MemoryJobStore()
+    manager = JobManager(store, workers=1, result_ttl=0)
+    manager.register("square", lambda x: {"square": x * x})
+
+    # Finished jobs are forgotten even if nobody polls them
+    for i in range(3):
+        job_id = manager.submit("square", {"x": i}).id
+        while job_id not in store.expires:
+            time.sleep(0.01)
+    time.sleep(0.01)
+    manager.submit("square", {"x": 3})
+    assert len(store.results) <= 1
+
+
+def test_interrupted(tmp_path):
+    db_file = str(tmp_path / "jobs.db")
+
+    # A process died while running a job
+    store = SQLiteJobStore(db_file, poll_interval=0.01)
+    store.enqueue(
+        Job(id="a", name="square", created=time.time()), pickle.dumps({"x": 3})
+    )
+    assert store.dequeue(0)[0].id == "a"
+    store.conn.close()
+
+    # Once its lease ran out, another one runs it again
+    manager = JobManager(SQLiteJobStore(db_file, poll_interval=0.01, lease=0.1))
+    manager.register("square", lambda x: {"square": x * x})
+    job = wait_for(manager, "a")
+    assert job.status == JobStatus.done
+    assert json.loads(manager.store.get_result("a")) == {"square": 9}
+
+
+def test_endpoints(monkeypatch):
+    manager = JobManager(MemoryJobStore(), workers=1)
+    manager.register("fail", lambda: 1 / 0)
+    monkeypatch.setattr(jobs, "get_job_manager", lambda: manager)
+
+    app = FastAPI()
+    jobs.init(Configurator(app, {}))
+    job = wait_for(manager, manager.submit("fail", {}).id)
+
+    # A failed job is not a failing server
+    async def run():
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            return await client.get(f"/v1/jobs/{job.id}/result")
+
+    response = asyncio.run(run())
+    assert response.status_code == 409
+    assert response.json()["detail"] == "Job failed: division by zero"
@@ -0,0 +1,42 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from prometheus_client import REGISTRY
+
+from app import loop_monitor
+from app.loop_monitor import LoopMonitor
+
+
+def test():
+    monitor = LoopMonitor("test", interval=0.01, slow_callback=0.05)
+
+    async def blocking(request):
+        time.sleep(0.2)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        await loop_monitor.wrap("/blocking", blocking)(SimpleNamespace(method="GET"))
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+    asyncio.run(run())
+
+    # Lag is measured continuously
+    assert (
+        REGISTRY.get_sample_value("event_loop_lag_seconds_count", {"loop": "test"}) > 5
+    )
+
+    # The stall is caught while blocking, with its route and stack
+    assert len(monitor.stalls) == 1
+    stall = monitor.stalls[0]
+    assert stall["route"] == "GET /blocking"
+    assert "in blocking" in stall["stack"]
+    assert stall["duration"] >= 0.15
+    assert (
+        REGISTRY.get_sample_value(
+            "event_loop_stalls_total", {"loop": "test", "route": "GET /blocking"}
+        )
+        == 1
+    )
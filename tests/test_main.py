@@ -0,0 +1,84 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from dynaconf import Dynaconf
+from fastapi import FastAPI
+from starlette.middleware.gzip import GZipMiddleware
+
+import app.main as main
+
+
+def test_start_all_modules(monkeypatch):
+    app = FastAPI(openapi_url=None)
+    tags_metadata = []
+    monkeypatch.setattr(main, "app", app)
+    monkeypatch.setattr(main, "tags_metadata", tags_metadata)
+    monkeypatch.setattr(
+        main, "settings", {"global": {"init_workers": 4}, "a": {}, "b": {}, "c": {}}
+    )
+
+    started = {}
+    finished = {}
+
+    def start_module(name: str, target: FastAPI, tags: list[dict]):
+        started[name] = time.monotonic()
+        time.sleep({"a": 0.1, "b": 0.01, "c": 0.05}[name])
+        target.get(f"/{name}")(lambda: name)
+        tags.append({"name": name, "description": name})
+        finished[name] = time.monotonic()
+        return 0, 0
+
+    monkeypatch.setattr(main, "start_module", start_module)
+
+    # b waits for c, which finishes before a
+    monkeypatch.setattr(
+        main, "get_enabled_modules", lambda: {"a": set(), "b": {"c"}, "c": set()}
+    )
+    main.start_all_modules()
+    assert started["b"] >= finished["c"]
+    assert started["a"] < finished["c"]
+
+    # Yet routes and tags are registered in config order
+    assert [route.path for route in app.router.routes] == ["/a", "/b", "/c"]
+    assert [tag["name"] for tag in tags_metadata] == ["a", "b", "c"]
+
+    # Cycles are detected instead of waiting forever
+    monkeypatch.setattr(
+        main, "get_enabled_modules", lambda: {"a": set(), "b": {"c"}, "c": {"b"}}
+    )
+    with pytest.raises(ValueError, match="Cyclic"):
+        main.start_all_modules()
+
+    # Lazy modules are not there to wait for
+    main.settings["c"] = SimpleNamespace(lazy=True, prefixes=["/c"])
+    monkeypatch.setattr(
+        main, "get_enabled_modules", lambda: {"a": set(), "b": {"c"}, "c": set()}
+    )
+    with pytest.raises(ValueError, match="only initialized on request"):
+        main.start_all_modules()
+
+
+def test_enabled_modules(monkeypatch):
+    settings = Dynaconf(settings_files=[])
+    settings.set("mcr", {"enable": True})
+    settings.set("itch", {"enable": False})
+    settings.set("badges", {"enable": True, "after": ["mcr", "itch"]})
+    monkeypatch.setattr(main, "settings", settings)
+
+    # In config order, depending on enabled modules only
+    enabled = main.get_enabled_modules()
+    assert list(enabled) == ["mcr", "badges"]
+    assert enabled == {"mcr": set(), "badges": {"mcr"}}
+
+
+def test_stage_module(monkeypatch):
+    def start_module(name: str, target: FastAPI, tags: list[dict]):
+        target.add_middleware(GZipMiddleware)
+        return 0, 0
+
+    monkeypatch.setattr(main, "start_module", start_module)
+
+    # Only routes are kept, anything else fails instead of getting lost
+    with pytest.raises(ValueError, match="middleware"):
+        main.stage_module("a")
@@ -43,8 +43,10 @@ def load_conversation() -> list[Message]:
 def test():
     conversation = load_conversation()
 
-    manager = MemoryManager(get_cache_path("test_memory.db"))
-    manager.prune()
+    manager = MemoryManager(
+        get_cache_path("test_memory.db"), background_compaction=False
+    )
+    manager.prune(retention_days=0)
     session_id = "test"
 
     history = None
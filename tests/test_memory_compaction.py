@@ -0,0 +1,195 @@
+import asyncio
+import threading
+import time
+
+from langchain_core.runnables import RunnableLambda
+
+from app.llm.memory import IdleCompactor, Memory, MemoryManager
+from app.llm.types import Message, Role
+
+
+def fake_summary(inputs: dict) -> str:
+    return f"Summary of {inputs['messages'].count(chr(10)) + 1} messages."
+
+
+def get_manager(tmp_path, monkeypatch, **kwargs) -> MemoryManager:
+    monkeypatch.setenv("LITELLM_API_KEY", "unused")
+    manager = MemoryManager(tmp_path / "memory.db", characters_per_level=100, **kwargs)
+    manager.chain = RunnableLambda(fake_summary)
+    return manager
+
+
+def get_conversation(turns: int) -> list[Message]:
+    return [
+        Message(
+            role=Role.user if i % 2 == 0 else Role.assistant,
+            content=f"This is message number {i}, long enough to fill the memory.",
+            name="Josef" if i % 2 == 0 else "You",
+        )
+        for i in range(turns)
+    ]
+
+
+def test(tmp_path, monkeypatch):
+    manager = get_manager(tmp_path, monkeypatch)
+    conversation = get_conversation(8)
+
+    # The request returns the uncompressed history right away
+    history = manager.add_fetch_compress("test", conversation)
+    assert len(history) == 8
+
+    # The compactor swaps the oldest memories with a summary afterward
+    manager.compactor.join()
+    memories = manager.fetch_memories("test")
+    assert memories[0].level == 1
+    assert memories[0].content.startswith("Summary of")
+    assert len(memories) < 8
+
+    # Already tracked messages are not added again
+    history = manager.add_fetch_compress("test", conversation)
+    assert len(history) == len(memories)
+
+    # Sessions are queued once, until the compactor picks them up
+    release = threading.Event()
+    manager.chain = RunnableLambda(lambda inputs: release.wait() and "Summary")
+    manager.add_fetch_compress("busy", conversation)
+    for _ in range(3):
+        manager.compactor.submit("waiting")
+    assert [s for s, _ in manager.compactor.queue.queue].count("waiting") == 1
+    release.set()
+    manager.compactor.join()
+    assert not manager.compactor.pending
+
+    # Closing the manager stops the compactor along with the store
+    manager.close()
+    assert not manager.compactor.thread.is_alive()
+
+
+def test_inline(tmp_path, monkeypatch):
+    manager = get_manager(tmp_path, monkeypatch, background_compaction=False)
+    history = manager.add_fetch_compress("test", get_conversation(8))
+    assert len(history) < 8
+    assert len(manager.fetch_memories("test")) == len(history)
+
+
+def contents(manager: MemoryManager, session_id: str) -> list[tuple]:
+    return [(m.name, m.content, m.level) for m in manager.fetch_memories(session_id)]
+
+
+def test_parity(tmp_path, monkeypatch):
+    (tmp_path / "sync").mkdir()
+    (tmp_path / "async").mkdir()
+    sync = get_manager(tmp_path / "sync", monkeypatch, background_compaction=False)
+    manager = get_manager(tmp_path / "async", monkeypatch, background_compaction=False)
+    conversation = get_conversation(20)
+
+    async def run():
+        histories = []
+        for turns in range(2, 21, 3):
+            histories.append(
+                await manager.aadd_fetch_compress("test", conversation[:turns])
+            )
+        await manager.aclose()
+        return histories
+
+    histories = asyncio.run(run())
+    for turns, history in zip(range(2, 21, 3), histories):
+        assert sync.add_fetch_compress("test", conversation[:turns]) == history
+
+    # The async writes are visible to sync readers, also without the cache
+    manager.store.sessions.clear()
+    assert contents(manager, "test") == contents(sync, "test")
+    assert contents(sync, "test")[0][2] > 0
+
+
+def test_concurrent(tmp_path, monkeypatch):
+    manager = get_manager(tmp_path, monkeypatch)
+
+    async def run():
+        histories = await asyncio.gather(
+            *[
+                manager.ainvoke(
+                    {"session_id": f"session_{i}", "conversation": get_conversation(8)}
+                )
+                for i in range(10)
+            ]
+        )
+        await manager.aclose()
+        return histories
+
+    assert all(len(history) == 8 for history in asyncio.run(run()))
+
+    manager.compactor.join()
+    manager.store.sessions.clear()
+    for i in range(10):
+        assert manager.fetch_memories(f"session_{i}")[0].level == 1
+
+
+def test_single_flight(tmp_path, monkeypatch):
+    manager = get_manager(tmp_path, monkeypatch, background_compaction=False)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_summary(inputs: dict) -> str:
+        started.set()
+        release.wait()
+        return fake_summary(inputs)
+
+    manager.chain = RunnableLambda(slow_summary)
+    manager.add_memories(
+        [
+            Memory(-1, "test", "Josef", i, m.content, 0)
+            for i, m in enumerate(get_conversation(8))
+        ]
+    )
+    before = manager.fetch_memories("test")
+
+    thread = threading.Thread(target=manager.compress_memory, args=(before,))
+    thread.start()
+    started.wait()
+
+    # Another request keeps its view instead of summarizing the same rows
+    assert manager.compress_memory(before) == before
+    release.set()
+    thread.join()
+
+    # Once done, the old view is stale
+    assert manager.compress_memory(before) == before
+    assert [m.level for m in manager.fetch_memories("test")].count(1) == 1
+
+
+def test_idle(tmp_path, monkeypatch):
+    manager = get_manager(tmp_path, monkeypatch, background_compaction=False)
+    now = int(time.time() * 1000)
+
+    def add(session_id: str, turns: int, at: int):
+        manager.add_memories(
+            [
+                Memory(-1, session_id, m.name, at + i, m.content, 0)
+                for i, m in enumerate(get_conversation(turns))
+            ]
+        )
+
+    add("idle", 8, 0)
+    add("idle_short", 1, 0)
+    add("active", 8, now)
+
+    # Just above the level size, below what requests compact
+    manager.add_memories(
+        [Memory(-1, "near", "Josef", i, "x" * 40, 0) for i in range(3)]
+    )
+
+    compactor = IdleCompactor(manager, idle_minutes=10, batch_size=1, dry_run=True)
+    assert compactor.run() == (2, 0)
+    assert manager.fetch_memories("idle")[0].level == 0
+
+    compactor.dry_run = False
+    assert compactor.run() == (2, 2)
+    assert manager.fetch_memories("idle")[0].level == 1
+    assert manager.fetch_memories("near")[0].level == 1
+    assert manager.fetch_memories("active")[0].level == 0
+
+    # Sessions of other characters are left alone
+    add("other", 8, 0)
+    assert IdleCompactor(manager, idle_minutes=10, session_glob="near*").run() == (0, 0)
+    assert manager.fetch_memories("other")[0].level == 0
@@ -0,0 +1,72 @@
+import asyncio
+
+from langchain_core.embeddings import Embeddings
+
+from app.llm.memory import Memory, MemoryManager
+from app.llm.types import Message, Role
+
+TOPICS = ["emerald", "wheat", "zombie", "wedding", "library"]
+
+
+class KeywordEmbedding(Embeddings):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return [text.count(topic) + 0.01 for topic in TOPICS]
+
+
+def get_memories(count: int) -> list[Memory]:
+    return [
+        Memory(
+            -1, "test", "Josef", i, f"Message {i} is about the {TOPICS[i % 5]}. " * 3, 0
+        )
+        for i in range(count)
+    ]
+
+
+def test(tmp_path, monkeypatch):
+    monkeypatch.setenv("LITELLM_API_KEY", "unused")
+
+    # Memories written before recall was enabled are embedded on first use
+    MemoryManager(tmp_path / "memory.db", background_compaction=False).add_memories(
+        get_memories(50)
+    )
+    manager = MemoryManager(
+        tmp_path / "memory.db",
+        background_compaction=False,
+        characters_per_level=100_000,
+        embedding=KeywordEmbedding(),
+        recall_k=3,
+        recall_characters=1000,
+    )
+
+    conversation = [
+        Message(role=Role.user, content="Where did you hide the emerald?", name="Josef")
+    ]
+    history = manager.add_fetch_compress("test", conversation)
+    assert sum(len(m.content) for m in history) <= 1000
+    assert history[-1].content == conversation[0].content
+
+    # The recalled older memories are the relevant ones, in order
+    older = [m.content for m in history if "Message" in m.content][:3]
+    assert all("emerald" in content for content in older)
+    assert older == sorted(older, key=lambda c: int(c.split()[1]))
+
+    # Same for the async path
+    async def run():
+        result = await manager.aadd_fetch_compress("test", conversation)
+        await manager.aclose()
+        return result
+
+    assert asyncio.run(run()) == history
+
+    # New memories are embedded on write, and removed along with them
+    def embedded() -> set[int]:
+        rows = manager.store.conn.execute("SELECT memory_id FROM memory_embedding")
+        return {row[0] for row in rows}
+
+    memories = manager.fetch_memories("test")
+    assert memories[-1].id in embedded()
+    manager.remove_memories(memories[:10])
+    assert not embedded() & {m.id for m in memories[:10]}
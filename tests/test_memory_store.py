@@ -0,0 +1,175 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from app.llm.memory import Memory, MemoryManager
+from app.llm.memory_store import (
+    MIGRATIONS,
+    MemoryStore,
+    shard_database,
+    vacuum_database,
+)
+
+
+def test(tmp_path, monkeypatch):
+    monkeypatch.setenv("LITELLM_API_KEY", "unused")
+    manager = MemoryManager(tmp_path / "memory.db", background_compaction=False)
+
+    memories = [Memory(-1, "test", "Josef", i, f"Message {i}", 0) for i in range(5)]
+    manager.add_memories(memories)
+    assert [m.id for m in manager.fetch_memories("test")] == [m.id for m in memories]
+
+    summary = Memory(-1, "test", "memory", 1, "Summary", 1)
+    manager.replace_memories(memories[:3], summary)
+    assert [m.content for m in manager.fetch_memories("test")] == [
+        "Summary",
+        "Message 3",
+        "Message 4",
+    ]
+
+    # A failing replacement leaves the memories untouched
+    with pytest.raises(sqlite3.IntegrityError):
+        manager.replace_memories(memories[3:], Memory(-1, "test", "memory", 3, None, 1))
+    assert len(manager.fetch_memories("test")) == 3
+
+    # Managers share the store, closing one leaves it open for the others
+    other = MemoryManager(tmp_path / "memory.db", background_compaction=False)
+    assert other.store is manager.store
+    manager.close()
+    other.store.sessions.clear()
+    assert len(other.fetch_memories("test")) == 3
+
+    # Once closed by all, the next manager opens it again
+    other.close()
+    manager = MemoryManager(tmp_path / "memory.db", background_compaction=False)
+    assert len(manager.fetch_memories("test")) == 3
+
+
+def test_event_loops(tmp_path):
+    store = MemoryStore(tmp_path / "memory.db")
+
+    async def run(i: int) -> int:
+        async def write(j: int):
+            async with store.awrite() as conn:
+                await conn.execute(
+                    "INSERT INTO memory (session_id, name, time, content) VALUES (?, ?, ?, ?)",
+                    ("test", "Josef", j, f"Message {j}"),
+                )
+                await asyncio.sleep(0.01)
+
+        # Contended, so that the lock is bound to the loop
+        await asyncio.gather(*[write(i * 2 + j) for j in range(2)])
+        conn = await store.aread()
+        async with conn.execute("SELECT COUNT(*) FROM memory") as cursor:
+            return (await cursor.fetchone())[0]
+
+    # Each loop, e.g., of a job, uses its own connections, closed along with it
+    for i in range(3):
+        assert asyncio.run(run(i)) == (i + 1) * 2
+        assert not store.loops
+    store.close()
+
+
+def test_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("LITELLM_API_KEY", "unused")
+    manager = MemoryManager(tmp_path / "memory.db", background_compaction=False)
+    manager.add_memories(
+        [Memory(-1, "test", "Josef", i, f"Message {i}", 0) for i in range(5)]
+    )
+
+    def uncached() -> list[Memory]:
+        manager.store.sessions.clear()
+        return manager.fetch_memories("test")
+
+    # Writes go through to the cached session, and its index of tracked messages
+    memories = manager.fetch_memories("test")
+    assert "test" in manager.store.sessions.sessions
+    tracked = manager.store.sessions.get("test").tracked
+
+    manager.add_memories([Memory(-1, "test", "You", 5, "Message 5", 0) for _ in "ab"])
+    manager.replace_memories(memories[:2], Memory(-1, "test", "memory", 0, "Sum", 1))
+    manager.remove_memories(memories[3:4] + manager.fetch_memories("test")[-1:])
+    assert manager.store.sessions.get("test").tracked is tracked
+    assert manager.fetch_memories("test") == uncached()
+    assert tracked == manager.store.sessions.get("test").tracked
+
+    # A write to a session only rejects fills of that session read before it
+    sessions = manager.store.sessions
+    sessions.clear()
+    generation = sessions.generation
+    sessions.update("other", [], [])
+    sessions.fill("test", memories, generation)
+    assert sessions.get("test") is not None
+    sessions.update("other", [], [])
+    sessions.fill("other", memories, generation)
+    assert sessions.get("other") is None
+
+
+def test_prune(tmp_path, monkeypatch):
+    monkeypatch.setenv("LITELLM_API_KEY", "unused")
+    manager = MemoryManager(tmp_path / "memory.db", background_compaction=False)
+    assert manager.store.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    # Older databases get it once vacuumed offline
+    legacy = sqlite3.connect(tmp_path / "legacy.db")
+    legacy.execute(MIGRATIONS[0])
+    legacy.close()
+    vacuum_database(tmp_path / "legacy.db")
+    assert (
+        MemoryStore(tmp_path / "legacy.db")
+        .conn.execute("PRAGMA auto_vacuum")
+        .fetchone()[0]
+        == 2
+    )
+
+    # Idle sessions, and one which is still active
+    manager.add_memories(
+        [
+            Memory(-1, f"idle_{i}", "Josef", j, "x" * 1000, 0)
+            for i in range(50)
+            for j in range(10)
+        ]
+        + [Memory(-1, "active", "Josef", 2000, "Hello", 0)]
+    )
+    manager.fetch_memories("idle_0")
+
+    sessions, rows, reclaimed = manager.store.prune(cutoff=1000, batch_size=7)
+    assert (sessions, rows) == (50, 500)
+    assert reclaimed > 0
+    assert manager.fetch_memories("idle_0") == []
+    assert len(manager.fetch_memories("active")) == 1
+
+
+def test_shards(tmp_path, monkeypatch):
+    monkeypatch.setenv("LITELLM_API_KEY", "unused")
+    db_file = tmp_path / "memory.db"
+    manager = MemoryManager(db_file, background_compaction=False)
+    manager.add_memories(
+        [
+            Memory(-1, f"session_{i}", "Josef", j, f"Message {j}", 0)
+            for i in range(20)
+            for j in range(3)
+        ]
+    )
+    expected = {
+        f"session_{i}": manager.fetch_memories(f"session_{i}") for i in range(20)
+    }
+    manager.close()
+
+    assert shard_database(db_file, 4) == 60
+    sharded = MemoryManager(db_file, background_compaction=False, shards=4)
+    assert len({sharded.store.shard(s) for s in expected}) == 4
+    assert {s: sharded.fetch_memories(s) for s in expected} == expected
+
+    # Writes across shards still set ids and reach the right cache
+    sharded.add_memories([Memory(-1, s, "You", 5, "Reply", 0) for s in expected])
+    sharded.remove_memories(expected["session_0"][:1])
+    for shard in sharded.store.shards:
+        shard.sessions.clear()
+    assert len(sharded.fetch_memories("session_0")) == 3
+    assert len(sharded.fetch_memories("session_1")) == 4
+
+    # A different shard count would lose sessions
+    with pytest.raises(ValueError):
+        MemoryManager(db_file, background_compaction=False, shards=2)
@@ -0,0 +1,167 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+from app.llm.ratelimit import (
+    CircuitOpenError,
+    arate_limited_call,
+    get_limiter,
+    rate_limited_call,
+)
+
+
+def get_error(status: int, headers: dict) -> openai.APIStatusError:
+    response = httpx.Response(
+        status,
+        headers=headers,
+        request=httpx.Request("POST", "https://llm.test/v1/chat/completions"),
+    )
+    return openai.APIStatusError("error", response=response, body=None)
+
+
+def failing(failures: int, status: int = 429, headers: dict = None):
+    calls = []
+
+    def call(prompt: str) -> str:
+        calls.append(time.monotonic())
+        if len(calls) <= failures:
+            raise get_error(status, headers or {})
+        return prompt
+
+    return RunnableLambda(call), calls
+
+
+def test_retry():
+    get_limiter.cache_clear()
+
+    # Retry-After is honored
+    llm, calls = failing(2, headers={"retry-after": "0.05"})
+    assert rate_limited_call(llm, "Hello") == "Hello"
+    assert len(calls) == 3
+    assert calls[1] - calls[0] >= 0.05
+
+    # Waiting does not block the event loop
+    async def run():
+        llm, calls = failing(2, headers={"retry-after-ms": "50"})
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while len(calls) < 3:
+                ticks += 1
+                await asyncio.sleep(0.005)
+
+        result, _ = await asyncio.gather(arate_limited_call(llm, "Hello"), tick())
+        return result, ticks
+
+    result, ticks = asyncio.run(run())
+    assert result == "Hello"
+    assert ticks > 5
+
+    # Client errors are not retried
+    llm, calls = failing(1, status=400)
+    with pytest.raises(openai.APIStatusError):
+        rate_limited_call(llm, "Hello")
+    assert len(calls) == 1
+
+
+def test_circuit_breaker():
+    get_limiter.cache_clear()
+
+    # Repeated failures open the circuit, which fails fast
+    limiter = get_limiter("default", "default")
+    limiter.backoff = 0.001
+    limiter.cooldown = 0.1
+    llm, calls = failing(100, status=503)
+    with pytest.raises(CircuitOpenError):
+        rate_limited_call(llm, "Hello")
+    assert len(calls) == limiter.failure_threshold
+    with pytest.raises(CircuitOpenError):
+        rate_limited_call(llm, "Hello")
+    assert len(calls) == limiter.failure_threshold
+
+    # After the cooldown, a single request probes the upstream and closes it again
+    time.sleep(0.15)
+    llm, calls = failing(0)
+    assert rate_limited_call(llm, "Hello") == "Hello"
+    assert limiter.failures == 0
+
+
+def test_learn():
+    get_limiter.cache_clear()
+
+    # Requests are spaced out once the upstream announces its limit
+    limiter = get_limiter("llm.test", "model")
+    limiter.learn(
+        {
+            "x-ratelimit-limit-requests": "600",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-reset-requests": "120ms",
+        }
+    )
+    assert limiter.rate == 10
+    assert 0.1 <= limiter.acquire()[0] <= 0.15 * 1.25
+
+    # A 429 halves the announced limit, rather than the announced limit undoing it
+    limiter.failed(
+        get_error(429, {"x-ratelimit-limit-requests": "600", "retry-after": "0"}), 0
+    )
+    assert limiter.rate == 5
+
+
+def test_cancelled_probe():
+    get_limiter.cache_clear()
+
+    limiter = get_limiter("default", "default")
+    limiter.failures = limiter.failure_threshold
+
+    async def hang(prompt: str) -> str:
+        await asyncio.sleep(10)
+        return prompt
+
+    async def run():
+        task = asyncio.ensure_future(arate_limited_call(RunnableLambda(hang), "Hello"))
+        await asyncio.sleep(0.01)
+        assert limiter.probing
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    # A cancelled probe does not keep the circuit open for good
+    asyncio.run(run())
+    assert not limiter.probing
+    llm, calls = failing(0)
+    assert rate_limited_call(llm, "Hello") == "Hello"
+
+
+def test_request_errors():
+    get_limiter.cache_clear()
+
+    limiter = get_limiter("default", "default")
+
+    # A bad request does not reset the failures of the upstream
+    limiter.failures = limiter.failure_threshold - 1
+    llm, calls = failing(1, status=400)
+    with pytest.raises(openai.APIStatusError):
+        rate_limited_call(llm, "Hello")
+    assert limiter.failures == limiter.failure_threshold - 1
+
+    # Timeouts count as failure, but are not retried
+    calls = []
+
+    def timeout(prompt: str) -> str:
+        calls.append(time.monotonic())
+        raise openai.APITimeoutError(
+            httpx.Request("POST", "https://llm.test/v1/chat/completions")
+        )
+
+    with pytest.raises(openai.APITimeoutError):
+        rate_limited_call(RunnableLambda(timeout), "Hello")
+    assert len(calls) == 1
+    assert limiter.failures == limiter.failure_threshold
+    with pytest.raises(CircuitOpenError):
+        rate_limited_call(llm, "Hello")
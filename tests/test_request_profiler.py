@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from app import request_profiler
+from app.configurator import Configurator
+
+
+def busy(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test(monkeypatch):
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    app = FastAPI()
+    request_profiler.init(Configurator(app, {}))
+    configurator = Configurator(app, {})
+    configurator.register("ProfilerTest", "Profiler test.")
+
+    @configurator.get("/async")
+    async def profiled_async():
+        await asyncio.sleep(0.1)
+        busy(0.05)
+
+    @configurator.get("/sync")
+    def profiled_sync():
+        busy(0.05)
+
+    async def unrelated():
+        for _ in range(10):
+            busy(0.01)
+            await asyncio.sleep(0)
+
+    async def run():
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as client:
+
+            async def get(path: str, headers: dict = None) -> httpx.Response:
+                response = await client.get(path, headers=headers)
+                assert response.status_code == 200
+                return response
+
+            # Only admins may ask for a profile
+            assert "x-profile-id" not in (await get("/sync")).headers
+            assert (
+                "x-profile-id"
+                not in (await get("/sync", {"X-Profile": "guess"})).headers
+            )
+            sync_id = (await get("/sync", {"X-Profile": "secret"})).headers[
+                "x-profile-id"
+            ]
+
+            # Other requests on the same loop are not attributed to the profiled one
+            response, _ = await asyncio.gather(
+                get("/async", {"X-Profile": "secret"}), unrelated()
+            )
+            async_id = response.headers["x-profile-id"]
+
+            # Or a share of all requests
+            monkeypatch.setattr(request_profiler, "sample_rate", 1.0)
+            assert "x-profile-id" in (await get("/sync")).headers
+            monkeypatch.setattr(request_profiler, "sample_rate", 0.0)
+
+            assert (await client.get(f"/v1/profiles/{sync_id}")).status_code == 403
+            assert (
+                await client.get(
+                    "/v1/profiles/unknown", headers={"x-admin-token": "secret"}
+                )
+            ).status_code == 404
+
+            profiles = {}
+            for profile_id in [sync_id, async_id]:
+                profiles[profile_id] = (
+                    await get(f"/v1/profiles/{profile_id}", {"X-Admin-Token": "secret"})
+                ).json()
+            return profiles[sync_id], profiles[async_id]
+
+    sync_profile, async_profile = asyncio.run(run())
+
+    def sampled(profile: dict) -> set[str]:
+        frames = profile["shared"]["frames"]
+        return {
+            frames[i]["name"]
+            for thread in profile["profiles"]
+            for sample in thread["samples"]
+            for i in sample
+        }
+
+    # Sync endpoints are sampled on their worker thread
+    assert any("profiled_sync" in name for name in sampled(sync_profile))
+
+    names = sampled(async_profile)
+    assert any("profiled_async" in name for name in names)
+    assert not any("unrelated" in name for name in names)
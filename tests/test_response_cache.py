@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import httpx
+from fastapi import FastAPI
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+
+from app.configurator import Configurator
+from app.response_cache import ResponseCache, memory_cache
+
+
+def test():
+    app = FastAPI()
+    configurator = Configurator(app, {})
+    configurator.register("Test", "Response cache test.")
+
+    calls = []
+
+    @configurator.get("/square", cache=ResponseCache(expire=60, redis=False))
+    def square(x: int):
+        calls.append(x)
+        time.sleep(0.1)
+        return {"square": x * x}
+
+    async def run():
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as client:
+            # Concurrent misses are coalesced
+            responses = await asyncio.gather(
+                *[client.get("/square", params={"x": 3}) for _ in range(8)]
+            )
+            assert all(r.json() == {"square": 9} for r in responses)
+
+            # Hits are served from memory, other keys are computed
+            assert (await client.get("/square", params={"x": 3})).json() == {
+                "square": 9
+            }
+            assert (await client.get("/square", params={"x": 4})).json() == {
+                "square": 16
+            }
+
+    asyncio.run(run())
+
+    assert calls == [3, 4]
+
+
+def test_redis_ttl():
+    FastAPICache.init(InMemoryBackend())
+    cache = ResponseCache(expire=60)
+
+    async def run():
+        await FastAPICache.get_backend().set("ttl", b"value", expire=5)
+        return await cache.get("Test", "ttl")
+
+    # Promoted entries expire along with the Redis one
+    assert asyncio.run(run()) == b"value"
+    assert memory_cache["ttl"][0] <= time.time() + 5
@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+
+import anyio.to_thread
+from fastapi import FastAPI
+from prometheus_client import REGISTRY
+
+from app import threadpool
+from app.configurator import Configurator
+
+
+def get_gauge(name: str, pool: str) -> float:
+    return REGISTRY.get_sample_value(name, {"pool": pool})
+
+
+def test_default_size():
+    running = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def work():
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+
+    async def run():
+        threadpool.set_default_size(3)
+        assert anyio.to_thread.current_default_thread_limiter().total_tokens == 3
+        await asyncio.gather(
+            *[threadpool.default_pool.wrap("default", work)() for _ in range(6)]
+        )
+
+    # Sync endpoints without a dedicated pool share the resized default pool
+    asyncio.run(run())
+    assert peak == 3
+    assert get_gauge("threadpool_size", "default") == 3
+
+
+def test_dedicated_pool():
+    configurator = Configurator(FastAPI(), {"threads": 2})
+    configurator.register("ThreadPoolTest", "Thread pool test.")
+    slow = configurator.threaded(lambda: time.sleep(0.2))
+    fast = Configurator(FastAPI(), {}).threaded(lambda: time.monotonic())
+
+    async def run():
+        threadpool.set_default_size(2)
+        tasks = [asyncio.ensure_future(slow()) for _ in range(4)]
+        await asyncio.sleep(0.05)
+
+        # The module's own threads are busy, with requests waiting for them
+        assert get_gauge("threadpool_active_threads", "ThreadPoolTest") == 2
+        assert get_gauge("threadpool_waiting_tasks", "ThreadPoolTest") == 2
+
+        # Yet the default pool is free for everyone else
+        start = time.monotonic()
+        finished = await fast()
+        await asyncio.gather(*tasks)
+        return finished - start
+
+    assert asyncio.run(run()) < 0.1
+    assert get_gauge("threadpool_size", "ThreadPoolTest") == 2
+    assert get_gauge("threadpool_waiting_tasks", "ThreadPoolTest") == 0